@@ -1,6 +1,8 @@
 from gym.envs.registration import register
 from .ets2 import ETS2Env
 from .ats import ATSEnv
+from .observation import Observation
+from .vector import VecSimulatorEnv
 
 
 register(
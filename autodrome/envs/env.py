@@ -1,31 +1,53 @@
 import gym
 import math
+import time
+import timeit
+import unittest
 import numpy as np
 
-from ..simulator import Simulator
+from ..simulator import Simulator, Pose
 from ..policeman import Policeman
+from .observation import Observation
 
 
 class SimulatorEnv(gym.Env):
 
-    def __init__(self, simulator: Simulator, map: str):
+    def __init__(self, simulator: Simulator, map: str, policeman: bool=True, observation: Observation=None,
+                 analog: bool=False, spawn: Pose=None):
+        """ Episodes start with a reload of the map, unless there's a spawn pose or 'random' for a pose sampled from
+        the map nodes to teleport the truck to after the first episode """
         super().__init__()
-        self.action_space = gym.spaces.MultiDiscrete(nvec=[3, 3])  # [Left, Straight, Right], [Accelerate, Coast, Brake]
+        if spawn == 'random' and not policeman:
+            raise ValueError("Random spawn poses are sampled from the map of the policeman")
+        if analog:  # [Steer, Throttle, Brake] with steering positive to the left
+            self.action_space = gym.spaces.Box(np.array([-1, 0, 0]), np.array([+1, 1, 1]), dtype=np.float32)
+        else:  # [Left, Straight, Right], [Accelerate, Coast, Brake]
+            self.action_space = gym.spaces.MultiDiscrete(nvec=[3, 3])
+        self.analog = analog
         width, height = int(Simulator.Config['r_mode_width']), int(Simulator.Config['r_mode_height'])
-        self.observation_space = gym.spaces.Box(0, 255, shape=[width, height, 3], dtype=np.uint8)  # Raw Screen Pixels
+        self.observation = Observation() if observation is None else observation  # Raw Screen Pixels by default
+        self.observation_space = self.observation.space((height, width, 3))
 
         self.map = map
         self.simulator = simulator
+        self.simulator.observation = self.observation
+        self.simulator.analog = analog
         self.simulator.start()
 
-        self.policeman = Policeman(simulator)
-        self.info = {'map': self.policeman.map, 'world': self.policeman.world}
+        self.policeman = Policeman(simulator) if policeman else None  # Needs extracted game archives
+        self.info = {'map': self.policeman.map, 'world': self.policeman.world} if policeman else {}
+        self.spawn = spawn
+        self.nodes = list(self.policeman.map['nodes'].values()) if spawn == 'random' else None
         self.pixels, self.data = None, None
         self.viewer = None
 
     def step(self, action: np.ndarray) -> tuple:
-        self.simulator.control(steer=action[0] - 1,  acceleration=action[1] - 1)
+        if self.analog:
+            self.simulator.drive(steer=action[0], throttle=action[1], brake=action[2])
+        else:
+            self.simulator.control(steer=action[0] - 1,  acceleration=action[1] - 1)
         self.pixels, self.data = self.simulator.frame(self.data)
+        self.info['stale'] = self.simulator.stale  # Observation is a duplicate of the previous one
         if self.data.wearCabin > 0 or self.data.wearChassis > 0:
             reward, done = -1, True
         else:
@@ -33,14 +55,27 @@ class SimulatorEnv(gym.Env):
         return self.pixels, reward, done, self.info
 
     def reset(self) -> np.array:
-        self.simulator.command(f'preview {self.map}')
-        self.data = self.simulator.wait()
-        self.pixels, self.data = self.simulator.frame(self.data)
+        start = time.perf_counter()
+        data = None
+        if self.spawn is not None and self.data is not None:
+            data = self.simulator.teleport(self.pose(), self.data)
+        self.info['reset'] = 'reload' if data is None else 'teleport'
+        if data is None:  # First episode or the teleport didn't work out
+            data = self.simulator.reload(self.map)
+        self.pixels, self.data = self.simulator.frame(data)
         if self.data.parkingBrake:
             self.simulator.keyboard.type(' ')  # Release parking brake
         self.simulator.keyboard.type('4')  # Switch to bumper camera
+        self.info['reset_seconds'] = time.perf_counter() - start
         return self.pixels
 
+    def pose(self) -> Pose:
+        """ Spawn pose of the next episode """
+        if self.spawn != 'random':
+            return self.spawn
+        position = self.nodes[self.np_random.integers(len(self.nodes))]['position']
+        return Pose(position['x'], position['y'], position['z'])
+
     def render(self, mode='human'):
         if mode == 'human':
             self._render_human()
@@ -76,14 +111,111 @@ class SimulatorEnv(gym.Env):
             from pyglet import window
             from gym.envs.classic_control import rendering
             self.viewer = rendering.SimpleImageViewer()
-            width, height = self.observation_space.shape[0] // 2, self.observation_space.shape[1] // 2
+            height, width = self.observation_space.shape[0] // 2, self.observation_space.shape[1] // 2
             self.viewer.window = window.Window(width, height, vsync=False, resizeable=False)
             self.viewer.window.set_location(2 * width, height)
 
         if self.pixels is not None:
-            self.viewer.imshow(self.pixels[::2, ::2, [2, 1, 0]])
+            self.viewer.imshow(self.observation.rgb(self.pixels[::2, ::2]))
             self.pixels = None
         return self.viewer.isopen
 
     def close(self):
         self.simulator.terminate()
+
+
+# region Unit Tests
+
+
+from ..simulator.replay import Replay
+from ..simulator.telemetry.replay import ReplayServer
+
+
+class TestSimulatorEnv(unittest.TestCase):
+    RepeatFPS = 500
+    MinimumFPS = 200
+
+    def test_step(self):
+        env = SimulatorEnv(Replay(), map='indy500', policeman=False)
+        env.reset()
+        seconds = timeit.timeit(lambda: env.step(np.array([1, 2])), number=self.RepeatFPS)
+        env.close()
+        self.assertGreater(self.RepeatFPS / seconds, self.MinimumFPS)
+
+    def test_crash(self):
+        env = SimulatorEnv(Replay(ReplayServer.synthetic(50)), map='indy500', policeman=False)
+        env.reset()
+        done, steps = False, 0
+        while not done:
+            pixels, reward, done, info = env.step(np.array([1, 2]))
+            steps += 1
+        env.close()
+        self.assertEqual(reward, -1)
+        self.assertLess(steps, 50)
+
+    def test_analog(self):
+        env = SimulatorEnv(Replay(), map='indy500', policeman=False, analog=True)
+        env.reset()
+        for step in range(10):
+            env.step(np.array([0.1, 1.0, 0.0]))
+        env.step(np.array([0.1, 0.5, 0.0]))
+        wheel, keyboard = env.simulator.wheel, env.simulator.keyboard
+        env.close()
+        self.assertIsInstance(env.action_space, gym.spaces.Box)
+        self.assertEqual(wheel.sent, 2)  # Repeated actions aren't sent again
+        self.assertAlmostEqual(wheel.throttle.value, 0.5, places=2)
+        self.assertLess(wheel.steer.value, 0)
+        self.assertFalse(keyboard.pressed)  # No arrow keys held
+
+    def test_control(self):
+        env = SimulatorEnv(Replay(), map='indy500', policeman=False)
+        env.reset()
+        keyboard, window = env.simulator.keyboard, env.simulator.window
+        for step, action in enumerate([[1, 2]] * 5 + [[2, 2]] * 5 + [[1, 1]] * 5):
+            if step == 7:
+                window.activations = 0  # Focus lost while the same keys are held
+            env.step(np.array(action))
+        metrics = env.simulator.metrics
+        env.close()
+        self.assertEqual(keyboard.pressed, set())
+        self.assertEqual(window.activations, 1)
+        self.assertEqual(metrics['activations'], 1)
+        self.assertEqual(metrics['transitions'], 6)  # Press ↑, press ←, press them again, release ← and ↑
+        self.assertEqual(metrics['controls'], 15)
+        self.assertGreater(metrics['control_seconds'], 0)
+
+    def test_teleport(self):
+        env = SimulatorEnv(Replay(ReplayServer.synthetic(50)), map='indy500', policeman=False,
+                           spawn=Pose(100.0, 0.0, 0.0))
+        resets = []
+        for episode in range(3):
+            env.reset()
+            resets.append(env.info['reset'])
+            done = False
+            while not done:
+                pixels, reward, done, info = env.step(np.array([1, 2]))
+        metrics = env.simulator.metrics
+        env.close()
+        self.assertEqual(resets, ['reload', 'teleport', 'teleport'])
+        self.assertEqual((metrics['reloads'], metrics['teleports']), (1, 2))
+        self.assertLess(metrics['teleport_seconds'] / 2, metrics['reload_seconds'])
+
+    def test_observation(self):
+        observation = Observation(crop=(200, None, None, None), downsample=4, grayscale=True, dtype=np.float16)
+        for threaded in (True, False):
+            env = SimulatorEnv(Replay(threaded=threaded), map='indy500', policeman=False, observation=observation)
+            first = env.reset()
+            pixels, reward, done, info = env.step(np.array([1, 2]))
+            env.close()
+            self.assertEqual(env.observation_space.shape, (100, 256, 1))
+            self.assertTrue(env.observation_space.contains(pixels))
+            if not threaded:
+                self.assertIs(pixels, first)  # Captured into the same buffer every step
+        env = SimulatorEnv(Replay(threaded=False), map='indy500', policeman=False)
+        pixels, window = env.reset(), env.simulator.window
+        env.close()
+        self.assertFalse(np.shares_memory(pixels, window.pixels))  # Raw pixels are copied out of the window
+        self.assertTrue(pixels.flags['C_CONTIGUOUS'])
+
+
+# endregion
@@ -0,0 +1,140 @@
+import gym
+import timeit
+import unittest
+import numpy as np
+
+
+class Observation:
+    """ Declarative preprocessing of captured RGB window pixels into observations of the environment
+    Pixels are cropped to the region of interest [top:bottom, left:right], averaged over square blocks of
+    downsample x downsample pixels, optionally converted to grayscale and written as uint8 or as float16 scaled to
+    [0, 1]. Cropping is a view and the rest is done in one vectorized pass over the region into a preallocated output,
+    so only the reduced observation is ever copied. """
+    Dtypes = (np.uint8, np.float16)
+    Luma = np.array([0.299, 0.587, 0.114])
+
+    def __init__(self, crop: tuple=(None, None, None, None), downsample: int=1, grayscale: bool=False,
+                 dtype: type=np.uint8):
+        if np.dtype(dtype) not in self.Dtypes:
+            raise ValueError(f"Observation dtype '{np.dtype(dtype)}' is not one of {self.Dtypes}")
+        if downsample < 1:
+            raise ValueError(f"Downsampling factor {downsample} is not a positive integer")
+        top, bottom, left, right = crop
+        self.rows, self.columns = slice(top, bottom), slice(left, right)
+        self.downsample, self.grayscale, self.dtype = downsample, grayscale, np.dtype(dtype)
+
+        scale = 1.0 / downsample ** 2 / (255.0 if self.dtype == np.float16 else 1.0)
+        self.weights = (self.Luma * scale).astype(np.float32)
+        self.scale = np.float32(scale)
+        self.scratch = None
+
+    @property
+    def identity(self) -> bool:
+        """ Whether the pipeline only crops the pixels """
+        return self.downsample == 1 and not self.grayscale and self.dtype == np.uint8
+
+    def shape(self, shape: tuple) -> tuple:
+        """ Shape of observations made from pixels of the shape (Height, Width, 3) """
+        height = len(range(*self.rows.indices(shape[0]))) // self.downsample
+        width = len(range(*self.columns.indices(shape[1]))) // self.downsample
+        return height, width, 1 if self.grayscale else 3
+
+    def space(self, shape: tuple) -> gym.spaces.Box:
+        """ Observation space of observations made from pixels of the shape (Height, Width, 3) """
+        high = 255 if self.dtype == np.uint8 else 1.0
+        return gym.spaces.Box(0, high, shape=self.shape(shape), dtype=self.dtype)
+
+    def empty(self, shape: tuple) -> np.ndarray:
+        """ Allocate a contiguous array for observations made from pixels of the shape (Height, Width, 3) """
+        return np.empty(self.shape(shape), dtype=self.dtype)
+
+    def __call__(self, pixels: np.ndarray, out: np.ndarray=None) -> np.ndarray:
+        """ Preprocess pixels into the preallocated output array or into a new one """
+        out = self.empty(pixels.shape) if out is None else out
+        height, width, channels = out.shape
+        region = pixels[self.rows, self.columns][:height * self.downsample, :width * self.downsample]
+        if self.identity:
+            np.copyto(out, region)
+            return out
+
+        blocks = region.reshape(height, self.downsample, width, self.downsample, 3)
+        if self.scratch is None or self.scratch.shape != out.shape:
+            self.scratch = np.empty(out.shape, dtype=np.float32)
+        if self.grayscale:
+            np.einsum('hawbc,c->hw', blocks, self.weights, out=self.scratch[..., 0], dtype=np.float32, casting='unsafe')
+        else:
+            np.copyto(self.scratch, blocks[:, 0, :, 0])
+            for row in range(self.downsample):
+                for column in range(1 if row == 0 else 0, self.downsample):
+                    np.add(self.scratch, blocks[:, row, :, column], out=self.scratch)
+            np.multiply(self.scratch, self.scale, out=self.scratch)
+        if self.dtype == np.uint8:
+            np.rint(self.scratch, out=self.scratch)
+        np.copyto(out, self.scratch, casting='unsafe')
+        return out
+
+    def rgb(self, observation: np.ndarray) -> np.ndarray:
+        """ Observation as uint8 RGB pixels for display """
+        if self.dtype == np.float16:
+            observation = np.rint(np.clip(observation, 0.0, 1.0) * 255.0).astype(np.uint8)
+        if observation.shape[2] == 1:
+            observation = np.repeat(observation, 3, axis=2)
+        return np.ascontiguousarray(observation)
+
+
+# region Unit Tests
+
+
+class TestObservation(unittest.TestCase):
+    Shape = (600, 1024, 3)
+    RepeatFPS = 100
+    MinimumFPS = 200
+
+    def setUp(self):
+        self.pixels = np.random.RandomState(0).randint(0, 256, size=self.Shape, dtype=np.uint8)
+
+    def test_identity(self):
+        observation = Observation()
+        self.assertEqual(observation.space(self.Shape).shape, self.Shape)
+        self.assertEqual(observation(self.pixels).tolist(), self.pixels.tolist())
+
+    def test_crop(self):
+        observation = Observation(crop=(100, -100, 12, None))
+        self.assertEqual(observation.shape(self.Shape), (400, 1012, 3))
+        self.assertEqual(observation(self.pixels).tolist(), self.pixels[100:-100, 12:].tolist())
+
+    def test_downsample(self):
+        observation = Observation(crop=(0, 598, None, None), downsample=4)
+        self.assertEqual(observation.shape(self.Shape), (149, 256, 3))
+        expected = self.pixels[:596].reshape(149, 4, 256, 4, 3).mean(axis=(1, 3))
+        self.assertLessEqual(np.abs(observation(self.pixels) - expected).max(), 0.5)
+
+    def test_grayscale(self):
+        observation = Observation(downsample=2, grayscale=True, dtype=np.float16)
+        space = observation.space(self.Shape)
+        self.assertEqual(space.shape, (300, 512, 1))
+        self.assertEqual(space.dtype, np.float16)
+        expected = self.pixels.reshape(300, 2, 512, 2, 3).mean(axis=(1, 3)) @ Observation.Luma / 255
+        self.assertLess(np.abs(observation(self.pixels)[..., 0] - expected).max(), 1e-3)
+        self.assertTrue(space.contains(observation(self.pixels)))
+
+    def test_rgb(self):
+        observation = Observation(downsample=2, grayscale=True, dtype=np.float16)
+        rgb = observation.rgb(observation(self.pixels))
+        self.assertEqual((rgb.shape, rgb.dtype), ((300, 512, 3), np.uint8))
+        self.assertEqual(rgb[..., 0].tolist(), rgb[..., 2].tolist())
+        expected = self.pixels.reshape(300, 2, 512, 2, 3).mean(axis=(1, 3)) @ Observation.Luma
+        self.assertLessEqual(np.abs(rgb[..., 0] - expected).max(), 1.0)
+
+    def test_performance(self):
+        observation = Observation(crop=(100, 500, None, None), downsample=4, grayscale=True)
+        out = observation.empty(self.Shape)
+        seconds = timeit.timeit(lambda: observation(self.pixels, out=out), number=self.RepeatFPS)
+        self.assertGreater(self.RepeatFPS / seconds, self.MinimumFPS)
+
+    def test_dtype(self):
+        with self.assertRaises(ValueError):
+            Observation(dtype=np.float64)
+
+
+# endregion
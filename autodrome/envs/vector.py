@@ -0,0 +1,343 @@
+import os
+import gym
+import sys
+import time
+import signal
+import tempfile
+import unittest
+import traceback
+import collections
+import multiprocessing.connection
+import numpy as np
+from pathlib import Path
+
+
+def worker(index: int, factory: callable, connection: multiprocessing.connection.Connection):
+    """ Worker process running the environment made by factory(index) until it gets 'close'
+    Observations are written into the row of the shared memory file, only rewards, done flags and scalar info entries
+    go through the pipe. Episodes that are done are reset right away. Any error is sent back before exiting. """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))  # Close the simulator when terminated
+    env = None
+    try:
+        env = factory(index)
+        connection.send(('ready', (env.observation_space, env.action_space)))
+        space = env.observation_space
+        observations = np.memmap(connection.recv(), dtype=space.dtype, mode='r+').reshape((-1,) + space.shape)
+        while True:
+            command, action = connection.recv()
+            if command == 'close':
+                break
+            if command == 'reset':
+                pixels, reward, done, info = env.reset(), 0.0, False, {}
+            else:
+                pixels, reward, done, info = env.step(action)
+                if done:
+                    pixels = env.reset()
+            np.copyto(observations[index], pixels)
+            info = {key: value for key, value in info.items() if np.isscalar(value)}
+            connection.send(('ok', (reward, done, info)))
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        if env is not None:
+            env.close()
+
+
+class VecSimulatorEnv:
+    """ Batch of environments stepped together in worker processes with observations in one shared memory array
+    Every worker runs the environment made by factory(index), i.e. with its own simulator instance. Observations of all
+    the workers are written into a memory-mapped file of shape (N, Height, Width, Channels), so pixels are never
+    pickled. Episodes are reset in the worker as soon as they're done. A worker that fails, dies or doesn't reply in
+    time is restarted in the background and reported as done with the error in info['failure'] until it's ready, the
+    rest keeps going. Its first reply after the restart is the reset one. Restarts that fail are tried again after a
+    backoff that doubles every time. """
+    StartTimeout = 300.0  # Seconds to launch a simulator
+    StepTimeout = 30.0  # Seconds to step or reset an environment
+    RestartBackoff = 10.0  # Seconds before the first retry of a failed restart
+
+    class Failed(Exception):
+        """ Exception raised when a worker reports an error, exits or doesn't reply in time """
+        pass
+
+    def __init__(self, factory: callable, count: int, timeout: float=StepTimeout, start_timeout: float=StartTimeout):
+        self.factory, self.count = factory, count
+        self.timeout, self.start_timeout = timeout, start_timeout
+        self.processes, self.connections = [None] * count, [None] * count
+        self.failures = collections.Counter()  # Restarts of every worker
+        self.dead = {}  # Error of every worker that is down until its restart works
+        self.starting = {}  # Start deadline of every worker restarting in the background
+        self.retries = {}  # Time of the next restart of every worker whose restart failed
+        self.backoff = collections.Counter()  # Failed restarts of every worker in a row
+
+        self.path = None
+        try:
+            for index in range(count):
+                self.spawn(index)
+            spaces = [self.receive(index, self.start_timeout) for index in range(count)]
+            self.observation_space, self.action_space = spaces[0]
+            self.num_envs = count
+
+            shm = Path('/dev/shm') if Path('/dev/shm').is_dir() else Path(tempfile.gettempdir())
+            descriptor, self.path = tempfile.mkstemp(prefix='autodrome_observations_', suffix='.mem', dir=shm)
+            os.close(descriptor)
+            self.observations = np.memmap(self.path, dtype=self.observation_space.dtype, mode='w+',
+                                          shape=(count,) + self.observation_space.shape)
+            for connection in self.connections:
+                connection.send(self.path)
+        except BaseException:  # Simulators that did start would be left running
+            for index in range(count):
+                if self.processes[index] is not None:
+                    self.kill(index)
+            if self.path is not None:
+                os.unlink(self.path)
+            raise
+
+    def spawn(self, index: int):
+        """ Start the worker process of the environment """
+        self.connections[index], connection = multiprocessing.Pipe()
+        self.processes[index] = multiprocessing.Process(target=worker, args=(index, self.factory, connection),
+                                                        daemon=True)
+        self.processes[index].start()
+        connection.close()
+
+    def kill(self, index: int):
+        """ Terminate the worker process and let it close its simulator """
+        self.processes[index].terminate()
+        self.processes[index].join(timeout=self.timeout)
+        if self.processes[index].is_alive():
+            self.processes[index].kill()
+            self.processes[index].join()
+        self.connections[index].close()
+
+    def restart(self, index: int):
+        """ Replace the worker process with a new one that starts in the background """
+        self.kill(index)
+        self.failures[index] += 1
+        self.spawn(index)
+        self.starting[index] = time.monotonic() + self.start_timeout
+
+    def send(self, index: int, message: tuple):
+        """ Send the message to the worker, a broken pipe shows up in the reply """
+        try:
+            self.connections[index].send(message)
+        except OSError:
+            pass
+
+    def receive(self, index: int, timeout: float) -> object:
+        """ Reply of the worker or Failed exception """
+        connection = self.connections[index]
+        try:
+            if not connection.poll(timeout):
+                raise self.Failed(f"Worker {index} didn't reply in {timeout} seconds")
+            status, payload = connection.recv()
+        except (EOFError, OSError):
+            raise self.Failed(f"Worker {index} exited with code {self.processes[index].exitcode}")
+        if status == 'error':
+            raise self.Failed(payload)
+        return payload
+
+    def revive(self, index: int) -> bool:
+        """ Check on the worker restarting in the background without waiting and return whether it's ready
+        The restart is tried again once the backoff of a failed one is over. """
+        if index in self.retries:
+            if time.monotonic() < self.retries[index]:
+                return False
+            del self.retries[index]
+            self.restart(index)
+        try:
+            if not self.connections[index].poll(0):
+                if time.monotonic() < self.starting[index]:
+                    return False
+                raise self.Failed(f"Worker {index} didn't start in {self.start_timeout} seconds")
+            self.receive(index, 0)
+        except self.Failed as error:
+            del self.starting[index]
+            self.kill(index)
+            self.dead[index] = f"Restart failed: {error}"
+            self.retries[index] = time.monotonic() + self.RestartBackoff * 2 ** self.backoff[index]
+            self.backoff[index] += 1
+            return False
+        del self.starting[index], self.dead[index], self.backoff[index]
+        self.send(index, self.path)
+        return True
+
+    def collect(self, command: str, actions: list) -> tuple:
+        """ Send the command to all workers at once and gather the replies, restarting the failed workers
+        Workers back from a restart get a reset instead of the command. """
+        revived = {index for index in list(self.dead) if self.revive(index)}
+        for index, action in enumerate(actions):
+            if index in revived:
+                self.send(index, ('reset', None))
+            elif index not in self.dead:
+                self.send(index, (command, action))
+        rewards, dones = np.zeros(self.count, dtype=np.float32), np.zeros(self.count, dtype=bool)
+        infos = [{} for index in range(self.count)]
+        for index in range(self.count):
+            if index in self.dead:
+                dones[index], infos[index] = True, {'failure': self.dead[index]}
+                continue
+            try:
+                rewards[index], dones[index], infos[index] = self.receive(index, self.timeout)
+            except self.Failed as failure:
+                self.restart(index)
+                self.dead[index] = str(failure)
+                dones[index], infos[index] = True, {'failure': self.dead[index]}
+        return rewards, dones, infos
+
+    def reset(self) -> np.ndarray:
+        """ Reset all environments and return their observations, the array is overwritten by the next call """
+        self.collect('reset', [None] * self.count)
+        return self.observations
+
+    def step(self, actions: np.ndarray) -> tuple:
+        """ Step all environments with their actions and return observations, rewards, dones and infos
+        Observations of the environments that are done already belong to the next episode. """
+        rewards, dones, infos = self.collect('step', actions)
+        return self.observations, rewards, dones, infos
+
+    def close(self):
+        """ Close the environments, stop the workers and release the shared memory """
+        for index in range(self.count):
+            self.send(index, ('close', None))
+        for index in range(self.count):
+            self.processes[index].join(timeout=self.timeout)
+            if self.processes[index].is_alive():
+                self.kill(index)
+        self.observations = None
+        os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# region Unit Tests
+
+
+from ..simulator.replay import Replay
+from ..simulator.telemetry.replay import ReplayServer
+from .env import SimulatorEnv
+from .observation import Observation
+
+
+def replay_env(instance: int) -> SimulatorEnv:
+    """ Environment replaying a short synthetic drive with its own telemetry address """
+    simulator = Replay(ReplayServer.synthetic(20), instance=instance + 1)
+    return SimulatorEnv(simulator, map='indy500', policeman=False, observation=Observation(downsample=8))
+
+
+class FlakyEnv(gym.Env):
+    """ Environment with observations counting the steps that fails on every third step of the worker 1 """
+    observation_space = gym.spaces.Box(0, 255, shape=(4, 4, 1), dtype=np.uint8)
+    action_space = gym.spaces.Discrete(2)
+
+    def __init__(self, instance: int):
+        self.instance, self.steps = instance, 0
+
+    def reset(self) -> np.ndarray:
+        return np.zeros(self.observation_space.shape, dtype=np.uint8)
+
+    def step(self, action: int) -> tuple:
+        self.steps += 1
+        if self.instance == 1 and self.steps % 3 == 0:
+            raise RuntimeError("Simulator crashed")
+        return np.full(self.observation_space.shape, self.steps, dtype=np.uint8), 1.0, False, {}
+
+
+class StartupEnv(FlakyEnv):
+    """ Flaky environment that can't start on the worker 1 while the marker file exists, or takes its time if the
+    marker file says it's slow """
+    Marker = Path(tempfile.gettempdir()) / 'autodrome_test_vector_startup'
+    SlowStart = 2.0
+
+    def __init__(self, instance: int):
+        if instance == 1 and self.Marker.exists() and self.Marker.read_text() == 'slow':
+            time.sleep(self.SlowStart)
+        elif instance == 1 and self.Marker.exists():
+            raise RuntimeError("Simulator didn't start")
+        super().__init__(instance)
+
+
+class TestVecSimulatorEnv(unittest.TestCase):
+
+    def tearDown(self):
+        StartupEnv.Marker.unlink(missing_ok=True)
+
+    @staticmethod
+    def step(env: VecSimulatorEnv, until: callable) -> tuple:
+        """ Step the workers until the condition holds and return the result of the last step """
+        for step in range(500):
+            result = env.step([0] * env.count)
+            if until():
+                return result
+            time.sleep(0.01)
+        raise TimeoutError("Condition didn't hold in time")
+
+    def test_step(self):
+        with VecSimulatorEnv(replay_env, count=3) as env:
+            observations = env.reset()
+            self.assertEqual(observations.shape, (3, 75, 128, 3))
+            episodes = np.zeros(3, dtype=int)
+            for step in range(40):
+                observations, rewards, dones, infos = env.step(np.ones((3, 2), dtype=int))
+                episodes += dones
+            self.assertEqual(rewards.shape, (3,))
+            self.assertTrue(all('stale' in info for info in infos))
+            self.assertTrue(all(episodes >= 1))  # Episodes were reset on the fly
+            self.assertFalse(env.failures)
+
+    def test_failure(self):
+        with VecSimulatorEnv(FlakyEnv, count=2) as env:
+            env.reset()
+            for step in range(3):
+                observations, rewards, dones, infos = env.step([0, 0])
+            self.assertEqual(dones.tolist(), [False, True])
+            self.assertIn("Simulator crashed", infos[1]['failure'])
+            self.assertEqual(env.failures[1], 1)
+            observations, rewards, dones, infos = self.step(env, until=lambda: not env.dead)
+            self.assertEqual(observations[1, 0, 0, 0], 0)  # Restarted worker is reset
+            observations, rewards, dones, infos = env.step([0, 0])
+            self.assertEqual(observations[1, 0, 0, 0], 1)
+
+    def test_dead(self):
+        with VecSimulatorEnv(StartupEnv, count=2) as env:
+            env.RestartBackoff = 0.05
+            env.reset()
+            StartupEnv.Marker.touch()
+            observations, rewards, dones, infos = self.step(env, until=lambda: env.backoff[1] == 2)
+            self.assertEqual(dones.tolist(), [False, True])
+            self.assertIn("Restart failed", infos[1]['failure'])
+            self.assertEqual(list(env.dead), [1])
+            self.assertEqual(list(env.retries), [1])  # Tried again after the backoff
+            StartupEnv.Marker.unlink()
+            observations, rewards, dones, infos = self.step(env, until=lambda: not env.dead)
+            self.assertEqual(dones.tolist(), [False, False])
+            self.assertEqual(observations[1, 0, 0, 0], 0)  # Revived worker is reset
+            observations, rewards, dones, infos = env.step([0, 0])
+            self.assertEqual(observations[1, 0, 0, 0], 1)
+
+    def test_background(self):
+        with VecSimulatorEnv(StartupEnv, count=2) as env:
+            env.reset()
+            StartupEnv.Marker.write_text('slow')
+            env.processes[1].kill()
+            start = time.monotonic()
+            for step in range(10):
+                observations, rewards, dones, infos = env.step([0, 0])
+                self.assertTrue(dones[1])
+            self.assertLess(time.monotonic() - start, StartupEnv.SlowStart / 2)  # Nobody waits for the restart
+            self.assertEqual(observations[0, 0, 0, 0], 10)
+            observations, rewards, dones, infos = self.step(env, until=lambda: not env.dead)
+            self.assertEqual(observations[1, 0, 0, 0], 0)
+            self.assertEqual(env.failures[1], 1)
+
+    def test_startup_failure(self):
+        StartupEnv.Marker.touch()
+        with self.assertRaises(VecSimulatorEnv.Failed):
+            VecSimulatorEnv(StartupEnv, count=2)
+        self.assertEqual(multiprocessing.active_children(), [])  # Worker that did start is stopped
+
+
+# endregion
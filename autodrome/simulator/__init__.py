@@ -1,3 +1,4 @@
-from .simulator import Simulator
+from .simulator import Simulator, Pose
 from .ets2 import ETS2
 from .ats import ATS
+from .replay import Replay
@@ -3,5 +3,7 @@ import platform
 
 if platform.system() == 'Darwin':
     from .darwin import SteeringWheelDarwin as SteeringWheel, KeyboardDarwin as Keyboard
+elif platform.system() == 'Linux':
+    from .linux import SteeringWheelLinux as SteeringWheel, KeyboardLinux as Keyboard
 else:
     from .controller import SteeringWheel, Keyboard
@@ -0,0 +1,239 @@
+import os
+import time
+import glob
+import fcntl
+import random
+import struct
+import unittest
+
+from .controller import SteeringWheel, Keyboard
+
+
+class UInput:
+    """ Virtual input device created through the Linux uinput module
+    Events are packed as kernel input_event structs and written with a single system call per batch. """
+    Path = '/dev/uinput'
+    EventFormat = 'llHHi'  # struct input_event {struct timeval time; __u16 type; __u16 code; __s32 value;}
+    SetupFormat = '4H80sI'  # struct uinput_setup {struct input_id id; char name[80]; __u32 ff_effects_max;}
+    AbsSetupFormat = 'H2x6i'  # struct uinput_abs_setup {__u16 code; struct input_absinfo absinfo;}
+    BusVirtual = 0x06
+
+    UI_DEV_CREATE = 0x5501
+    UI_DEV_DESTROY = 0x5502
+    UI_DEV_SETUP = 0x405c5503
+    UI_ABS_SETUP = 0x401c5504
+    UI_SET_EVBIT = 0x40045564
+    UI_SET_KEYBIT = 0x40045565
+    UI_SET_ABSBIT = 0x40045567
+    UI_GET_SYSNAME = 0x8040552c  # With 64 byte buffer
+
+    EV_SYN, EV_KEY, EV_ABS = 0x00, 0x01, 0x03
+    SYN_REPORT = 0
+
+    def __init__(self, name: str, keys: tuple=(), axes: dict=None):
+        """ Create a device sending the keys and absolute axes given as {code: (minimum, maximum)} """
+        axes = {} if axes is None else axes
+        self.descriptor = os.open(self.Path, os.O_WRONLY | os.O_NONBLOCK)
+        if keys:
+            fcntl.ioctl(self.descriptor, self.UI_SET_EVBIT, self.EV_KEY)
+            for key in keys:
+                fcntl.ioctl(self.descriptor, self.UI_SET_KEYBIT, key)
+        if axes:
+            fcntl.ioctl(self.descriptor, self.UI_SET_EVBIT, self.EV_ABS)
+            for axis, (minimum, maximum) in axes.items():
+                fcntl.ioctl(self.descriptor, self.UI_SET_ABSBIT, axis)
+                fcntl.ioctl(self.descriptor, self.UI_ABS_SETUP,
+                            struct.pack(self.AbsSetupFormat, axis, minimum, minimum, maximum, 0, 0, 0))
+        setup = struct.pack(self.SetupFormat, self.BusVirtual, 0x1209, 0x0001, 1, name.encode()[:79], 0)
+        fcntl.ioctl(self.descriptor, self.UI_DEV_SETUP, setup)
+        fcntl.ioctl(self.descriptor, self.UI_DEV_CREATE)
+
+    @classmethod
+    def pack(cls, events: list) -> bytes:
+        """ Pack (type, code, value) events followed by a single SYN_REPORT """
+        events = list(events) + [(cls.EV_SYN, cls.SYN_REPORT, 0)]
+        return b''.join(struct.pack(cls.EventFormat, 0, 0, type, code, value) for type, code, value in events)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> list:
+        """ Unpack input_event structs into (type, code, value) events """
+        return [(type, code, value) for seconds, microseconds, type, code, value
+                in struct.iter_unpack(cls.EventFormat, data)]
+
+    def write(self, events: list):
+        """ Write the events as one report """
+        os.write(self.descriptor, self.pack(events))
+
+    def node(self) -> str:
+        """ Path of the event device node that receives the events, i.e. /dev/input/event7 """
+        sysname = fcntl.ioctl(self.descriptor, self.UI_GET_SYSNAME, bytes(64)).split(b'\0')[0].decode()
+        event = glob.glob(f'/sys/devices/virtual/input/{sysname}/event*')[0]
+        return '/dev/input/' + os.path.basename(event)
+
+    def close(self):
+        if self.descriptor is not None:
+            fcntl.ioctl(self.descriptor, self.UI_DEV_DESTROY)
+            os.close(self.descriptor)
+            self.descriptor = None
+
+    def __del__(self):
+        if getattr(self, 'descriptor', None) is not None:
+            self.close()
+
+
+class SteeringWheelLinux(SteeringWheel):
+    """ Virtual steering wheel implementation for Linux with uinput """
+    BTN_TRIGGER = 0x120  # Joystick button, udev classifies devices with axes and no buttons as something else
+    ABS_X, ABS_Y, ABS_Z, ABS_RX = 0x00, 0x01, 0x02, 0x03
+    RawRange = (0x0000, 0xffff)
+
+    def __init__(self, name="Tithonus Virtual Wheel", device: UInput=None):
+        self.name = name
+        self.steer = self.Axis(0.0, range=(-1, +1), raw_range=self.RawRange)
+        self.throttle = self.Axis(0.0, range=(0, 1), raw_range=self.RawRange)
+        self.brake = self.Axis(0.0, range=(0, 1), raw_range=self.RawRange)
+        self.clutch = self.Axis(0.0, range=(0, 1), raw_range=self.RawRange)
+        axes = {axis: self.RawRange for axis in (self.ABS_X, self.ABS_Y, self.ABS_Z, self.ABS_RX)}
+        self.device = UInput(name, keys=(self.BTN_TRIGGER,), axes=axes) if device is None else device
+
+    def send(self):
+        """ Send the current steer, throttle and brake values to the virtual controller in one report """
+        self.device.write([(UInput.EV_ABS, self.ABS_X, self.steer.raw),
+                           (UInput.EV_ABS, self.ABS_Y, self.throttle.raw),
+                           (UInput.EV_ABS, self.ABS_Z, self.brake.raw),
+                           (UInput.EV_ABS, self.ABS_RX, self.clutch.raw)])
+
+
+class KeyboardLinux(Keyboard):
+    """ Virtual keyboard implementation for Linux with uinput """
+    KeyMap = {  # https://github.com/torvalds/linux/blob/master/include/uapi/linux/input-event-codes.h
+        'esc': 1,  # KEY_ESC
+        '1': 2, '2': 3, '3': 4, '4': 5, '5': 6, '6': 7, '7': 8, '8': 9, '9': 10, '0': 11,  # KEY_1 .. KEY_0
+        '-': 12,  # KEY_MINUS
+        '=': 13,  # KEY_EQUAL
+        '\b': 14,  # KEY_BACKSPACE
+        '\t': 15,  # KEY_TAB
+        'q': 16, 'w': 17, 'e': 18, 'r': 19, 't': 20, 'y': 21, 'u': 22, 'i': 23, 'o': 24, 'p': 25,
+        '(': 26,  # KEY_LEFTBRACE
+        ')': 27,  # KEY_RIGHTBRACE
+        '\n': 28,  # KEY_ENTER
+        'a': 30, 's': 31, 'd': 32, 'f': 33, 'g': 34, 'h': 35, 'j': 36, 'k': 37, 'l': 38,
+        ';': 39,  # KEY_SEMICOLON
+        '\'': 40,  # KEY_APOSTROPHE
+        '`': 41,  # KEY_GRAVE
+        '~': 41,  # KEY_GRAVE
+        'shift': 42,  # KEY_LEFTSHIFT
+        '\\': 43,  # KEY_BACKSLASH
+        'z': 44, 'x': 45, 'c': 46, 'v': 47, 'b': 48, 'n': 49, 'm': 50,
+        ',': 51,  # KEY_COMMA
+        '.': 52,  # KEY_DOT
+        '/': 53,  # KEY_SLASH
+        '*': 55,  # KEY_KPASTERISK
+        ' ': 57,  # KEY_SPACE
+        'f1': 59, 'f2': 60, 'f3': 61, 'f4': 62, 'f5': 63, 'f6': 64, 'f7': 65, 'f8': 66, 'f9': 67, 'f10': 68,
+        '+': 78,  # KEY_KPPLUS
+        'f11': 87,  # KEY_F11
+        'f12': 88,  # KEY_F12
+        '↑': 103,  # KEY_UP
+        '←': 105,  # KEY_LEFT
+        '→': 106,  # KEY_RIGHT
+        '↓': 108,  # KEY_DOWN
+    }
+
+    def __init__(self, name="Tithonus Virtual Keyboard", device: UInput=None):
+        super().__init__()
+        self.pressed = set()
+        self.device = UInput(name, keys=sorted(set(self.KeyMap.values()))) if device is None else device
+
+    def type(self, string: str):
+        """ Type string on the virtual keyboard with all keystrokes written at once """
+        events = []
+        for key in string:
+            events += self.events(key, down=True) + self.events(key, down=False)
+        self.device.write(events)
+
+    def press(self, key: str):
+        """ Press a virtual keyboard key """
+        self.device.write(self.events(key, down=True))
+        self.pressed.add(key)
+
+    def release(self, key: str):
+        """ Release a virtual keyboard key """
+        self.device.write(self.events(key, down=False))
+        self.pressed.discard(key)
+
+    def afk(self):
+        """ Release all pressed keys """
+        self.device.write([event for key in self.pressed for event in self.events(key, down=False)])
+        self.pressed = set()
+
+    def events(self, key: str, down: bool) -> list:
+        """ Key events with shift around upper case keys """
+        try:
+            event = (UInput.EV_KEY, self.KeyMap[key.lower()], int(down))
+        except KeyError:
+            raise NotImplementedError(f"Key '{key}' is not implemented")
+        if not key.isupper():
+            return [event]
+        shift = (UInput.EV_KEY, self.KeyMap['shift'], int(down))
+        return [shift, event] if down else [event, shift]
+
+
+# region Unit Tests
+
+
+class TestVirtualControllersLinux(unittest.TestCase):
+
+    class DeviceFake:
+        """ Device that keeps the written reports instead of sending them to the kernel """
+        def __init__(self):
+            self.reports = []
+
+        def write(self, events: list):
+            self.reports.append(UInput.unpack(UInput.pack(events)))
+
+    def test_wheel(self):
+        device = self.DeviceFake()
+        wheel = SteeringWheelLinux(device=device)
+        wheel.steer.value, wheel.throttle.value, wheel.brake.value = -1.0, 0.5, 0.0
+        wheel.send()
+        self.assertEqual(device.reports, [[(UInput.EV_ABS, SteeringWheelLinux.ABS_X, 0x0000),
+                                           (UInput.EV_ABS, SteeringWheelLinux.ABS_Y, 0x8000),
+                                           (UInput.EV_ABS, SteeringWheelLinux.ABS_Z, 0x0000),
+                                           (UInput.EV_ABS, SteeringWheelLinux.ABS_RX, 0x0000),
+                                           (UInput.EV_SYN, UInput.SYN_REPORT, 0)]])
+
+    def test_keyboard(self):
+        device = self.DeviceFake()
+        keyboard = KeyboardLinux(device=device)
+        keyboard.type('Hasta la vista, baby')
+        self.assertEqual(len(device.reports), 1)
+        self.assertEqual(device.reports[0][:4], [(UInput.EV_KEY, 42, 1), (UInput.EV_KEY, 35, 1),
+                                                 (UInput.EV_KEY, 35, 0), (UInput.EV_KEY, 42, 0)])
+        self.assertEqual(device.reports[0][-1], (UInput.EV_SYN, UInput.SYN_REPORT, 0))
+        keyboard.press('↑')
+        keyboard.press('←')
+        keyboard.afk()
+        self.assertEqual(sorted(device.reports[-1][:-1]), [(UInput.EV_KEY, 103, 0), (UInput.EV_KEY, 105, 0)])
+        with self.assertRaises(NotImplementedError):
+            keyboard.press('€')
+
+    @unittest.skipUnless(os.access(UInput.Path, os.W_OK), "Needs write access to /dev/uinput")
+    def test_loopback(self):
+        wheel = SteeringWheelLinux()
+        time.sleep(0.5)  # Let udev create the event device node
+        reader = os.open(wheel.device.node(), os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            wheel.steer.value, wheel.throttle.value = random.uniform(-1, +1), 1.0
+            wheel.send()
+            time.sleep(0.1)
+            events = UInput.unpack(os.read(reader, 64 * struct.calcsize(UInput.EventFormat)))
+        finally:
+            os.close(reader)
+            wheel.device.close()
+        self.assertIn((UInput.EV_ABS, SteeringWheelLinux.ABS_X, wheel.steer.raw), events)
+        self.assertIn((UInput.EV_ABS, SteeringWheelLinux.ABS_Y, 0xffff), events)
+        self.assertEqual(events[-1], (UInput.EV_SYN, UInput.SYN_REPORT, 0))
+
+
+# endregion
@@ -0,0 +1,247 @@
+import math
+import time
+import asyncio
+import timeit
+import unittest
+import numpy as np
+from pathlib import Path
+
+from .simulator import Simulator, Pose
+from .window.window import Window
+from .controller.controller import Keyboard, SteeringWheel
+from .telemetry import Telemetry
+from .telemetry.aio import AsyncTelemetry
+from .telemetry.replay import ReplayServer
+
+
+class WindowReplay(Window):
+    """ Headless window that captures the same blank frame, without copying unless there's an out array """
+    ZeroCopy = True
+
+    def __init__(self, width: int, height: int):
+        super().__init__(pid=None, timeout=0)
+        self.shape = (height, width, 3)
+        self.activations = 0
+        self.pixels = np.zeros(self.shape, dtype=self.Dtype)
+
+    def activate(self):
+        self.activations += 1
+
+    def focused(self) -> bool:
+        return self.activations > 0
+
+    def capture(self, out: np.ndarray=None) -> np.array:
+        if out is None:
+            return self.pixels
+        np.copyto(out, self.pixels)
+        return out
+
+
+class KeyboardReplay(Keyboard):
+    """ Headless keyboard that only remembers which keys are pressed, the console key opens and closes the console of
+    the replay server """
+    def __init__(self, server: ReplayServer=None):
+        self.server = server
+        self.pressed = set()
+
+    def press(self, key: str):
+        if key == '`' and self.server is not None and self.server.pausing.is_set():
+            self.server.resume()
+        elif key == '`' and self.server is not None:
+            self.server.pause()
+        self.pressed.add(key)
+
+    def release(self, key: str):
+        self.pressed.discard(key)
+
+    def afk(self):
+        self.pressed.clear()
+
+
+class SteeringWheelReplay(SteeringWheel):
+    """ Headless steering wheel that only counts the sent reports """
+    def __init__(self):
+        self.steer = self.Axis(0.0, range=(-1, +1))
+        self.throttle = self.Axis(0.0, range=(0, +1))
+        self.brake = self.Axis(0.0, range=(0, +1))
+        self.clutch = self.Axis(0.0, range=(0, +1))
+        self.sent = 0
+
+    def send(self):
+        self.sent += 1
+
+
+class Replay(Simulator):
+    """ Headless stand-in simulator replaying recorded or synthetic telemetry without ETS2/ATS installed
+    The 'preview' console command restarts the replay like a map reload and 'goto' rewinds it like a teleport to the
+    first frame. Commands leave the console open and the replay paused until the console key is typed. """
+    MapsFolder = Path(__file__).parent / '../maps/ets2/'
+    Retries = 0  # Blank frames are always duplicates
+
+    def __init__(self, frames: np.ndarray=None, pacing: str='fast', rate: float=60.0, transport: type=Telemetry,
+                 threaded: bool=True, instance: int=0):
+        super().__init__(transport, threaded, instance)
+        self.frames = ReplayServer.synthetic(1000, rate=rate) if frames is None else frames
+        self.pacing, self.rate = pacing, rate
+        self.mod_dir = self.MapsFolder
+        self.server = None
+
+    def launch(self):
+        """ Start the replay server in place of the simulator process """
+        self.server = ReplayServer(self.frames, address=self.address, pacing=self.pacing, rate=self.rate)
+        self.server.start()
+        self.window = WindowReplay(int(self.Config['r_mode_width']), int(self.Config['r_mode_height']))
+        self.keyboard = KeyboardReplay(self.server)
+        if self.analog:
+            self.wheel = SteeringWheelReplay()
+
+    def command(self, *commands: str):
+        commands = self.console(commands)
+        if commands:
+            self.server.pause()
+        for command in commands:
+            if command.startswith('preview'):
+                self.server.restart()
+            if command.startswith('goto'):
+                self.server.rewind()
+
+    async def command_async(self, *commands: str):
+        self.command(*commands)
+
+    def terminate(self):
+        """ Stop the replay server """
+        self.stop_capture()
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
+        self.keyboard = None
+        self.wheel, self.wheel_raw = None, None
+        self.held, self.paused = set(), True
+        self.window = None
+        self.buffer, self.scratch = None, None
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+
+# region Unit Tests
+
+
+class SilentReplay(Replay):
+    """ Replay of a game that starts without loading the telemetry plugin """
+    def launch(self):
+        super().launch()
+        self.server.stop()
+
+
+class TestReplay(unittest.TestCase):
+    RepeatFPS = 1000
+    MinimumFPS = 500
+
+    def test_frame(self):
+        with Replay(ReplayServer.synthetic(2 * self.RepeatFPS)) as replay:
+            replay.command('preview indy500')
+            data = replay.wait()
+            seconds = timeit.timeit(lambda: replay.frame(data), number=self.RepeatFPS)
+        self.assertGreater(self.RepeatFPS / seconds, self.MinimumFPS)
+
+    def test_restart(self):
+        with Replay(ReplayServer.synthetic(20)) as replay:
+            replay.command('preview indy500')
+            data = replay.wait()
+            pixels, data = replay.frame(data)
+            self.assertEqual(pixels.shape, (600, 1024, 3))
+            replay.enqueue('g_set_time 12')
+            replay.command('preview indy500')
+            self.assertGreater(replay.wait().renderTime, data.renderTime)
+            self.assertEqual(replay.queued, [])
+
+    def test_command(self):
+        with Replay(ReplayServer.synthetic(1000, rate=100), pacing='fixed', rate=100) as replay:
+            replay.command('preview indy500')
+            data = replay.wait()
+            start = time.monotonic()
+            Simulator.command(replay, 'g_set_time 12', 'g_traffic 0', 'g_weather 0')  # Typed into the paused replay
+            seconds = time.monotonic() - start
+            self.assertIsNone(replay.rendered(data.renderTime + 20_000, timeout=0.2))  # Nothing while it's open
+            replay.keyboard.type('`')
+            self.assertIsNotNone(replay.rendered(data.renderTime, timeout=Replay.ConsoleTimeout))
+        self.assertLess(seconds, Replay.ConsoleTimeout)
+        self.assertEqual(replay.metrics['commands'], 3)
+
+    def test_teleport(self):
+        with Replay(ReplayServer.synthetic(5)) as replay:
+            replay.command('preview indy500')
+            data = replay.wait()
+            start = time.monotonic()
+            self.assertIsNone(replay.teleport(Pose(1000.0, 0.0, 0.0), data))  # Replay pauses before getting there
+            self.assertLess(time.monotonic() - start, 2 * Replay.ConsoleTimeout)
+            self.assertEqual(replay.metrics['teleport_failures'], 1)
+
+    def test_stale(self):
+        for threaded in (True, False):
+            with Replay(ReplayServer.synthetic(20), threaded=threaded) as replay:
+                replay.command('preview indy500')
+                data = replay.wait()
+                pixels, new_data = replay.frame(data)
+                self.assertGreater(new_data.renderTime, data.renderTime)
+                pixels, data = replay.frame(new_data)
+                self.assertTrue(replay.stale)
+                self.assertEqual(replay.metrics['duplicates'], replay.metrics['stale'])
+                self.assertEqual(replay.metrics['retries'], 0)
+
+    def test_startup(self):
+        with Replay() as replay:
+            self.assertNotIn('frame', replay.startup)  # Main menu doesn't render frames
+            replay.reload('indy500')
+            replay.reload('indy500')
+            startup, telemetry = replay.startup, replay.telemetry
+        self.assertTrue(telemetry.socket.closed)
+        self.assertEqual(startup['attempts'], 1)
+        phases = [startup[phase] for phase in ('window', 'plugin', 'dialog', 'frame')]
+        self.assertEqual(phases, sorted(phases))
+        self.assertLess(startup['frame'], 1.0)  # Time to the first frame, not to the last reload
+
+    def test_startup_async(self):
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def start():
+            ticker = asyncio.ensure_future(tick())
+            async with Replay(transport=AsyncTelemetry) as replay:
+                startup = replay.startup
+            ticker.cancel()
+            return startup
+
+        startup = asyncio.run(start())
+        self.assertEqual(startup['attempts'], 1)
+        self.assertGreater(len(ticks), 1)  # Other coroutines kept running during the startup
+
+    def test_startup_timeout(self):
+        replay = SilentReplay()
+        replay.PluginTimeout = 0.2
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            replay.start()
+        self.assertLess(time.monotonic() - start, 2.0)
+        self.assertEqual(replay.metrics['startup_failures'], Replay.StartupAttempts)
+        self.assertIsNone(replay.server)
+
+    def test_instances(self):
+        with Replay(ReplayServer.synthetic(20, radius=100)) as first, \
+                Replay(ReplayServer.synthetic(20, radius=50), instance=1) as second:
+            self.assertNotEqual(first.address, second.address)
+            self.assertNotEqual(first.broker, second.broker)
+            self.assertNotEqual(first.user_dir, second.user_dir)
+            first.command('preview indy500')
+            second.command('preview indy500')
+            positions = [replay.wait().worldPlacement.position for replay in (first, second)]
+        radiuses = [round(math.hypot(position.x, position.z)) for position in positions]
+        self.assertEqual(radiuses, [100, 50])  # Each client talks to its own server
+
+
+# endregion
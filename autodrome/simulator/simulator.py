@@ -1,13 +1,31 @@
+import os
 import abc
+import math
 import time
 import shutil
+import asyncio
+import contextlib
 import subprocess
+import collections
+import numpy as np
 from pathlib import Path
-import distutils.dir_util as dstdir
 
 from .window import Window
-from .controller import Keyboard
+from .window.capture import WindowCapture, checksum
+from .controller import Keyboard, SteeringWheel
 from .telemetry import Telemetry
+from .sync import sync, place, write
+
+
+Pose = collections.namedtuple('Pose', ['x', 'y', 'z'])  # World position like in telemetry, goto keeps the heading
+
+
+def instanced(location: str, instance: int) -> str:
+    """ Socket address or file path of the instance, i.e. ipc:///tmp/autodrome_telemetry_2.ipc for instance 2 """
+    if instance == 0:
+        return location
+    root, extension = os.path.splitext(location)
+    return f'{root}_{instance}{extension}'
 
 
 class Simulator(abc.ABC):
@@ -20,55 +38,259 @@ class Simulator(abc.ABC):
     MapsFolder = Path()
     Config = {'g_developer': '1', 'g_console': '1',
               'r_fullscreen': '0', 'r_mode_width': '1024', 'r_mode_height': '600'}
+    Retries = 3  # Captures of a duplicate frame before it's flagged as stale
+    ConsoleTimeout = 0.5  # Longest wait for the game to pause once the console opens or to render a frame after
+    CaptureTimeout = 1.0
+    TeleportCommands = ('goto {x:.3f};{y:.3f};{z:.3f}', 'repair')  # Formatted with the pose fields, per game
+    TeleportFrames = 60  # Rendered frames to wait for the truck to show up at the pose
+    TeleportTolerance = 2.0  # Horizontal distance from the pose in meters
+    StartupAttempts = 2  # Launches of the game before giving up
+    WindowTimeout = 30.0  # Seconds for the window to show up and get focus
+    PluginTimeout = 60.0  # Seconds for the telemetry plugin to load
+    DialogTimeout = 30.0  # Seconds to get past the Telemetry SDK dialog to the truck config events
+    DialogInterval = 2.0  # Seconds between presses of enter to dismiss the dialog
 
-    def __init__(self):
+    def __init__(self, transport: type=Telemetry, threaded: bool=True, instance: int=0):
+        """ Instances other than 0 run with their own home folder, user folder, telemetry address or memory path and
+        broker address so that several of them fit on one host, the home folder of instance 0 is the default one of
+        the game. A TelemetryBroker of the instance binds TelemetryBroker(self.broker, plugin=self.address). """
+        self.transport = transport
+        self.threaded = threaded
+        self.instance = instance
+        self.address = instanced(Telemetry.Message.Bind.address, instance)
+        self.memory = instanced(Telemetry.Message.Bind.memory, instance)
+        self.broker = instanced(Telemetry.Message.Bind.broker, instance)
+        self.home_dir = None if instance == 0 else self.UserGameFolder.parent / f'autodrome-{instance}'
+        self.user_dir = self.UserGameFolder if instance == 0 else self.home_dir / self.UserGameFolder.name
         self.steam1_file = Path.cwd() / 'steam_appid.txt'
         self.steam2_file = self.GameExecutable.parent / 'steam_appid.txt'
-        self.config_file = self.UserGameFolder / 'config.cfg'
-        self.mod_dir = self.UserGameFolder / 'mod' / 'autodrome'
+        self.config_file = self.user_dir / 'config.cfg'
+        self.mod_dir = self.user_dir / 'mod' / 'autodrome'
 
         self.process = None
         self.window = None
+        self.capture = None
+        self.observation = None  # Preprocessing of captured pixels, i.e. autodrome.envs.Observation
+        self.metrics = collections.Counter()  # Frames, duplicates, retries, stale frames and control timings
+        self.checksum, self.stale = None, False
+        self.buffer, self.scratch = None, None  # Allocated once for captures on the caller's thread
         self.keyboard = None
+        self.wheel = None
+        self.analog = False  # Virtual steering wheel is created on launch to drive with analog controls
+        self.wheel_raw = None
+        self.held = set()  # Arrow keys currently held down by control()
+        self.queued = []  # Console commands typed in the next console session
+        self.paused = True  # Game is in a menu or the console and doesn't render frames, it starts in the main menu
+        self.startup = {}  # Seconds from the launch to the window, plugin, dialog and frame phases and the attempts
+        self.launched = None  # Start of the launch, the first frame is only rendered once a map loads
         self.telemetry = None
 
     def start(self):
-        """ Setup, start the simulator process and connect telemetry plugin """
-        self.setup_plugin(self.TelemetryPlugin)
-        self.setup_maps(self.mod_dir, self.MapsFolder)
-        self.setup_config(self.config_file, self.Config)
-        self.setup_steam(self.steam1_file)
-        self.setup_steam(self.steam2_file)
+        """ Setup, start the simulator process and connect telemetry plugin
+        The game is launched again if any startup phase fails or doesn't finish before its deadline. """
+        for attempt in range(1, self.StartupAttempts + 1):
+            start = self.launched = time.perf_counter()
+            self.startup = {'attempts': attempt}
+            try:
+                self.launch()
+                self.telemetry = self.connect()
+                self.probe_window(start)
+                self.probe(start)
+                break
+            except Exception as error:
+                self.metrics['startup_failures'] += 1
+                self.terminate()
+                if attempt == self.StartupAttempts:
+                    raise
+                print(f"Startup attempt {attempt} failed, launching again: {error}")
+        self.start_capture()
 
-        game_command = [str(self.GameExecutable), '-nointro', '-force_mods', '-noworkshop', '-window_pos', '0', '0']
-        self.process = subprocess.Popen(game_command)
-        self.window = Window(pid=self.process.pid, timeout=5)
-        self.window.activate()
-        time.sleep(2)  # ETS2/ATS is sometimes slow to activate
+    async def start_async(self):
+        """ Setup, start the simulator process and connect telemetry plugin without blocking the event loop
+        File setup and the process launch run in the default executor, waits are awaited on the loop. """
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.StartupAttempts + 1):
+            start = self.launched = time.perf_counter()
+            self.startup = {'attempts': attempt}
+            try:
+                await loop.run_in_executor(None, self.launch)
+                self.telemetry = self.connect()
+                await self.probe_window_async(start)
+                await self.probe_async(start)
+                break
+            except Exception as error:
+                self.metrics['startup_failures'] += 1
+                self.terminate()
+                if attempt == self.StartupAttempts:
+                    raise
+                print(f"Startup attempt {attempt} failed, launching again: {error}")
+        self.start_capture()
+
+    def probe_window(self, start: float):
+        """ Wait for the window of the process to show up and get focus """
+        with self.timed('window'):
+            deadline = time.monotonic() + self.WindowTimeout
+            if self.window is None:
+                self.window = Window(pid=self.process.pid, timeout=self.WindowTimeout)
+            self.window.activate()
+            while not self.window.focused():
+                if time.monotonic() > deadline:
+                    raise TimeoutError("Simulator window didn't get focus in time")
+                time.sleep(0.1)
+                self.window.activate()
+        self.startup['window'] = time.perf_counter() - start
+
+    async def probe_window_async(self, start: float):
+        """ Wait for the window of the process to show up and get focus without blocking the event loop """
+        with self.timed('window'):
+            deadline = time.monotonic() + self.WindowTimeout
+            if self.window is None:
+                self.window = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: Window(pid=self.process.pid, timeout=self.WindowTimeout))
+            self.window.activate()
+            while not self.window.focused():
+                if time.monotonic() > deadline:
+                    raise TimeoutError("Simulator window didn't get focus in time")
+                await asyncio.sleep(0.1)
+                self.window.activate()
+        self.startup['window'] = time.perf_counter() - start
+
+    def probe(self, start: float):
+        """ Wait for the telemetry plugin to load and the Telemetry SDK dialog to go away
+        Lifecycle events are only waited for in lockstep mode, streamed events published before subscription are lost.
+        Enter is pressed again every DialogInterval until the truck config events show up. The game stays in the main
+        menu without rendering frames until the first map loads, so the first frame is waited for by wait(). """
+        lockstep = self.transport.Mode == Telemetry.Mode
+        with self.timed('plugin'):
+            if lockstep and self.telemetry.wait(Telemetry.Event.load, timeout=self.PluginTimeout) is None:
+                raise TimeoutError("Telemetry plugin didn't load in time")
+        self.startup['plugin'] = time.perf_counter() - start
+        with self.timed('dialog'):
+            configs, deadline = 0, time.monotonic() + self.DialogTimeout
+            self.keyboard.enter()  # Get rid of pesky Telemetry SDK warning
+            while lockstep and configs < 5:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Simulator didn't get past the Telemetry SDK dialog in time")
+                if self.telemetry.wait(Telemetry.Event.config, timeout=min(self.DialogInterval, remaining)) is None:
+                    self.keyboard.enter()
+                else:
+                    configs += 1
+        self.startup['dialog'] = time.perf_counter() - start
+
+    async def probe_async(self, start: float):
+        """ Wait for the plugin and the dialog without blocking the event loop """
+        with self.timed('plugin'):
+            if await self.telemetry.wait(Telemetry.Event.load, timeout=self.PluginTimeout) is None:
+                raise TimeoutError("Telemetry plugin didn't load in time")
+        self.startup['plugin'] = time.perf_counter() - start
+        with self.timed('dialog'):
+            configs, deadline = 0, time.monotonic() + self.DialogTimeout
+            self.keyboard.enter()
+            while configs < 5:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Simulator didn't get past the Telemetry SDK dialog in time")
+                if await self.telemetry.wait(Telemetry.Event.config, timeout=min(self.DialogInterval, remaining)) \
+                        is None:
+                    self.keyboard.enter()
+                else:
+                    configs += 1
+        self.startup['dialog'] = time.perf_counter() - start
+
+    def connect(self) -> Telemetry:
+        """ Connect the telemetry transport to the plugin of this instance """
+        if self.transport.Mode == Telemetry.Message.Mode.memory:
+            return self.transport(self.memory)
+        return self.transport(self.address)
+
+    @contextlib.contextmanager
+    def timed(self, step: str):
+        """ Add the time spent in the block to the startup_<step>_seconds metric """
+        start = time.perf_counter()
+        yield
+        self.metrics[f'startup_{step}_seconds'] += time.perf_counter() - start
+
+    def launch(self):
+        """ Setup and start the simulator process and create the virtual controllers """
+        if self.home_dir is not None:
+            with self.timed('home'):
+                self.setup_home(self.user_dir, self.UserGameFolder)
+        with self.timed('plugin'):
+            self.setup_plugin(self.TelemetryPlugin)
+        with self.timed('maps'):
+            self.setup_maps(self.mod_dir, self.MapsFolder)
+        with self.timed('config'):
+            self.setup_config(self.config_file, self.Config)
+            self.setup_steam(self.steam1_file)
+            self.setup_steam(self.steam2_file)
+
+        with self.timed('process'):
+            self.spawn()
         self.keyboard = Keyboard()
-        self.keyboard.enter()  # Get rid of pesky Telemetry SDK warning
-        self.telemetry = Telemetry()
-        for truck_config_event in range(5):
-            self.telemetry.wait(Telemetry.Event.config)
+        if self.analog:
+            self.wheel = SteeringWheel()
+
+    def spawn(self):
+        """ Start the simulator process, its window is found once it shows up """
+        game_command = [str(self.GameExecutable), '-nointro', '-force_mods', '-noworkshop', '-window_pos', '0', '0']
+        if self.home_dir is not None:
+            game_command += ['-homedir', str(self.home_dir)]
+        game_environment = dict(os.environ, **{Telemetry.Message.Bind.mode: self.transport.Mode,
+                                               Telemetry.Message.Bind.addressVariable: self.address,
+                                               Telemetry.Message.Bind.memoryVariable: self.memory})
+        self.process = subprocess.Popen(game_command, env=game_environment)
+
+    def start_capture(self):
+        """ Start capturing the window in a background thread if the simulator is threaded """
+        if self.threaded:
+            self.capture = WindowCapture(self.window, observation=self.observation)
+            self.capture.start()
+
+    def stop_capture(self):
+        """ Stop the background capture thread if it's running """
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
 
     def __enter__(self):
         self.start()
         return self
 
+    async def __aenter__(self):
+        await self.start_async()
+        return self
+
+    @classmethod
+    def setup_home(cls, user_dir: Path, default_dir: Path):
+        """ Seed the user folder of an instance with the profiles and config of the default user folder """
+        print(f"Setting up instance user folder in '{user_dir}'...")
+        user_dir.mkdir(parents=True, exist_ok=True)
+        if not (user_dir / 'profiles').exists() and (default_dir / 'profiles').exists():
+            shutil.copytree(default_dir / 'profiles', user_dir / 'profiles')
+        if not (user_dir / 'config.cfg').exists() and (default_dir / 'config.cfg').exists():
+            shutil.copy(default_dir / 'config.cfg', user_dir / 'config.cfg')
+
     @classmethod
     def setup_maps(cls, mod_dir: Path, local_dir: Path):
-        """ Copy local mod with custom map into the ETS2/ATS mod folder """
+        """ Sync local mod with custom map into the ETS2/ATS mod folder, only changed files are copied """
         print(f"Setting up mod with map in '{mod_dir}'...")
         mod_dir.mkdir(parents=True, exist_ok=True)
-        dstdir.copy_tree(str(local_dir), str(mod_dir))
+        counts = sync(local_dir, mod_dir)
+        print(f"Synced {sum(counts[kind] for kind in ('reflink', 'link', 'copy'))} changed files "
+              f"({counts['bytes']} bytes), {counts['unchanged']} unchanged, {counts['removed']} removed")
 
     @classmethod
     def setup_plugin(cls, telemetry_lib: Path):
-        """ Copy Telemetry SDK library into ETS2/ATS telemetry folder """
+        """ Copy Telemetry SDK library into ETS2/ATS telemetry folder unless it's already there """
         destination_dir = cls.GameExecutable.parent / 'plugins'
         print(f"Setting up telemetry plugin in '{destination_dir}'...")
         destination_dir.mkdir(exist_ok=True)
-        shutil.copy(telemetry_lib, destination_dir)
+        destination = destination_dir / telemetry_lib.name
+        source_stat = telemetry_lib.stat()
+        if not destination.exists() or (destination.stat().st_size, destination.stat().st_mtime_ns) != \
+                (source_stat.st_size, source_stat.st_mtime_ns):
+            place(telemetry_lib, destination)
 
     @classmethod
     def setup_config(cls, config_file: Path, override: dict):
@@ -90,7 +312,7 @@ class Simulator(abc.ABC):
         for key, value in override.items():
             new_lines.append(f'uset {key} "{value}"')
 
-        config_file.write_text('\n'.join(new_lines))
+        write(config_file, '\n'.join(new_lines))
 
     @classmethod
     def setup_steam(cls, steam_file: Path) -> None:
@@ -101,52 +323,219 @@ class Simulator(abc.ABC):
 
         Details: https://partner.steamgames.com/doc/api/steam_api#SteamAPI_RestartAppIfNecessary """
         print(f"Setting up Steam ID in '{steam_file}'")
-        steam_file.write_text(str(cls.SteamAppID))
+        write(steam_file, str(cls.SteamAppID))
 
     def control(self, steer: int, acceleration: int):
-        """ Issue steering and throttle/brake commands """
-        self.window.activate()
-        if steer == 0:
-            self.keyboard.release('→')
-            self.keyboard.release('←')
-        if steer > 0:
-            self.keyboard.press('←')
-        if steer < 0:
-            self.keyboard.press('→')
-        if acceleration == 0:
-            self.keyboard.release('↑')
-            self.keyboard.release('↓')
-        if acceleration > 0:
-            self.keyboard.press('↑')
-        if acceleration < 0:
-            self.keyboard.press('↓')
+        """ Issue steering and throttle/brake commands by pressing and releasing only the keys that changed
+        Focus is checked on every call. If the window lost focus, it's activated again and the game is assumed to
+        have forgotten all held keys, so they're pressed again. """
+        start = time.perf_counter()
+        keys = {'←'} if steer > 0 else {'→'} if steer < 0 else set()
+        keys |= {'↑'} if acceleration > 0 else {'↓'} if acceleration < 0 else set()
+        if not self.window.focused():
+            self.window.activate()
+            self.metrics['activations'] += 1
+            self.held = set()
+        if keys != self.held:
+            for key in self.held - keys:
+                self.keyboard.release(key)
+            for key in keys - self.held:
+                self.keyboard.press(key)
+            self.metrics['transitions'] += len(self.held ^ keys)
+            self.held = keys
+        self.metrics['controls'] += 1
+        self.metrics['control_seconds'] += time.perf_counter() - start
+
+    def drive(self, steer: float, throttle: float, brake: float):
+        """ Move the virtual steering wheel axes and send them only if their raw values changed
+        Steering is positive to the left like in control(). """
+        self.wheel.steer.value = -steer
+        self.wheel.throttle.value = throttle
+        self.wheel.brake.value = brake
+        start = time.perf_counter()
+        raw = (self.wheel.steer.raw, self.wheel.throttle.raw, self.wheel.brake.raw)
+        if raw != self.wheel_raw:
+            self.wheel.send()
+            self.wheel_raw = raw
+            self.metrics['transitions'] += 1
+        self.metrics['controls'] += 1
+        self.metrics['control_seconds'] += time.perf_counter() - start
 
     def frame(self, old_data: Telemetry.Data) -> tuple:
         """ Wait for next frame to be rendered and return it with telemetry data """
         new_data = self.telemetry.data()
-        while new_data.renderTime < old_data.renderTime:
+        while new_data.renderTime <= old_data.renderTime:
             new_data = self.telemetry.data()
-        pixels = self.window.capture()
-        return pixels, new_data
+        return self.pixels(new_data), new_data
+
+    async def frame_async(self, old_data: Telemetry.Data) -> tuple:
+        """ Wait for next frame to be rendered without blocking the event loop and return it with telemetry data """
+        new_data = await self.telemetry.data()
+        while new_data.renderTime <= old_data.renderTime:
+            new_data = await self.telemetry.data()
+        return self.pixels(new_data), new_data
+
+    def pixels(self, data: Telemetry.Data) -> np.array:
+        """ Frame captured no earlier than the telemetry data was rendered, by the capture thread if it's threaded
+        Frames with the same sampled checksum as the previous one are captured again a few times and then flagged as
+        stale. Buffer of the frame stays untouched until the next call. """
+        since = -math.inf
+        for attempt in range(self.Retries + 1):
+            if self.capture is None:
+                pixels = self.grab()
+                frame_checksum = checksum(pixels)
+            else:
+                self.capture.request(data.renderTime)
+                frame = self.capture.latest(render_time=data.renderTime, since=since, timeout=self.CaptureTimeout)
+                if frame is None:
+                    raise TimeoutError("Window capture didn't finish in time")
+                pixels, frame_checksum, since = frame.pixels, frame.checksum, frame.timestamp
+            self.metrics['frames'] += 1
+            duplicate = frame_checksum == self.checksum
+            if not duplicate:
+                break
+            self.metrics['duplicates'] += 1
+            self.metrics['retries'] += attempt < self.Retries
+        self.metrics['stale'] += duplicate
+        self.checksum, self.stale = frame_checksum, duplicate
+        return pixels
 
-    def command(self, command: str) -> Telemetry.Data:
-        """ Type command into the game developer console
+    def grab(self) -> np.array:
+        """ Capture the window on this thread into the buffer allocated on the first call, through the observation
+        preprocessing if there's one. Only the observation reads pixels in place if the window captures without copying,
+        raw pixels are always copied out so they aren't overwritten by the next capture. """
+        if self.buffer is None:
+            self.buffer = self.window.empty() if self.observation is None else self.observation.empty(self.window.shape)
+            self.scratch = None if self.observation is None or self.window.ZeroCopy else self.window.empty()
+        if self.observation is None:
+            return self.window.capture(out=self.buffer)
+        return self.observation(self.window.capture(out=self.scratch), out=self.buffer)
+
+    def enqueue(self, command: str):
+        """ Queue a console command to be typed in the next console session """
+        self.queued.append(command)
+
+    def console(self, commands: tuple) -> list:
+        """ Take the queued commands followed by the commands and get the keyboard and the window ready to type """
+        commands, self.queued = self.queued + list(commands), []
+        if commands:
+            self.keyboard.afk()
+            self.held = set()
+            if not self.window.focused():
+                self.window.activate()
+        return commands
+
+    def command(self, *commands: str):
+        """ Type queued commands and the commands into the game developer console in one session
+        Opening the console pauses the game, which is acknowledged by the pause event unless the game is paused
+        already. No frames are rendered while the console is open, so the commands are typed without waiting for any.
+        ConsoleTimeout only bounds the wait in case the game doesn't respond.
         List of Commands: http://modding.scssoft.com/wiki/Documentation/Engine/Console/Commands """
-        self.keyboard.afk()
-        self.window.activate()
+        start = time.perf_counter()
+        commands = self.console(commands)
+        if not commands:
+            return
+        self.telemetry.wait(None, timeout=0)  # Skip messages from before the console opens
+        self.keyboard.type('`')
+        if not self.paused:
+            self.telemetry.wait(Telemetry.Event.pause, timeout=self.ConsoleTimeout)
+            self.paused = True
+        for command in commands:
+            self.keyboard.type(command + '\n')
+        self.metrics['commands'] += len(commands)
+        self.metrics['command_seconds'] += time.perf_counter() - start
+
+    async def command_async(self, *commands: str):
+        """ Type queued commands and the commands into the game developer console without blocking the event loop """
+        start = time.perf_counter()
+        commands = self.console(commands)
+        if not commands:
+            return
+        await self.telemetry.wait(None, timeout=0)
         self.keyboard.type('`')
-        self.telemetry.wait(None, timeout=0.25)
-        self.keyboard.type(command)
-        self.keyboard.press('\n')
-        self.telemetry.wait(None, timeout=0.35)
-        self.keyboard.release('\n')
+        if not self.paused:
+            await self.telemetry.wait(Telemetry.Event.pause, timeout=self.ConsoleTimeout)
+            self.paused = True
+        for command in commands:
+            self.keyboard.type(command + '\n')
+        self.metrics['commands'] += len(commands)
+        self.metrics['command_seconds'] += time.perf_counter() - start
+
+    def rendered(self, render_time: int, timeout: float) -> Telemetry.Data:
+        """ Wait for a frame rendered after the renderTime and return its telemetry data or None after the timeout
+        Frames buffered or counted before are skipped. """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            reply = None if remaining <= 0 else self.telemetry.wait(Telemetry.Event.frameEnd, timeout=remaining)
+            if reply is None:
+                return None
+            data = self.telemetry.frames(reply)[-1]
+            if data.renderTime > render_time:
+                return data
+
+    async def rendered_async(self, render_time: int, timeout: float) -> Telemetry.Data:
+        """ Wait for a frame rendered after the renderTime without blocking the event loop """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            reply = None if remaining <= 0 else await self.telemetry.wait(Telemetry.Event.frameEnd, timeout=remaining)
+            if reply is None:
+                return None
+            data = self.telemetry.frames(reply)[-1]
+            if data.renderTime > render_time:
+                return data
+
+    def reload(self, map: str) -> Telemetry.Data:
+        """ Reload the map from scratch and wait until the game starts sending telemetry data again """
+        start = time.perf_counter()
+        self.command(f'preview {map}')
+        data = self.wait()
+        self.metrics['reloads'] += 1
+        self.metrics['reload_seconds'] += time.perf_counter() - start
+        return data
+
+    def teleport(self, pose: Pose, data: Telemetry.Data) -> Telemetry.Data:
+        """ Move the truck to the pose without reloading the map and wait for telemetry to confirm it
+        Returns None if the truck isn't at the pose without any wear within TeleportFrames rendered frames or the game
+        doesn't render a frame within ConsoleTimeout, then only a reload gets the episode back to a clean state. """
+        start = time.perf_counter()
+        self.command(*(command.format(**pose._asdict()) for command in self.TeleportCommands))
+        self.keyboard.type('`')  # Close the console to resume the game
+        self.paused = False
+        for frame in range(self.TeleportFrames):
+            data = self.rendered(data.renderTime, self.ConsoleTimeout)
+            if data is None:
+                break
+            position = data.worldPlacement.position
+            if math.hypot(position.x - pose.x, position.z - pose.z) <= self.TeleportTolerance and \
+                    data.wearCabin == 0 and data.wearChassis == 0:
+                self.metrics['teleports'] += 1
+                self.metrics['teleport_seconds'] += time.perf_counter() - start
+                return data
+        self.metrics['teleport_failures'] += 1
+        return None
 
     def wait(self) -> Telemetry.Data:
-        """ Wait until game is ready and starts sending telemetry data """
+        """ Wait until game is ready and starts sending telemetry data, the first time since the launch is the frame
+        phase of the startup """
         self.telemetry.wait(Telemetry.Event.start)
+        self.paused = False
         for strange_map_loading_frames in range(4):
             self.telemetry.data()
-        return self.telemetry.data()
+        data = self.telemetry.data()
+        self.startup.setdefault('frame', time.perf_counter() - self.launched)
+        return data
+
+    async def wait_async(self) -> Telemetry.Data:
+        """ Wait until game is ready and starts sending telemetry data without blocking the event loop """
+        await self.telemetry.wait(Telemetry.Event.start)
+        self.paused = False
+        for strange_map_loading_frames in range(4):
+            await self.telemetry.data()
+        data = await self.telemetry.data()
+        self.startup.setdefault('frame', time.perf_counter() - self.launched)
+        return data
 
     def terminate(self):
         """ Stop the simulator process and clean up """
@@ -155,12 +544,22 @@ class Simulator(abc.ABC):
             self.steam2_file.unlink()
         except FileNotFoundError:
             pass
-        self.telemetry = None
+        self.stop_capture()
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
         self.keyboard = None
+        self.wheel, self.wheel_raw = None, None
+        self.held, self.paused = set(), True
         self.window = None
-        self.process.terminate()
-        self.process.wait()
-        self.process = None
+        self.buffer, self.scratch = None, None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.terminate()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.terminate()
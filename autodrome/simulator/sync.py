@@ -0,0 +1,162 @@
+import os
+import json
+import shutil
+import hashlib
+import platform
+import tempfile
+import unittest
+import collections
+from pathlib import Path
+
+
+Manifest = '.autodrome_manifest.json'
+FICLONE = 0x40049409  # Linux ioctl sharing the extents of another file, supported by Btrfs, XFS and others
+
+
+def digest(path: Path) -> str:
+    """ Content hash of the file """
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def place(source: Path, destination: Path) -> str:
+    """ Put the file in place as a reflink, a hard link or a copy, whichever works first, and return which it was
+    The file is placed under a temporary name and then atomically renamed over the destination. A destination that
+    is a hard link of the source already has its content and is left alone. """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    if destination.exists() and os.path.samefile(source, destination):
+        return 'link'  # Renaming another link of the same file over it would do nothing and leave the temporary
+    temporary = destination.with_name(f'.{destination.name}.tmp')
+    temporary.unlink(missing_ok=True)
+    try:
+        kind = clone(source, temporary)
+        os.replace(temporary, destination)
+    finally:
+        temporary.unlink(missing_ok=True)
+    return kind
+
+
+def clone(source: Path, temporary: Path) -> str:
+    """ Create the temporary file as a reflink, a hard link or a copy of the source and return which it was """
+    if platform.system() == 'Linux':
+        import fcntl
+        try:
+            with open(source, 'rb') as original, open(temporary, 'wb') as reflink:
+                fcntl.ioctl(reflink.fileno(), FICLONE, original.fileno())
+            shutil.copystat(source, temporary)
+            return 'reflink'
+        except OSError:
+            temporary.unlink(missing_ok=True)
+    try:
+        os.link(source, temporary)
+        return 'link'
+    except OSError:
+        shutil.copy2(source, temporary)
+        return 'copy'
+
+
+def sync(source_dir: Path, destination_dir: Path) -> collections.Counter:
+    """ Mirror files of the source folder into the destination folder and return counts of what happened to them
+    A manifest in the destination remembers size, modification time and content hash of every synced source file.
+    Files with unchanged size and time aren't even read, the rest is hashed and placed only if the content differs.
+    Files that were synced before and are gone from the source are removed, other files in the destination are kept. """
+    manifest_file = destination_dir / Manifest
+    try:
+        manifest = json.loads(manifest_file.read_text())
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    counts, entries = collections.Counter(), {}
+    for source in sorted(path for path in source_dir.rglob('*') if path.is_file()):
+        relative = source.relative_to(source_dir).as_posix()
+        destination, stat, entry = destination_dir / relative, source.stat(), manifest.get(relative)
+        if entry is not None and destination.exists() and (entry['size'], entry['mtime']) == (stat.st_size,
+                                                                                                stat.st_mtime_ns):
+            entries[relative] = entry
+            counts['unchanged'] += 1
+            continue
+        content = digest(source)
+        if entry is None or entry['digest'] != content or not destination.exists():
+            counts[place(source, destination)] += 1
+            counts['bytes'] += stat.st_size
+        else:
+            counts['unchanged'] += 1
+        entries[relative] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': content}
+    for relative in manifest.keys() - entries.keys():
+        (destination_dir / relative).unlink(missing_ok=True)
+        counts['removed'] += 1
+    if entries != manifest:
+        destination_dir.mkdir(parents=True, exist_ok=True)
+        temporary = manifest_file.with_suffix('.tmp')
+        temporary.write_text(json.dumps(entries, indent=1))
+        os.replace(temporary, manifest_file)
+    return counts
+
+
+def write(path: Path, text: str) -> bool:
+    """ Write the text into the file only if it's different and return whether it was written """
+    try:
+        if path.read_text() == text:
+            return False
+    except FileNotFoundError:
+        pass
+    path.write_text(text)
+    return True
+
+
+# region Unit Tests
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source, self.destination = Path(self.directory.name) / 'source', Path(self.directory.name) / 'mod'
+        (self.source / 'map').mkdir(parents=True)
+        (self.source / 'map' / 'indy500.mbd').write_bytes(os.urandom(4096))
+        (self.source / 'manifest.sii').write_text('SiiNunit { }')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sync(self):
+        first = sync(self.source, self.destination)
+        self.assertEqual(first['unchanged'], 0)
+        self.assertEqual(first['reflink'] + first['link'] + first['copy'], 2)
+        self.assertEqual((self.destination / 'manifest.sii').read_text(), 'SiiNunit { }')
+        second = sync(self.source, self.destination)
+        self.assertEqual(second, collections.Counter(unchanged=2))
+
+    def test_changes(self):
+        sync(self.source, self.destination)
+        (self.destination / 'cache').mkdir()
+        os.replace(self.source / 'manifest.sii', self.source / 'renamed.sii')
+        os.utime(self.source / 'map' / 'indy500.mbd')  # Touched without changing content
+        counts = sync(self.source, self.destination)
+        self.assertEqual((counts['removed'], counts['unchanged'], counts['bytes']), (1, 1, len('SiiNunit { }')))
+        self.assertFalse((self.destination / 'manifest.sii').exists())
+        self.assertTrue((self.destination / 'renamed.sii').exists())
+        self.assertTrue((self.destination / 'cache').exists())  # Files not synced from the source are kept
+
+    def test_place(self):
+        source, destination = self.source / 'manifest.sii', self.destination / 'manifest.sii'
+        kind = place(source, destination)
+        with open(source, 'a') as file:  # Edited in place, a hard link sees the change too
+            file.write(' ')
+        self.assertEqual(place(source, destination), kind)
+        self.assertEqual(destination.read_text(), 'SiiNunit { } ')
+        self.assertEqual([path.name for path in self.destination.iterdir()], ['manifest.sii'])
+        with self.assertRaises(FileNotFoundError):
+            place(self.source / 'missing.sii', self.destination / 'missing.sii')
+        self.assertEqual([path.name for path in self.destination.iterdir()], ['manifest.sii'])
+
+    def test_write(self):
+        config = self.destination / 'config.cfg'
+        self.destination.mkdir()
+        self.assertTrue(write(config, 'uset g_console "1"'))
+        self.assertFalse(write(config, 'uset g_console "1"'))
+
+
+# endregion
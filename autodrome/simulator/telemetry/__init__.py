@@ -1 +1,8 @@
 from .telemetry import Telemetry
+from .stream import TelemetryStream
+from .memory import TelemetryMemory
+from .aio import AsyncTelemetry
+from .decoder import Decoder
+from .recorder import Recorder, Recording
+from .replay import ReplayServer
+from .broker import TelemetryBroker
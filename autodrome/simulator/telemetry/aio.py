@@ -0,0 +1,113 @@
+import zmq
+import math
+import time
+import asyncio
+import zmq.asyncio
+
+from .telemetry import Telemetry
+
+
+class AsyncTelemetry(Telemetry):
+    """ Telemetry client for asyncio event loop that waits for the plugin without blocking other coroutines
+    The same methods as in Telemetry are coroutines. One event loop can drive several simulators at once. """
+
+    def __init__(self, address: str=Telemetry.Message.Bind.address, channels: dict=None, batch: int=1):
+        self.address = address
+        self.context = zmq.asyncio.Context()
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.connect(address)
+        self.skipped = 0
+        self.last = None
+
+        self.request_bytes = self.subscribe(channels, batch)
+        zmq.Socket.shadow(self.socket.underlying).send(self.request_bytes)  # Doesn't need a running event loop
+
+    async def poll(self, timeout: float) -> bool:
+        """ Wait at most timeout seconds for the next message and return whether it's ready """
+        return bool(await self.socket.poll(timeout=None if math.isinf(timeout) else timeout * 1000))
+
+    async def recv(self) -> Telemetry.Response:
+        reply = self.decode(await self.recv_bytes())
+        if reply.event == Telemetry.Event.frameEnd:
+            self.last = self.frames(reply)[-1]
+        return reply
+
+    async def recv_bytes(self) -> bytes:
+        """ Receive raw bytes of the next message without deserializing them """
+        reply_bytes = await self.socket.recv()
+        await self.socket.send(self.request_bytes)
+        return reply_bytes
+
+    async def wait(self, event: Telemetry.Event, timeout: float=math.inf) -> Telemetry.Response:
+        """ Wait until a message with the event arrives and count the skipped ones or return None after timeout
+        Event None receives all messages until timeout and returns the last one. """
+        reply, deadline = None, time.monotonic() + timeout
+        self.skipped = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await self.poll(timeout=remaining):
+                return reply if event is None else None
+            if reply is not None:
+                self.skipped += 1
+            reply = await self.recv()
+            if event is not None and reply.event == event:
+                return reply
+
+    async def latest(self) -> Telemetry.Data:
+        while await self.poll(timeout=0):
+            await self.recv()
+        return self.last
+
+    async def data(self) -> Telemetry.Data:
+        reply = await self.wait(event=Telemetry.Event.frameEnd)
+        return self.frames(reply)[-1]
+
+    async def batch(self) -> list:
+        reply = await self.wait(event=Telemetry.Event.frameEnd)
+        return self.frames(reply)
+
+
+# region Unit Tests
+
+
+from . import telemetry
+
+
+class TestAsyncTelemetry(telemetry.TestTelemetry):
+
+    def test_wait(self):
+        async def wait():
+            telemetry = AsyncTelemetry()
+            self.assertEqual((await telemetry.wait(Telemetry.Event.start)).event, Telemetry.Event.start)
+            self.assertEqual(telemetry.skipped, 6)
+            self.assertEqual((await telemetry.data()).renderTime, 8)
+            self.assertEqual((await telemetry.wait(None, timeout=0.1)).event, Telemetry.Event.pause)
+
+        self.serve(self.Lifecycle)
+        asyncio.run(wait())
+
+    def test_latest(self):
+        async def wait():
+            telemetry = AsyncTelemetry()
+            await telemetry.wait(Telemetry.Event.pause, timeout=1)
+            self.assertEqual((await telemetry.latest()).renderTime, 12)
+
+        self.serve(self.Lifecycle)
+        asyncio.run(wait())
+
+    def test_timeout(self):
+        async def wait():
+            telemetry = AsyncTelemetry()
+            ticks = 0
+            waiting = asyncio.ensure_future(telemetry.wait(Telemetry.Event.unload, timeout=0.1))
+            while not waiting.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+            self.assertIsNone(waiting.result())
+            self.assertGreater(ticks, 5)  # Other coroutines keep running while waiting
+
+        self.serve(self.Lifecycle)
+        asyncio.run(wait())
+
+
+# endregion
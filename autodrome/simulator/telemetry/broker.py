@@ -0,0 +1,108 @@
+import zmq
+import time
+import unittest
+import threading
+
+from .telemetry import Telemetry
+from .stream import TelemetryStream
+from .replay import ReplayServer
+
+
+class TelemetryBroker:
+    """ Owner of the only plugin connection that re-publishes every message to any number of subscribers
+    The plugin runs in lockstep request mode and the broker requests the next message as soon as the previous one is
+    published. Every subscriber has its own queue bounded by the high-water mark and once it's full new messages for
+    that subscriber are dropped, so a slow subscriber never holds back the plugin or the other subscribers. Lifecycle
+    events published before a subscriber connects are lost like in the streaming mode. Brokers of simulator instances
+    other than 0 bind the broker address of the instance, Simulator.broker. """
+    HighWaterMark = 1000
+
+    def __init__(self, address: str=Telemetry.Message.Bind.broker, plugin: str=Telemetry.Message.Bind.address,
+                 channels: dict=None, batch: int=1, hwm: int=HighWaterMark):
+        self.address, self.plugin = address, plugin
+        self.channels, self.batch = channels, batch
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)  # Applies to each subscriber pipe separately
+        self.socket.bind(address)
+        self.stopping = threading.Event()
+        self.thread = None
+        self.published = 0
+
+    def subscribe(self, size: int=256) -> TelemetryStream:
+        """ Connect a new subscriber that buffers at most size messages on its side """
+        return TelemetryStream(self.address, size=size, context=self.context)
+
+    def start(self):
+        """ Connect the plugin and re-publish its messages in a background thread """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop re-publishing and release the sockets """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.socket.close(linger=0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def run(self):
+        """ Forward raw message bytes from the plugin to the subscribers until stopped """
+        telemetry = Telemetry(self.plugin, channels=self.channels, batch=self.batch)
+        try:
+            while not self.stopping.is_set():
+                if telemetry.poll(timeout=0.1):
+                    self.socket.send(telemetry.recv_bytes(), copy=False)
+                    self.published += 1
+        finally:
+            telemetry.close()
+
+
+# region Unit Tests
+
+
+class TestTelemetryBroker(unittest.TestCase):
+    Address = 'inproc://autodrome_test_broker'
+    Plugin = 'ipc:///tmp/autodrome_test_broker.ipc'
+
+    def test_fan_out(self):
+        frames = ReplayServer.synthetic(200)
+        with TelemetryBroker(self.Address, plugin=self.Plugin) as broker:
+            fast, slow = broker.subscribe(size=1000), broker.subscribe(size=8)
+            time.sleep(0.2)  # Let the subscriptions propagate to the publisher
+            with ReplayServer(frames, address=self.Plugin) as server:
+                server.restart()
+                fast.wait(Telemetry.Event.start)
+                render_times = [fast.data().renderTime for frame in range(len(frames))]
+                self.assertEqual(fast.recv().event, Telemetry.Event.pause)
+                self.assertEqual(server.served, len(frames))
+        self.assertEqual(render_times, frames['renderTime'].tolist())
+        slow.drain()
+        self.assertEqual(len(slow.buffer), 8)
+        self.assertEqual(slow.latest().renderTime, frames['renderTime'][-1])
+
+    def test_slow_subscriber(self):
+        frames = ReplayServer.synthetic(5000)
+        with TelemetryBroker(self.Address, plugin=self.Plugin, hwm=16) as broker:
+            stalled = broker.subscribe(size=16)
+            time.sleep(0.2)
+            with ReplayServer(frames, address=self.Plugin) as server:
+                server.restart()
+                deadline = time.monotonic() + 10
+                while server.served < len(frames) and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(server.served, len(frames))
+            self.assertGreater(broker.published, 2 * len(frames))
+        stalled.drain()
+        self.assertEqual(len(stalled.buffer), 16)
+        self.assertGreater(stalled.dropped, 0)  # Ring buffer dropped the oldest messages
+
+
+# endregion
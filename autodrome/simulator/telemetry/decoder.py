@@ -0,0 +1,307 @@
+import time
+import random
+import unittest
+import numpy as np
+
+from .telemetry import Telemetry
+from .layout import Primitives, DataLayout
+
+
+class Decoder:
+    """ Vectorized decoder of telemetry Response messages into one NumPy structured array
+    The plugin builds every frame message the same way, so messages of the same length share the positions of all
+    fields. Positions are found by walking the pointers of the first message in each group of equal length and all
+    messages in the group are then decoded at once with a strided view, one vectorized pass per field. Messages that
+    don't match the group layout (different pointers, multiple segments) fall back to decoding with pycapnp. """
+    Schema = Telemetry.Data.schema
+    DataUnion = Telemetry.Response.schema.fields['data'].schema
+    TelemetryField = DataUnion.fields['telemetry'].proto
+    BatchField = DataUnion.fields['batch'].proto
+
+    class Unsupported(Exception):
+        """ Exception that is raised for a message layout that can't be decoded by a strided view """
+        pass
+
+    def __init__(self, layout: np.dtype=DataLayout):
+        self.layout = layout
+
+    def decode(self, buffers: list, strict: bool=True) -> np.ndarray:
+        """ Decode a sequence of Response message buffers carrying telemetry into a structured array
+        Batches are expanded into all of their frames in place. Messages without telemetry (i.e. lifecycle events)
+        raise an error or are left out if not strict. """
+        frames = np.zeros(len(buffers), dtype=self.layout)
+        valid = np.ones(len(buffers), dtype=bool)
+        batches = {}
+        groups = {}
+        for index, buffer in enumerate(buffers):
+            groups.setdefault(len(buffer), []).append(index)
+
+        for length, indices in groups.items():
+            try:
+                fields, pointers = self.locate(buffers[indices[0]])
+            except self.Unsupported:
+                valid[indices] = self.decode_slowly(buffers, indices, frames, batches)
+                continue
+
+            stack = np.frombuffer(b''.join(buffers[index] for index in indices), dtype=np.uint8)
+            stack = stack.reshape(len(indices), length)
+            matching = (stack[:, pointers] == stack[0, pointers]).all(axis=1)
+            indices = np.asarray(indices)
+            valid[indices[~matching]] = self.decode_slowly(buffers, indices[~matching], frames, batches)
+            stack, indices = stack[matching], indices[matching]
+
+            discriminant_offset, *_ = fields.pop(0)
+            discriminant = stack[:, discriminant_offset:discriminant_offset + 2].copy().view('<u2')[:, 0]
+            telemetry = discriminant == self.TelemetryField.discriminantValue
+            for index in indices[discriminant == self.BatchField.discriminantValue]:
+                try:
+                    batches[index] = self.decode_batch(buffers[index])
+                except self.Unsupported:
+                    self.decode_slowly(buffers, [index], frames, batches)
+            valid[indices[~telemetry]] = False
+            stack, indices = stack[telemetry], indices[telemetry]
+
+            for path, offset, format, bit in fields:
+                if offset is None:
+                    continue
+                size = np.dtype(format).itemsize
+                column = stack[:, offset:offset + size].copy().view(format)[:, 0]
+                if bit is not None:
+                    column = (column >> bit) & 1
+                self.column(frames, path)[indices] = column
+
+        if valid.all():
+            return frames
+        if strict and not all(valid[index] or index in batches for index in range(len(buffers))):
+            raise ValueError("Response message doesn't carry telemetry data")
+        if not batches:
+            return frames[valid]
+        pieces = [batches[index] if index in batches else frames[index:index + 1]
+                  for index in range(len(buffers)) if valid[index] or index in batches]
+        return np.concatenate(pieces)
+
+    def decode_batch(self, buffer: bytes) -> np.ndarray:
+        """ Decode all frames of a batch Response message with one vectorized walk over the list elements """
+        segments = int.from_bytes(buffer[0:4], 'little') + 1
+        if segments != 1:
+            raise self.Unsupported("Multi-segment messages have far pointers")
+        header = (4 * (segments + 1) + 7) // 8 * 8
+        root = self.pointer(buffer, header, [])
+        if root is None:
+            raise self.Unsupported("Empty message")
+        data, data_size, children, children_count = root
+        position = children + 8 * self.BatchField.slot.offset
+        word = int.from_bytes(buffer[position:position + 8], 'little')
+        if word & 0b11 != 1 or (word >> 32) & 0b111 != 7:
+            raise self.Unsupported("Batch isn't a list of structs")
+        offset = (word & 0xffffffff) >> 2
+        if offset >= 1 << 29:
+            offset -= 1 << 30
+        tag = position + 8 + 8 * offset
+        word = int.from_bytes(buffer[tag:tag + 8], 'little')
+        count, data_words, pointer_count = (word & 0xffffffff) >> 2, (word >> 32) & 0xffff, word >> 48
+
+        message = np.frombuffer(buffer, dtype=np.uint8)
+        frames = np.zeros(count, dtype=self.layout)
+        data = tag + 8 + 8 * (data_words + pointer_count) * np.arange(count)
+        elements = (data, np.full(count, 8 * data_words), data + 8 * data_words, np.full(count, pointer_count))
+        self.gather(message, elements, np.ones(count, dtype=bool), self.Schema, (), frames)
+        return frames
+
+    def gather(self, message: np.ndarray, structs: tuple, present: np.ndarray, schema, path: tuple, frames: np.ndarray):
+        """ Recursively copy primitive fields of many structs at once given arrays of their positions and sizes """
+        data, data_size, children, pointer_count = structs
+        for field in schema.fields_list:
+            slot, name = field.proto.slot, path + (field.proto.name,)
+            kind = slot.type.which()
+            if kind == 'struct':
+                has = present & (slot.offset < pointer_count)
+                position = children + 8 * slot.offset
+                words = np.zeros(len(frames), dtype='<u8')
+                words[has] = message[position[has, None] + np.arange(8)].copy().view('<u8')[:, 0]
+                has &= words != 0
+                if (words[has] & 0b11 != 0).any():
+                    raise self.Unsupported("Only struct pointers within a single segment are supported")
+                offset = ((words & 0xffffffff) >> 2).astype(np.int64)
+                offset[offset >= 1 << 29] -= 1 << 30
+                child = position + 8 + 8 * offset
+                child_size = 8 * ((words >> 32) & 0xffff).astype(np.int64)
+                child_count = (words >> 48).astype(np.int64)
+                self.gather(message, (child, child_size, child + child_size, child_count), has, field.schema, name, frames)
+                continue
+            if kind == 'bool':
+                offset, bit, format = slot.offset // 8, slot.offset % 8, '<u1'
+            else:
+                format, bit = Primitives[kind], None
+                offset = slot.offset * np.dtype(format).itemsize
+            size = np.dtype(format).itemsize
+            has = present & (offset + size <= data_size)
+            column = message[(data[has] + offset)[:, None] + np.arange(size)].copy().view(format)[:, 0]
+            if bit is not None:
+                column = (column >> bit) & 1
+            self.column(frames, name)[has] = column
+
+    def locate(self, buffer: bytes) -> tuple:
+        """ Find byte offsets of all telemetry fields and bytes of all pointers in a Response message """
+        segments = int.from_bytes(buffer[0:4], 'little') + 1
+        if segments != 1:
+            raise self.Unsupported("Multi-segment messages have far pointers")
+        header = (4 * (segments + 1) + 7) // 8 * 8
+        pointers = list(range(0, header))
+
+        root = self.pointer(buffer, header, pointers)
+        if root is None:
+            raise self.Unsupported("Empty message")
+        data, data_size, children, children_count = root
+        discriminant = data + 2 * self.DataUnion.node.struct.discriminantOffset
+        telemetry = children + 8 * self.TelemetryField.slot.offset
+        fields = [(discriminant, None, '<u2', None)]
+        self.walk(buffer, telemetry, self.Schema, (), fields, pointers)
+        return fields, pointers
+
+    def walk(self, buffer: bytes, position: int, schema, path: tuple, fields: list, pointers: list):
+        """ Recursively collect byte offsets of primitive fields of the struct referenced by the pointer """
+        struct = None if position is None else self.pointer(buffer, position, pointers)
+        for field in schema.fields_list:
+            slot, name = field.proto.slot, path + (field.proto.name,)
+            kind = slot.type.which()
+            if kind == 'struct':
+                child = None
+                if struct is not None and slot.offset < struct[3]:
+                    child = struct[2] + 8 * slot.offset
+                self.walk(buffer, child, field.schema, name, fields, pointers)
+                continue
+            if kind not in Primitives:
+                raise self.Unsupported(f"Field '{field.proto.name}' of type '{kind}' has no fixed size layout")
+            if kind == 'bool':
+                offset, bit, format = slot.offset // 8, slot.offset % 8, '<u1'
+            else:
+                format, bit = Primitives[kind], None
+                offset = slot.offset * np.dtype(format).itemsize
+            if struct is None or offset + np.dtype(format).itemsize > struct[1]:
+                fields.append((name, None, format, bit))  # Missing struct or field reads as the default zero
+            else:
+                fields.append((name, struct[0] + offset, format, bit))
+
+    def pointer(self, buffer: bytes, position: int, pointers: list) -> tuple:
+        """ Decode a struct pointer and return data start, data size, pointers start and pointer count """
+        pointers.extend(range(position, position + 8))
+        word = int.from_bytes(buffer[position:position + 8], 'little')
+        if word == 0:
+            return None
+        if word & 0b11 != 0:
+            raise self.Unsupported("Only struct pointers within a single segment are supported")
+        offset = (word & 0xffffffff) >> 2
+        if offset >= 1 << 29:
+            offset -= 1 << 30
+        data_words, pointer_count = (word >> 32) & 0xffff, word >> 48
+        data = position + 8 + 8 * offset
+        return data, 8 * data_words, data + 8 * data_words, pointer_count
+
+    def decode_slowly(self, buffers: list, indices: list, frames: np.ndarray, batches: dict) -> np.ndarray:
+        """ Decode messages one by one with pycapnp and return which of them carry a single telemetry frame """
+        valid = np.zeros(len(indices), dtype=bool)
+        for position, index in enumerate(indices):
+            reply = Telemetry.decode(buffers[index])
+            if reply.data.which() == 'telemetry':
+                self.copy(reply.data.telemetry, frames[index], self.Schema)
+                valid[position] = True
+            if reply.data.which() == 'batch':
+                batches[index] = np.zeros(len(reply.data.batch), dtype=self.layout)
+                for telemetry, record in zip(reply.data.batch, batches[index]):
+                    self.copy(telemetry, record, self.Schema)
+        return valid
+
+    def copy(self, reader, record: np.void, schema):
+        """ Recursively copy fields of a capnp struct reader into a structured record """
+        for field in schema.fields_list:
+            name = field.proto.name
+            if field.proto.slot.type.which() == 'struct':
+                self.copy(getattr(reader, name), record[name], field.schema)
+            else:
+                record[name] = getattr(reader, name)
+
+    @staticmethod
+    def column(frames: np.ndarray, path: tuple) -> np.ndarray:
+        """ View of a nested field of the structured array """
+        for name in path:
+            frames = frames[name]
+        return frames
+
+
+# region Unit Tests
+
+
+class TestDecoder(unittest.TestCase):
+
+    @staticmethod
+    def response(render_time: int, full: bool=True) -> bytes:
+        response = Telemetry.Response.new_message()
+        response.event = Telemetry.Event.frameEnd
+        telemetry = response.data.init('telemetry')
+        telemetry.renderTime = render_time
+        telemetry.simulationTime = render_time + 1
+        telemetry.speed = render_time / 4
+        telemetry.parkingBrake = render_time % 2
+        telemetry.wearChassis = render_time / 8
+        if full:
+            telemetry.worldPlacement.position.x = render_time / 2
+            telemetry.worldPlacement.orientation.heading = render_time / 16
+            telemetry.localLinearVelocity.z = -render_time
+            telemetry.localAngularVelocity.y = 1.0
+        return response.to_bytes()
+
+    def test_decode(self):
+        buffers = [self.response(render_time) for render_time in range(100)]
+        frames = Decoder().decode(buffers)
+        self.assertEqual(frames.dtype, DataLayout)
+        self.assertTrue((frames['renderTime'] == np.arange(100)).all())
+        self.assertTrue((frames['simulationTime'] == np.arange(100) + 1).all())
+        self.assertTrue((frames['speed'] == np.arange(100) / 4).all())
+        self.assertTrue((frames['parkingBrake'] == np.arange(100) % 2).all())
+        self.assertTrue((frames['worldPlacement']['position']['x'] == np.arange(100) / 2).all())
+        self.assertTrue((frames['worldPlacement']['orientation']['heading'] == np.float32(np.arange(100) / 16)).all())
+        self.assertTrue((frames['localLinearVelocity']['z'] == -np.arange(100)).all())
+        self.assertTrue((frames['localAngularVelocity']['y'] == 1.0).all())
+
+    def test_mixed(self):
+        buffers = [self.response(render_time, full=random.random() < 0.5) for render_time in range(100)]
+        frames, expected = Decoder().decode(buffers), np.zeros(100, dtype=DataLayout)
+        Decoder().decode_slowly(buffers, range(100), expected, {})
+        self.assertEqual(frames.tobytes(), expected.tobytes())
+
+    def test_event(self):
+        response = Telemetry.Response.new_message()
+        response.event = Telemetry.Event.pause
+        response.data.none = None
+        buffers = [self.response(1), response.to_bytes(), self.response(2, full=False), self.response(3)]
+        with self.assertRaises(ValueError):
+            Decoder().decode(buffers)
+        frames = Decoder().decode(buffers, strict=False)
+        self.assertEqual(frames['renderTime'].tolist(), [1, 2, 3])
+
+    def test_batch(self):
+        response = Telemetry.Response.new_message()
+        response.event = Telemetry.Event.frameEnd
+        batch = response.data.init('batch', 3)
+        for render_time, reply_bytes in enumerate([self.response(10), self.response(11, full=False), self.response(12)]):
+            batch[render_time] = Telemetry.decode(reply_bytes).data.telemetry
+        buffers = [self.response(1), response.to_bytes(), self.response(2)]
+        frames = Decoder().decode(buffers)
+        self.assertEqual(frames['renderTime'].tolist(), [1, 10, 11, 12, 2])
+        batches = {}
+        Decoder().decode_slowly([buffers[1]], [0], np.zeros(1, dtype=DataLayout), batches)
+        self.assertEqual(frames[1:4].tobytes(), batches[0].tobytes())
+
+    def test_performance(self):
+        buffers = [self.response(render_time) for render_time in range(10_000)]
+        start = time.perf_counter()
+        Decoder().decode(buffers)
+        fast = time.perf_counter() - start
+        start = time.perf_counter()
+        Decoder().decode_slowly(buffers, range(len(buffers)), np.zeros(len(buffers), dtype=DataLayout), {})
+        slow = time.perf_counter() - start
+        self.assertLess(fast * 10, slow)
+
+
+# endregion
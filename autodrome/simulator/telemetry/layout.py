@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+
+from .telemetry import Telemetry
+
+
+Primitives = {
+    'bool': '?',
+    'int8': '<i1', 'int16': '<i2', 'int32': '<i4', 'int64': '<i8',
+    'uint8': '<u1', 'uint16': '<u2', 'uint32': '<u4', 'uint64': '<u8',
+    'float32': '<f4', 'float64': '<f8',
+    'enum': '<u2',
+}
+
+
+def structured(schema) -> np.dtype:
+    """ Packed little-endian NumPy structured dtype with the same (nested) fields as a capnp struct schema """
+    fields = []
+    for field in schema.fields_list:
+        kind = field.proto.slot.type.which()
+        if kind == 'struct':
+            fields.append((field.proto.name, structured(field.schema)))
+        elif kind in Primitives:
+            fields.append((field.proto.name, Primitives[kind]))
+        else:
+            raise NotImplementedError(f"Field '{field.proto.name}' of type '{kind}' has no fixed size layout")
+    return np.dtype(fields)
+
+
+DataLayout = structured(Telemetry.Data.schema)
+
+
+# region Unit Tests
+
+
+class TestLayout(unittest.TestCase):
+
+    def test_fields(self):
+        self.assertEqual(DataLayout.names, tuple(field.proto.name for field in Telemetry.Data.schema.fields_list))
+        self.assertEqual(DataLayout['worldPlacement']['position']['x'], np.dtype('<f8'))
+        self.assertEqual(DataLayout['worldPlacement']['orientation']['heading'], np.dtype('<f4'))
+        self.assertEqual(DataLayout['parkingBrake'], np.dtype('<u1'))
+
+    def test_packed(self):
+        self.assertEqual(DataLayout.itemsize, 3*8 + (3*8 + 3*4) + 2*(3*8) + 4 + 3*4 + 1 + 4*4)
+
+
+# endregion
@@ -0,0 +1,191 @@
+import os
+import math
+import mmap
+import time
+import unittest
+import numpy as np
+
+from .telemetry import Telemetry
+from .layout import DataLayout
+
+
+class TelemetryMemory(Telemetry):
+    """ Zero-copy reader of telemetry written by the plugin into a shared memory segment
+    The plugin increments the sequence counter before and after every write, so an odd value means a write is in
+    progress. A read is consistent if the counter was even and didn't change while the segment was being copied.
+    Besides the latest event and telemetry the segment counts occurrences of every event, so none of them is missed. """
+    Mode = Telemetry.Message.Mode.memory
+    Layout = np.dtype([('sequence', '<u4'), ('event', '<u2'),
+                       ('events', '<u4', (len(Telemetry.Event.schema.enumerants),)),
+                       ('telemetry', DataLayout)])
+    Record = np.dtype((np.record, Layout))
+    Interval = 0.0002
+    WriteTimeout = 0.1  # Longest write of the plugin, the counter stays odd forever if it dies in the middle of one
+
+    def __init__(self, path: str=Telemetry.Message.Bind.memory):
+        self.path = path
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(descriptor).st_size < self.Layout.itemsize:
+            os.ftruncate(descriptor, self.Layout.itemsize)
+        self.mmap = mmap.mmap(descriptor, self.Layout.itemsize)
+        os.close(descriptor)
+
+        self.segment = np.frombuffer(self.mmap, dtype=self.Record, count=1)
+        self.raw = self.segment.view(np.uint8)
+        self.counter = memoryview(self.mmap)[:4].cast('I')
+        self.snapshot = np.zeros(1, dtype=self.Record)
+        self.sequence = 0
+        self.events = np.zeros_like(self.segment['events'][0])
+
+    def read(self, out: np.ndarray=None) -> np.record:
+        """ Copy a consistent snapshot of the segment into the output array without waiting for a new write
+        Without the output array the snapshot is overwritten by the next read. Raises TimeoutError if a write doesn't
+        finish within WriteTimeout. """
+        out = self.snapshot if out is None else out
+        raw = out.view(np.uint8)  # Copying raw bytes is an order of magnitude faster than copying nested fields
+        deadline = None
+        while True:
+            begin = self.counter[0]
+            if begin & 1:
+                deadline = time.monotonic() + self.WriteTimeout if deadline is None else deadline
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Telemetry write in '{self.path}' didn't finish, the plugin might be gone")
+                continue
+            np.copyto(raw, self.raw)
+            if self.counter[0] == begin:
+                return out[0]
+
+    def poll(self, timeout: float) -> bool:
+        """ Wait at most timeout seconds for the next write and return whether it's ready """
+        deadline = time.monotonic() + timeout
+        while self.counter[0] == self.sequence or self.counter[0] & 1:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.Interval)
+        return True
+
+    def recv(self) -> np.record:
+        """ Wait for the next write and return a copy of the segment """
+        self.poll(math.inf)
+        snapshot = self.read(out=np.zeros(1, dtype=self.Record))
+        self.sequence = snapshot.sequence
+        return snapshot
+
+    def wait(self, event: Telemetry.Event, timeout: float=math.inf) -> np.record:
+        """ Wait until the plugin writes an event not seen yet and return a copy of the segment
+        Event None waits for the whole timeout, counts all events written so far as seen and returns the last write. """
+        snapshot, deadline = None, time.monotonic() + timeout
+        while True:
+            if event is not None:
+                snapshot = self.read(out=np.zeros(1, dtype=self.Record))
+                if snapshot.events[event] > self.events[event]:
+                    self.events[event] += 1
+                    self.sequence = snapshot.sequence
+                    return snapshot
+                snapshot = None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.poll(remaining):
+                if event is None:
+                    self.events[:] = self.read().events
+                return snapshot
+            if event is None:
+                snapshot = self.recv()
+
+    def data(self) -> np.record:
+        """ Return telemetry of the newest frame not returned yet and wait for the next one if there's none """
+        frames = int(self.segment['events'][0][Telemetry.Event.frameEnd])
+        self.events[Telemetry.Event.frameEnd] = max(int(self.events[Telemetry.Event.frameEnd]), frames - 1)
+        return self.wait(Telemetry.Event.frameEnd).telemetry
+
+    def latest(self) -> np.record:
+        """ Return telemetry of the newest write without waiting or consuming any event """
+        return self.read(out=np.zeros(1, dtype=self.Record)).telemetry
+
+    @staticmethod
+    def frames(reply: np.record) -> list:
+        """ Telemetry data of the frame in the snapshot """
+        return [reply.telemetry]
+
+    def close(self):
+        """ Release the shared memory segment """
+        self.counter.release()
+        self.segment = self.raw = None
+        self.mmap.close()
+
+
+# region Unit Tests
+
+
+class TestTelemetryMemory(unittest.TestCase):
+    Path = '/tmp/autodrome_test_telemetry.mem'
+    RepeatReads = 10_000
+    MinimumReads = 10_000  # Per second, a frame takes thousands of times longer
+
+    def setUp(self):
+        self.memory = TelemetryMemory(self.Path)
+        self.plugin = np.frombuffer(mmap.mmap(os.open(self.Path, os.O_RDWR), TelemetryMemory.Layout.itemsize),
+                                    dtype=TelemetryMemory.Layout, count=1)
+
+    def tearDown(self):
+        self.memory.close()
+        os.unlink(self.Path)
+
+    def write(self, event: Telemetry.Event, render_time: int=None):
+        self.plugin['sequence'] += 1
+        self.plugin['event'] = int(event)
+        self.plugin['events'][0][int(event)] += 1
+        if render_time is not None:
+            self.plugin['telemetry']['renderTime'] = render_time
+            self.plugin['telemetry']['worldPlacement']['position']['x'] = render_time / 2
+        self.plugin['sequence'] += 1
+
+    def test_read(self):
+        self.write(Telemetry.Event.frameEnd, render_time=42)
+        snapshot = self.memory.read()
+        self.assertEqual(snapshot.event, Telemetry.Event.frameEnd)
+        self.assertEqual(snapshot.telemetry.renderTime, 42)
+        self.assertEqual(snapshot.telemetry.worldPlacement.position.x, 21.0)
+
+    def test_events(self):
+        for config in range(5):
+            self.write(Telemetry.Event.config)
+        self.write(Telemetry.Event.start)
+        self.write(Telemetry.Event.frameStart)
+        self.write(Telemetry.Event.frameEnd, render_time=1)
+        for config in range(5):
+            self.assertEqual(self.memory.wait(Telemetry.Event.config, timeout=0.1).event, Telemetry.Event.frameEnd)
+        self.assertIsNone(self.memory.wait(Telemetry.Event.config, timeout=0.01))
+        self.assertIsNotNone(self.memory.wait(Telemetry.Event.start, timeout=0.01))
+        self.write(Telemetry.Event.pause)
+        self.assertEqual(self.memory.wait(None, timeout=0.01).event, Telemetry.Event.pause)
+        self.assertIsNone(self.memory.wait(Telemetry.Event.pause, timeout=0))  # Skipped like the messages of sockets
+
+    def test_data(self):
+        self.write(Telemetry.Event.frameEnd, render_time=1)
+        self.write(Telemetry.Event.frameEnd, render_time=2)
+        self.write(Telemetry.Event.frameEnd, render_time=3)
+        self.assertEqual(self.memory.data().renderTime, 3)
+        self.assertFalse(self.memory.poll(timeout=0.0))
+
+    def test_latest(self):
+        self.write(Telemetry.Event.frameEnd, render_time=1)
+        self.write(Telemetry.Event.frameEnd, render_time=2)
+        self.assertEqual(self.memory.latest().renderTime, 2)
+        self.assertEqual(self.memory.wait(Telemetry.Event.frameEnd, timeout=0).telemetry.renderTime, 2)
+
+    def test_torn_write(self):
+        self.plugin['sequence'] += 1  # Plugin died in the middle of a write
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.memory.read()
+        self.assertLess(time.monotonic() - start, 10 * TelemetryMemory.WriteTimeout)
+
+    def test_performance(self):
+        self.write(Telemetry.Event.frameEnd, render_time=1)
+        start = time.perf_counter()
+        for read in range(self.RepeatReads):
+            self.memory.read()
+        self.assertGreater(self.RepeatReads / (time.perf_counter() - start), self.MinimumReads)
+
+
+# endregion
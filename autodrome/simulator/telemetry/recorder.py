@@ -0,0 +1,227 @@
+import os
+import json
+import unittest
+import tempfile
+import numpy as np
+from pathlib import Path
+
+from .telemetry import Telemetry
+from .layout import DataLayout
+from .decoder import Decoder
+
+
+def columns(layout: np.dtype, path: tuple=()) -> list:
+    """ Flatten nested fields of a structured dtype into a list of (path, dtype) columns """
+    flat = []
+    for name in layout.names:
+        if layout[name].names:
+            flat.extend(columns(layout[name], path + (name,)))
+        else:
+            flat.append((path + (name,), layout[name]))
+    return flat
+
+
+class Recorder:
+    """ Writer of telemetry frames into preallocated memory-mapped files with one file per column
+    Files grow by whole chunks of frames. Every flush atomically replaces the footer holding the number of frames safely
+    on disk, so a crash loses at most frames appended since the last flush. Messages are decoded in batches. """
+    Footer = 'footer.json'
+    Index = 'renderTime.index'
+    Chunk = 2 ** 16
+    Batch = 256
+
+    def __init__(self, directory: Path, layout: np.dtype=DataLayout, chunk: int=Chunk, batch: int=Batch):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.layout, self.chunk, self.batch = layout, chunk, batch
+        self.columns = columns(layout)
+        self.decoder = Decoder(layout)
+        self.pending = []
+        self.count, self.ordered, self.last = 0, True, 0
+        self.capacity, self.maps = 0, []
+
+        footer = self.directory / self.Footer
+        if footer.exists():  # Continue appending to an existing recording
+            metadata = json.loads(footer.read_text())
+            if metadata['columns'] != self.describe():
+                raise ValueError(f"Recording in '{self.directory}' has different columns")
+            self.count, self.ordered, self.last = metadata['count'], metadata['ordered'], metadata['last']
+        if (self.directory / self.Index).exists():  # Index becomes stale with new frames
+            (self.directory / self.Index).unlink()
+        self.grow(max(self.count, 1))
+
+    def __enter__(self):
+        return self
+
+    def describe(self) -> list:
+        """ Names and types of all columns as stored in the footer """
+        return [['.'.join(path), dtype.str] for path, dtype in self.columns]
+
+    def grow(self, required: int):
+        """ Extend column files to hold at least the required number of frames rounded up to whole chunks """
+        capacity = -(-required // self.chunk) * self.chunk
+        for mmap in self.maps:
+            mmap.flush()
+        self.maps = []
+        for path, dtype in self.columns:
+            file = self.directory / ('.'.join(path) + '.bin')
+            file.touch()
+            os.truncate(file, capacity * dtype.itemsize)
+            self.maps.append(np.memmap(file, dtype=dtype, mode='r+', shape=(capacity,)))
+        self.capacity = capacity
+
+    def append(self, reply_bytes: bytes):
+        """ Queue a raw Response message, messages without telemetry are skipped when the batch is decoded """
+        self.pending.append(reply_bytes)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def write(self, frames: np.ndarray):
+        """ Copy decoded frames into the column files """
+        if len(frames) == 0:
+            return
+        if self.count + len(frames) > self.capacity:
+            self.grow(self.count + len(frames))
+        for (path, dtype), mmap in zip(self.columns, self.maps):
+            mmap[self.count:self.count + len(frames)] = Decoder.column(frames, path)
+
+        render_time = frames['renderTime']
+        if render_time[0] < self.last or (np.diff(render_time.astype(np.int64)) < 0).any():
+            self.ordered = False
+        self.last = int(render_time[-1])
+        self.count += len(frames)
+
+    def flush(self):
+        """ Decode and write queued messages, sync the column files and then commit the footer """
+        if self.pending:
+            self.write(self.decoder.decode(self.pending, strict=False))
+            self.pending = []
+        for mmap in self.maps:
+            mmap.flush()
+        metadata = {'count': self.count, 'ordered': self.ordered, 'last': self.last,
+                    'chunk': self.chunk, 'columns': self.describe()}
+        footer = self.directory / self.Footer
+        temporary = footer.with_suffix('.tmp')
+        temporary.write_text(json.dumps(metadata))
+        os.replace(temporary, footer)
+
+    def close(self):
+        """ Flush remaining frames and store the renderTime index if the frames are out of order """
+        self.flush()
+        if not self.ordered:
+            render_time = self.maps[[path for path, dtype in self.columns].index(('renderTime',))]
+            order = np.argsort(render_time[:self.count], kind='stable')
+            order.astype('<i8').tofile(self.directory / self.Index)
+        self.maps = []
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Recording:
+    """ Memory-mapped read access to telemetry frames stored by the Recorder """
+
+    def __init__(self, directory: Path, layout: np.dtype=DataLayout):
+        self.directory = Path(directory)
+        self.layout = layout
+        metadata = json.loads((self.directory / Recorder.Footer).read_text())
+        self.count, self.ordered = metadata['count'], metadata['ordered']
+        self.columns = {}
+        for name, dtype in metadata['columns']:
+            file = self.directory / (name + '.bin')
+            if self.count == 0:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(file, dtype=dtype, mode='r', shape=(self.count,))
+        self.order, self.sorted = None, None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """ Column of the recording by its dotted name (i.e. 'worldPlacement.position.x') """
+        return self.columns[name]
+
+    def frames(self, start: int=0, stop: int=None) -> np.ndarray:
+        """ Assemble a range of frames into a structured array """
+        stop = self.count if stop is None else stop
+        frames = np.zeros(len(range(*slice(start, stop).indices(self.count))), dtype=self.layout)
+        for path, dtype in columns(self.layout):
+            Decoder.column(frames, path)[:] = self.columns['.'.join(path)][start:stop]
+        return frames
+
+    def find(self, render_time: int) -> int:
+        """ Index of the last frame rendered at or before the render time or -1 if there's none """
+        if self.ordered:
+            return int(np.searchsorted(self['renderTime'], render_time, side='right')) - 1
+        if self.order is None:
+            index = self.directory / Recorder.Index
+            if index.exists():
+                self.order = np.fromfile(index, dtype='<i8')[:self.count]
+            else:  # Recorder crashed before storing the index
+                self.order = np.argsort(self['renderTime'], kind='stable')
+            self.sorted = self['renderTime'][self.order]
+        position = int(np.searchsorted(self.sorted, render_time, side='right')) - 1
+        return int(self.order[position]) if position >= 0 else -1
+
+
+# region Unit Tests
+
+
+class TestRecorder(unittest.TestCase):
+
+    @staticmethod
+    def response(render_time: int, event: str='frameEnd') -> bytes:
+        response = Telemetry.Response.new_message()
+        response.event = event
+        if event == 'frameEnd':
+            telemetry = response.data.init('telemetry')
+            telemetry.renderTime = render_time
+            telemetry.worldPlacement.position.x = render_time / 2
+            telemetry.worldPlacement.orientation.heading = 0.25
+            telemetry.localLinearVelocity.x = 0.0
+            telemetry.localAngularVelocity.x = 0.0
+        else:
+            response.data.none = None
+        return response.to_bytes()
+
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with Recorder(directory, chunk=100, batch=16) as recorder:
+                for render_time in range(250):
+                    recorder.append(self.response(render_time, event='frameStart'))
+                    recorder.append(self.response(render_time))
+                self.assertEqual(recorder.capacity, 300)
+            recording = Recording(directory)
+            self.assertEqual(len(recording), 250)
+            self.assertTrue((recording['renderTime'] == np.arange(250)).all())
+            self.assertTrue((recording['worldPlacement.position.x'] == np.arange(250) / 2).all())
+            self.assertEqual(recording.frames(10, 20)['worldPlacement']['orientation']['heading'].tolist(), [0.25] * 10)
+            self.assertEqual(recording.find(100), 100)
+            self.assertEqual(recording.find(-1), -1)
+
+    def test_crash(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = Recorder(directory, batch=10)
+            for render_time in range(25):
+                recorder.append(self.response(render_time))
+            self.assertEqual(len(Recording(directory)), 20)
+            del recorder  # Crash without closing
+
+            with Recorder(directory, batch=10) as recorder:
+                recorder.append(self.response(100))
+            self.assertEqual(Recording(directory)['renderTime'].tolist(), list(range(20)) + [100])
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with Recorder(directory, batch=10) as recorder:
+                for render_time in [5, 6, 7, 1, 2, 3, 10]:
+                    recorder.append(self.response(render_time))
+            recording = Recording(directory)
+            self.assertFalse(recording.ordered)
+            self.assertEqual(recording.find(3), 5)
+            self.assertEqual(recording.find(6), 1)
+            self.assertEqual(recording.find(0), -1)
+
+
+# endregion
@@ -0,0 +1,353 @@
+import zmq
+import math
+import time
+import unittest
+import threading
+import numpy as np
+from typing import Callable
+
+from .telemetry import Telemetry
+from .layout import DataLayout
+from .decoder import Decoder
+
+
+class Encoder:
+    """ Vectorized encoder of telemetry frames into Response messages with the same layout as the plugin sends
+    A template message with all structs initialized is built once, then frames are written into copies of it one
+    vectorized pass per field at the offsets found by the Decoder. """
+
+    def __init__(self):
+        response = Telemetry.Response.new_message()
+        response.event = Telemetry.Event.frameEnd
+        self.initialize(response.data.init('telemetry'), Telemetry.Data.schema)
+        self.template = np.frombuffer(response.to_bytes(), dtype=np.uint8)
+        fields, pointers = Decoder().locate(self.template.tobytes())
+        self.fields = fields[1:]  # Union discriminant is already set in the template
+
+    def initialize(self, builder, schema):
+        """ Recursively initialize all nested structs so every message has the same pointers """
+        for field in schema.fields_list:
+            if field.proto.slot.type.which() == 'struct':
+                self.initialize(builder.init(field.proto.name), field.schema)
+
+    def encode(self, frames: np.ndarray) -> np.ndarray:
+        """ Encode structured array of frames into rows of a 2D array of message bytes """
+        stack = np.tile(self.template, (len(frames), 1))
+        for path, offset, format, bit in self.fields:
+            size = np.dtype(format).itemsize
+            column = np.ascontiguousarray(Decoder.column(frames, path), dtype=format)
+            stack[:, offset:offset + size] = column.view(np.uint8).reshape(len(frames), size)
+        return stack
+
+    def batch(self, frames: np.ndarray) -> bytes:
+        """ Encode frames into a single batch message with one segment that the Decoder can walk at once """
+        response = Telemetry.Response.new_message(num_first_segment_words=len(self.template) // 8 * (len(frames) + 1))
+        response.event = Telemetry.Event.frameEnd
+        for builder, frame in zip(response.data.init('batch', len(frames)), frames):
+            self.fill(builder, frame, Telemetry.Data.schema)
+        return response.to_bytes()
+
+    def fill(self, builder, record: np.void, schema):
+        """ Recursively copy fields of a structured record into a capnp struct builder """
+        for field in schema.fields_list:
+            name, kind = field.proto.name, field.proto.slot.type.which()
+            if kind == 'struct':
+                self.fill(getattr(builder, name), record[name], field.schema)
+            else:
+                setattr(builder, name, bool(record[name]) if kind == 'bool' else record[name].item())
+
+    @staticmethod
+    def event(event: Telemetry.Event) -> bytes:
+        """ Encode a lifecycle message without data """
+        response = Telemetry.Response.new_message()
+        response.event = event
+        response.data.none = None
+        return response.to_bytes()
+
+
+class ReplayServer:
+    """ Local stand-in for the game telemetry plugin that replays recorded or synthetic telemetry frames
+    Speaks the same REQ/REP lifecycle as the plugin: load, config (5x), start once restart() loads the first map,
+    frameStart/frameEnd for every frame and pause once the frames run out. The replay starts over after restart() like
+    the game after a map reload, or goes back to the first frame without the lifecycle events after rewind() like the
+    game after a teleport. Between pause() and resume() no frames are served like while the console of the game is
+    open. Pacing of frames is 'realtime' (by renderTime), 'fixed' (at the rate in Hz) or 'fast' (as fast as the client
+    asks). Frames are batched as negotiated by the client requests, channel subscriptions aren't emulated. """
+    Configs = 5
+    Pacings = ('realtime', 'fixed', 'fast')
+
+    class Stopped(Exception):
+        """ Exception that is raised inside of the serving thread to unwind it once the server is stopped """
+        pass
+
+    def __init__(self, frames: np.ndarray, address: str=Telemetry.Message.Bind.address,
+                 pacing: str='fast', rate: float=60.0):
+        if pacing not in self.Pacings:
+            raise ValueError(f"Pacing '{pacing}' is not one of {self.Pacings}")
+        self.frames, self.address = frames, address
+        self.pacing, self.rate = pacing, rate
+        self.encoder = Encoder()
+        self.events = {event: self.encoder.event(event) for event in Telemetry.Event.schema.enumerants}
+        self.restarting = threading.Event()
+        self.rewinding = threading.Event()
+        self.pausing = threading.Event()
+        self.resuming = threading.Event()  # Wakes up the server waiting for any of the above
+        self.stopping = threading.Event()
+        self.thread = None
+        self.served = 0
+        self.request_bytes, self.batch = None, 1
+
+    @staticmethod
+    def synthetic(count: int, rate: float=60.0, radius: float=100.0, speed: float=20.0) -> np.ndarray:
+        """ Truck driving around a circle that crashes into the railing in the last frame """
+        frames = np.zeros(count, dtype=DataLayout)
+        render_time = np.arange(count) / rate
+        angle = render_time * speed / radius
+        frames['renderTime'] = frames['simulationTime'] = np.round(render_time * 1e6)
+        frames['worldPlacement']['position']['x'] = radius * np.cos(angle)
+        frames['worldPlacement']['position']['z'] = radius * np.sin(angle)
+        frames['worldPlacement']['orientation']['heading'] = (angle / (2 * math.pi) + 0.25) % 1.0
+        frames['localLinearVelocity']['z'] = -speed
+        frames['localAngularVelocity']['y'] = speed / radius
+        frames['speed'] = speed
+        frames['effectiveThrottle'] = 0.5
+        if count > 0:
+            frames['wearChassis'][-1] = 0.01
+        return frames
+
+    def start(self):
+        """ Bind the socket and serve the lifecycle in a background thread """
+        socket = zmq.Context.instance().socket(zmq.REP)
+        socket.bind(self.address)
+        self.thread = threading.Thread(target=self.run, args=(socket,), daemon=True)
+        self.thread.start()
+
+    def restart(self):
+        """ Start replaying the frames from the beginning like after a map reload, which also closes the console """
+        self.pausing.clear()
+        self.restarting.set()
+        self.resuming.set()
+
+    def rewind(self):
+        """ Continue replaying from the first frame without reloading, renderTime keeps increasing """
+        self.rewinding.set()
+        self.resuming.set()
+
+    def pause(self):
+        """ Send the pause event and hold back frames like the game does once the console opens """
+        self.pausing.set()
+
+    def resume(self):
+        """ Send the start event and continue with the next frame like the game does once the console closes """
+        self.pausing.clear()
+        self.resuming.set()
+
+    def stop(self):
+        """ Stop serving and release the socket """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def run(self, socket: zmq.Socket):
+        """ Serve the plugin lifecycle until stopped """
+        offset = 0
+        try:
+            self.exchange(socket, self.events['load'])
+            for truck_config_event in range(self.Configs):
+                self.exchange(socket, self.events['config'])
+            self.idle(self.restarting.is_set)  # Main menu until the first map loads
+            while True:
+                if self.restarting.is_set():
+                    self.restarting.clear()
+                    self.exchange(socket, self.events['start'])
+                offset = self.serve(socket, offset)
+                self.idle(lambda: self.restarting.is_set() or self.rewinding.is_set())
+        except self.Stopped:
+            if socket.poll(timeout=100):
+                socket.recv()
+                socket.send(self.events['unload'])
+        finally:
+            socket.close(linger=0)
+
+    def serve(self, socket: zmq.Socket, offset: int) -> int:
+        """ Send all frames paced as configured, from the first one again after every rewind, followed by the pause
+        event and return the renderTime offset for the next replay """
+        if len(self.frames) == 0:
+            self.rewinding.clear()
+            self.exchange(socket, self.events['pause'])
+            return offset
+        self.rewinding.set()
+        while not self.restarting.is_set():
+            if self.rewinding.is_set():
+                self.rewinding.clear()
+                frames = self.frames.copy()
+                shift = offset - int(frames['renderTime'][0])  # Python ints, uint64 arithmetic would wrap around
+                frames['renderTime'] = frames['renderTime'].astype(np.int64) + shift
+                messages = self.encoder.encode(frames)
+                start, first, index = time.monotonic(), offset, 0
+            if self.pausing.is_set():
+                self.exchange(socket, self.events['pause'])
+                paused = time.monotonic()
+                self.idle(lambda: not self.pausing.is_set() or self.restarting.is_set())
+                if self.restarting.is_set():
+                    return offset
+                self.exchange(socket, self.events['start'])
+                start += time.monotonic() - paused  # Paced from where the replay stopped
+                continue  # Rewound while paused like after a teleport
+            if index == len(frames):
+                break
+            batch = min(self.batch, len(frames) - index)
+            last = index + batch - 1
+            if self.pacing == 'realtime':
+                self.sleep(start + (int(frames['renderTime'][last]) - first) / 1e6)
+            if self.pacing == 'fixed':
+                self.sleep(start + last / self.rate)
+            if self.batch > 1:
+                self.exchange(socket, self.encoder.batch(frames[index:index + batch]))
+            else:
+                self.exchange(socket, self.events['frameStart'])
+                self.exchange(socket, messages[index])
+            self.served += batch
+            index += batch
+            offset = int(frames['renderTime'][last]) + 1
+        self.exchange(socket, self.events['pause'])
+        return offset
+
+    def idle(self, until: Callable[[], bool]):
+        """ Wait without serving frames until the condition holds """
+        while not until():
+            self.resuming.wait(timeout=0.1)
+            self.resuming.clear()
+            if self.stopping.is_set():
+                raise self.Stopped()
+
+    def exchange(self, socket: zmq.Socket, message: bytes):
+        """ Wait for a request and reply with the message """
+        while not socket.poll(timeout=100):
+            if self.stopping.is_set():
+                raise self.Stopped()
+        request_bytes = socket.recv()
+        if request_bytes != self.request_bytes:
+            self.request_bytes = request_bytes
+            with Telemetry.Request.from_bytes(request_bytes) as request:
+                self.batch = max(request.batch, 1)
+        socket.send(message, copy=False)
+
+    @staticmethod
+    def sleep(until: float):
+        """ Sleep until the monotonic time """
+        remaining = until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+# region Unit Tests
+
+
+class TestReplayServer(unittest.TestCase):
+    MinimumFPS = 1000
+
+    def test_encode(self):
+        frames = ReplayServer.synthetic(100)
+        messages = Encoder().encode(frames)
+        decoded = Decoder().decode([message.tobytes() for message in messages])
+        self.assertEqual(decoded.tobytes(), frames.tobytes())
+        reply = Telemetry.decode(messages[10].tobytes())
+        self.assertEqual(reply.event, Telemetry.Event.frameEnd)
+        self.assertEqual(reply.data.telemetry.worldPlacement.position.x, frames['worldPlacement']['position']['x'][10])
+
+    def test_lifecycle(self):
+        with ReplayServer(ReplayServer.synthetic(10)) as server:
+            telemetry = Telemetry()
+            self.assertEqual(telemetry.recv().event, Telemetry.Event.load)
+            for config in range(ReplayServer.Configs):
+                self.assertEqual(telemetry.recv().event, Telemetry.Event.config)
+            self.assertIsNone(telemetry.wait(None, timeout=0.2))  # Nothing until a map loads
+            server.restart()
+            self.assertEqual(telemetry.recv().event, Telemetry.Event.start)
+            render_times = [telemetry.data().renderTime for frame in range(10)]
+            self.assertEqual(telemetry.recv().event, Telemetry.Event.pause)
+            server.restart()
+            self.assertIsNotNone(telemetry.wait(Telemetry.Event.start, timeout=1))
+            self.assertGreater(telemetry.data().renderTime, render_times[-1])
+        self.assertEqual(render_times, sorted(render_times))
+
+    def test_rewind(self):
+        frames = ReplayServer.synthetic(10)
+        with ReplayServer(frames) as server:
+            telemetry = Telemetry()
+            server.restart()
+            telemetry.wait(Telemetry.Event.start)
+            for frame in range(5):
+                data = telemetry.data()
+            server.rewind()
+            rewound = [telemetry.data() for frame in range(2)]  # Reply of the next frame might be on its way
+        self.assertGreater(rewound[0].renderTime, data.renderTime)
+        self.assertIn(frames['worldPlacement']['position']['x'][0], [data.worldPlacement.position.x for data in rewound])
+
+    def test_pause(self):
+        with ReplayServer(ReplayServer.synthetic(10)) as server:
+            telemetry = Telemetry()
+            server.restart()
+            telemetry.wait(Telemetry.Event.start)
+            data = telemetry.data()
+            server.pause()
+            self.assertIsNotNone(telemetry.wait(Telemetry.Event.pause, timeout=1))
+            self.assertIsNone(telemetry.wait(Telemetry.Event.frameEnd, timeout=0.2))  # Console open, nothing renders
+            server.resume()
+            self.assertIsNotNone(telemetry.wait(Telemetry.Event.start, timeout=1))
+            self.assertGreater(telemetry.data().renderTime, data.renderTime)
+
+    def test_offset(self):
+        frames = ReplayServer.synthetic(10)
+        frames['renderTime'] += 10 ** 9  # Recording doesn't start at zero
+        with ReplayServer(frames, pacing='realtime') as server:
+            telemetry = Telemetry()
+            server.restart()
+            telemetry.wait(Telemetry.Event.start)
+            render_times = [telemetry.data().renderTime for frame in range(10)]
+        self.assertEqual(render_times, (frames['renderTime'] - frames['renderTime'][0]).tolist())
+
+    def test_batch(self):
+        frames = ReplayServer.synthetic(100)
+        with ReplayServer(frames) as server:
+            telemetry = Telemetry(batch=32)
+            server.restart()
+            telemetry.wait(Telemetry.Event.start)
+            batches = [telemetry.batch() for batch in range(4)]
+            self.assertEqual([len(batch) for batch in batches], [32, 32, 32, 4])
+            self.assertEqual(telemetry.recv().event, Telemetry.Event.pause)
+        render_time = [data.renderTime for batch in batches for data in batch]
+        self.assertEqual(render_time, frames['renderTime'].tolist())
+
+    def test_pacing(self):
+        with ReplayServer(ReplayServer.synthetic(30), pacing='fixed', rate=100) as server:
+            telemetry = Telemetry()
+            server.restart()
+            telemetry.wait(Telemetry.Event.start)
+            start = time.monotonic()
+            for frame in range(30):
+                telemetry.data()
+            self.assertGreater(time.monotonic() - start, 0.25)
+
+    def test_performance(self):
+        with ReplayServer(ReplayServer.synthetic(5000)) as server:
+            telemetry = Telemetry()
+            server.restart()
+            telemetry.wait(Telemetry.Event.start)
+            start = time.monotonic()
+            for frame in range(5000):
+                telemetry.data()
+            seconds = time.monotonic() - start
+        self.assertGreater(5000 / seconds, self.MinimumFPS)
+
+
+# endregion
@@ -0,0 +1,118 @@
+import zmq
+import math
+import time
+import unittest
+import collections
+
+from .telemetry import Telemetry
+
+
+class TelemetryStream(Telemetry):
+    """ Non-blocking subscriber to telemetry published by the plugin in streaming mode
+    Neither side waits for the other. Messages are kept in a bounded ring buffer and once it's full the oldest ones
+    are dropped, so the newest frame is always available. Lifecycle events published before the subscription is
+    established are lost. """
+    Mode = Telemetry.Message.Mode.stream
+
+    def __init__(self, address: str=Telemetry.Message.Bind.address, size: int=256, context: zmq.Context=None):
+        self.address = address
+        self.buffer = collections.deque(maxlen=size)
+        self.dropped = 0
+        self.skipped = 0
+        self.last = None
+        self.context = zmq.Context() if context is None else None  # Inproc addresses need the publisher's context
+        self.socket = (context or self.context).socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.socket.connect(address)
+
+    def drain(self) -> int:
+        """ Move all messages waiting in the socket into the ring buffer without blocking """
+        count = 0
+        while True:
+            try:
+                reply_bytes = self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return count
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(reply_bytes)
+            count += 1
+
+    def poll(self, timeout: float) -> bool:
+        """ Wait at most timeout seconds for the next message and return whether it's ready """
+        return len(self.buffer) > 0 or bool(self.socket.poll(timeout=None if math.isinf(timeout) else timeout * 1000))
+
+    def recv(self) -> Telemetry.Response:
+        """ Return the oldest buffered message or block until a new one is published """
+        reply = self.decode(self.recv_bytes())
+        if reply.event == Telemetry.Event.frameEnd:
+            self.last = reply.data.telemetry
+        return reply
+
+    def recv_bytes(self) -> bytes:
+        """ Return raw bytes of the oldest buffered message or block until a new one is published """
+        self.drain()
+        return self.buffer.popleft() if self.buffer else self.socket.recv()
+
+    def latest(self) -> Telemetry.Data:
+        """ Return the newest published telemetry data without blocking or consuming the buffer """
+        self.drain()
+        for reply_bytes in reversed(self.buffer):
+            reply = self.decode(reply_bytes)
+            if reply.event == Telemetry.Event.frameEnd:
+                self.last = reply.data.telemetry
+                break
+        return self.last
+
+
+# region Unit Tests
+
+
+class TestTelemetryStream(unittest.TestCase):
+    Address = 'ipc:///tmp/autodrome_test_stream.ipc'
+
+    def setUp(self):
+        self.publisher = zmq.Context.instance().socket(zmq.PUB)
+        self.publisher.bind(self.Address)
+
+    def tearDown(self):
+        self.publisher.close(linger=0)
+
+    def publish(self, event: Telemetry.Event, render_time: int=None):
+        response = Telemetry.Response.new_message()
+        response.event = event
+        if render_time is None:
+            response.data.none = None
+        else:
+            response.data.init('telemetry').renderTime = render_time
+        self.publisher.send(response.to_bytes())
+
+    def subscribe(self, size: int) -> TelemetryStream:
+        stream = TelemetryStream(self.Address, size=size)
+        time.sleep(0.2)  # Let the subscription propagate to the publisher
+        return stream
+
+    def test_latest(self):
+        stream = self.subscribe(size=16)
+        self.assertIsNone(stream.latest())
+        for render_time in range(1, 5):
+            self.publish(Telemetry.Event.frameStart)
+            self.publish(Telemetry.Event.frameEnd, render_time)
+        self.publish(Telemetry.Event.pause)
+        time.sleep(0.1)
+        self.assertEqual(stream.latest().renderTime, 4)
+        self.assertEqual(stream.recv().event, Telemetry.Event.frameStart)
+        self.assertEqual(stream.data().renderTime, 1)
+
+    def test_ring_buffer(self):
+        stream = self.subscribe(size=8)
+        for render_time in range(1, 33):
+            self.publish(Telemetry.Event.frameEnd, render_time)
+        time.sleep(0.1)
+        stream.drain()
+        self.assertEqual(len(stream.buffer), 8)
+        self.assertEqual(stream.dropped, 32 - 8)
+        self.assertEqual(stream.latest().renderTime, 32)
+
+
+# endregion
@@ -2,8 +2,27 @@
 
 
 Telemetry::Telemetry(const scs_telemetry_init_params_v100_t *const params, const scs_u32_t version) :
-    paused(true), print(params->common.log),
-    zmq_context(1), data_socket(zmq_context, ZMQ_REP, *this), message_builder()
+    paused(true), print(params->common.log), transport(Telemetry::check_transport()),
+    address(Telemetry::check_bind(Bind::ADDRESS_VARIABLE->cStr(), Bind::ADDRESS->cStr())),
+    memory(Telemetry::check_bind(Bind::MEMORY_VARIABLE->cStr(), Bind::MEMORY->cStr())),
+    zmq_context(1), data_socket(zmq_context, transport == Transport::REQUEST ? ZMQ_REP : ZMQ_PUB, *this),
+    data_memory(*this), message_builder(),
+    channels{{
+        {this, Request::Channel::WORLD_PLACEMENT, SCS_TELEMETRY_TRUCK_CHANNEL_world_placement, SCS_VALUE_TYPE_dplacement, 0, 0, false, {}, false},
+        {this, Request::Channel::LOCAL_LINEAR_VELOCITY, SCS_TELEMETRY_TRUCK_CHANNEL_local_linear_velocity, SCS_VALUE_TYPE_dvector, 0, 0, false, {}, false},
+        {this, Request::Channel::LOCAL_ANGULAR_VELOCITY, SCS_TELEMETRY_TRUCK_CHANNEL_local_angular_velocity, SCS_VALUE_TYPE_dvector, 0, 0, false, {}, false},
+        {this, Request::Channel::SPEED, SCS_TELEMETRY_TRUCK_CHANNEL_speed, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+        {this, Request::Channel::EFFECTIVE_STEERING, SCS_TELEMETRY_TRUCK_CHANNEL_effective_steering, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+        {this, Request::Channel::EFFECTIVE_THROTTLE, SCS_TELEMETRY_TRUCK_CHANNEL_effective_throttle, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+        {this, Request::Channel::EFFECTIVE_BRAKE, SCS_TELEMETRY_TRUCK_CHANNEL_effective_brake, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+        {this, Request::Channel::PARKING_BRAKE, SCS_TELEMETRY_TRUCK_CHANNEL_parking_brake, SCS_VALUE_TYPE_bool, 0, 0, false, {}, false},
+        {this, Request::Channel::WEAR_ENGINE, SCS_TELEMETRY_TRUCK_CHANNEL_wear_engine, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+        {this, Request::Channel::WEAR_TRANSMISSION, SCS_TELEMETRY_TRUCK_CHANNEL_wear_transmission, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+        {this, Request::Channel::WEAR_CABIN, SCS_TELEMETRY_TRUCK_CHANNEL_wear_cabin, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+        {this, Request::Channel::WEAR_CHASSIS, SCS_TELEMETRY_TRUCK_CHANNEL_wear_chassis, SCS_VALUE_TYPE_float, 0, 0, false, {}, false},
+    }},
+    batch_size(1), batch_count(0), batch_builder(),
+    register_for_channel(params->register_for_channel), unregister_from_channel(params->unregister_from_channel)
 {
     if (!this->check_version(params, version)) {
         throw exception();
@@ -20,58 +39,54 @@ Telemetry::Telemetry(const scs_telemetry_init_params_v100_t *const params, const
     this->register_event(params, SCS_TELEMETRY_EVENT_frame_end, Telemetry::frame_end_callback);
     this->register_event(params, SCS_TELEMETRY_EVENT_paused, Telemetry::pause_callback);
 
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_world_placement, SCS_VALUE_TYPE_dplacement, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_local_linear_velocity, SCS_VALUE_TYPE_dvector, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_local_angular_velocity, SCS_VALUE_TYPE_dvector, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_speed, SCS_VALUE_TYPE_float, this);
-
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_effective_steering, SCS_VALUE_TYPE_float, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_effective_throttle, SCS_VALUE_TYPE_float, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_effective_brake, SCS_VALUE_TYPE_float, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_parking_brake, SCS_VALUE_TYPE_bool, this);
-
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_wear_engine, SCS_VALUE_TYPE_float, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_wear_transmission, SCS_VALUE_TYPE_float, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_wear_cabin, SCS_VALUE_TYPE_float, this);
-    this->register_channel(params, SCS_TELEMETRY_TRUCK_CHANNEL_wear_chassis, SCS_VALUE_TYPE_float, this);
+    if (this->transport != Transport::REQUEST) {
+        // Nobody sends requests to choose channels from, so all of them are subscribed
+        capnp::MallocMessageBuilder request_builder;
+        this->subscribe(request_builder.initRoot<Request>().asReader());
+    }
 
-    this->data_socket.bind(Bind::ADDRESS.toString());
+    if (this->transport == Transport::MEMORY) {
+        if (!this->data_memory.open(this->memory)) {
+            throw exception();
+        }
+    } else {
+        this->data_socket.bind(this->address);
+    }
     auto response = this->message_builder.initRoot<Response>();
     response.initData();
 
-    auto request = this->data_socket.recv();
     response.setEvent(Response::Event::LOAD);
     response.getData().setNone();
-    this->data_socket.send(this->message_builder);
+    this->reply();
 }
 
 void Telemetry::config(const struct scs_telemetry_configuration_t *const config_info) {
-    auto request = this->data_socket.recv();
+    this->flush();
     auto response = this->message_builder.getRoot<Response>();
     response.setEvent(Response::Event::CONFIG);
     auto config = response.getData().initConfig();
     config.setNotImplemented();
-    this->data_socket.send(this->message_builder);
+    this->reply();
 }
 
 void Telemetry::start() {
     this->paused = false;
 
-    auto request = this->data_socket.recv();
     auto response = this->message_builder.getRoot<Response>();
     response.setEvent(Response::Event::START);
     response.getData().setNone();
-    this->data_socket.send(this->message_builder);
+    this->reply();
 }
 
 void Telemetry::frame_start(const struct scs_telemetry_frame_start_t *const frame_start_info) {
     if (this->paused) return;
 
-    auto request = this->data_socket.recv();
     auto response = this->message_builder.getRoot<Response>();
-    response.setEvent(Response::Event::FRAME_START);
-    response.getData().setNone();
-    this->data_socket.send(this->message_builder);
+    if (this->batch_size == 1) {  // Batched frames are sent without frameStart events
+        response.setEvent(Response::Event::FRAME_START);
+        response.getData().setNone();
+        this->reply();
+    }
 
     // Prepare telemetry data for channel_update(...) callbacks
     auto telemetry = response.getData().initTelemetry();
@@ -83,33 +98,41 @@ void Telemetry::frame_start(const struct scs_telemetry_frame_start_t *const fram
 void Telemetry::frame_end() {
     if (this->paused) return;
 
-    auto request = this->data_socket.recv();
     auto response = this->message_builder.getRoot<Response>();
     response.setEvent(Response::Event::FRAME_END);
     // Telemetry data were set by channel_update(...) callbacks
-    this->data_socket.send(this->message_builder);
+    if (this->batch_size > 1) {
+        this->collect(response.getData().getTelemetry().asReader());
+    } else {
+        this->reply();
+    }
 }
 
 void Telemetry::pause() {
     this->paused = true;
+    this->flush();
 
-    auto request = this->data_socket.recv();
     auto response = this->message_builder.getRoot<Response>();
     response.setEvent(Response::Event::PAUSE);
     response.getData().setNone();
-    this->data_socket.send(this->message_builder);
+    this->reply();
 }
 
 Telemetry::~Telemetry() {
     if (! this->zmq_context) return;
+    this->register_for_channel = nullptr;  // Channels can't be registered during shutdown
+    this->flush();
 
-    auto request = this->data_socket.recv();
     auto response = this->message_builder.getRoot<Response>();
     response.setEvent(Response::Event::UNLOAD);
     response.getData().setNone();
-    this->data_socket.send(this->message_builder);
+    this->reply();
 
-    this->data_socket.unbind(*Bind::ADDRESS);
+    if (this->transport == Transport::MEMORY) {
+        this->data_memory.close();
+    } else {
+        this->data_socket.unbind(this->address);
+    }
     this->data_socket.close();
     this->zmq_context.close();
 }
@@ -137,39 +160,33 @@ SCSAPI_VOID Telemetry::pause_callback(const scs_event_t event, const void *const
     static_cast<Telemetry *>(context)->pause();
 }
 
-SCSAPI_VOID Telemetry::channel_update(const scs_string_t channel, const scs_u32_t index, const scs_value_t *const value, const scs_context_t context) {
-    Telemetry* self = static_cast<Telemetry *>(context);
-    auto response = self->message_builder.getRoot<Response>();
-    auto telemetry = response.getData().getTelemetry();
-
-    if (string(SCS_TELEMETRY_TRUCK_CHANNEL_world_placement) == channel) {
-        Helper::set(telemetry.getWorldPlacement(), value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_local_linear_velocity) == channel) {
-        Helper::set(telemetry.getLocalLinearVelocity(), value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_local_angular_velocity) == channel) {
-        Helper::set(telemetry.getLocalAngularVelocity(), value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_speed) == channel) {
-        telemetry.setSpeed(value->value_float.value);
-    }
-
-    if (string(SCS_TELEMETRY_TRUCK_CHANNEL_effective_steering) == channel) {
-        telemetry.setEffectiveSteering(value->value_float.value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_effective_throttle) == channel) {
-        telemetry.setEffectiveThrottle(value->value_float.value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_effective_brake) == channel) {
-        telemetry.setEffectiveBrake(value->value_float.value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_parking_brake) == channel) {
-        telemetry.setParkingBrake(value->value_bool.value);
+SCSAPI_VOID Telemetry::channel_update(const scs_string_t name, const scs_u32_t index, const scs_value_t *const update, const scs_context_t context) {
+    auto channel = static_cast<channel_t *>(context);
+    // Every frame starts with zeroed telemetry, so skipped frames repeat the last sampled value instead of a false 0
+    if (channel->frame++ % channel->decimation == 0 && update != nullptr) {
+        channel->last = *update;
+        channel->sampled = true;
     }
+    if (!channel->sampled) return;
+    const scs_value_t *const value = &channel->last;
+    auto response = channel->telemetry->message_builder.getRoot<Response>();
+    auto telemetry = response.getData().getTelemetry();
 
-    if (string(SCS_TELEMETRY_TRUCK_CHANNEL_wear_engine) == channel) {
-        telemetry.setWearEngine(value->value_float.value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_wear_transmission) == channel) {
-        telemetry.setWearTransmission(value->value_float.value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_wear_cabin) == channel) {
-        telemetry.setWearCabin(value->value_float.value);
-    } else if (string(SCS_TELEMETRY_TRUCK_CHANNEL_wear_chassis) == channel) {
-        telemetry.setWearChassis(value->value_float.value);
+    switch (channel->id) {
+        case Request::Channel::WORLD_PLACEMENT: Helper::set(telemetry.getWorldPlacement(), value); break;
+        case Request::Channel::LOCAL_LINEAR_VELOCITY: Helper::set(telemetry.getLocalLinearVelocity(), value); break;
+        case Request::Channel::LOCAL_ANGULAR_VELOCITY: Helper::set(telemetry.getLocalAngularVelocity(), value); break;
+        case Request::Channel::SPEED: telemetry.setSpeed(value->value_float.value); break;
+
+        case Request::Channel::EFFECTIVE_STEERING: telemetry.setEffectiveSteering(value->value_float.value); break;
+        case Request::Channel::EFFECTIVE_THROTTLE: telemetry.setEffectiveThrottle(value->value_float.value); break;
+        case Request::Channel::EFFECTIVE_BRAKE: telemetry.setEffectiveBrake(value->value_float.value); break;
+        case Request::Channel::PARKING_BRAKE: telemetry.setParkingBrake(value->value_bool.value); break;
+
+        case Request::Channel::WEAR_ENGINE: telemetry.setWearEngine(value->value_float.value); break;
+        case Request::Channel::WEAR_TRANSMISSION: telemetry.setWearTransmission(value->value_float.value); break;
+        case Request::Channel::WEAR_CABIN: telemetry.setWearCabin(value->value_float.value); break;
+        case Request::Channel::WEAR_CHASSIS: telemetry.setWearChassis(value->value_float.value); break;
     }
 }
 
@@ -226,11 +243,11 @@ Telemetry::capnp_socket_t::capnp_socket_t(context_t& context, int type, const Te
     telemetry(telemetry)
 {/*   ¯\(°_o)/¯   */}
 
-size_t Telemetry::capnp_socket_t::send(capnp::MessageBuilder &message) {
+size_t Telemetry::capnp_socket_t::send(capnp::MessageBuilder &message, int flags) {
     try {
         auto words = capnp::messageToFlatArray(message);
         auto bytes = words.asBytes();
-        return socket_t::send(bytes.begin(), bytes.size(), 0);
+        return socket_t::send(bytes.begin(), bytes.size(), flags);
     } catch (zmq::error_t &error) {
         this->telemetry.log("[autodrome] : error during zmq recv(...)");
         return 0;
@@ -249,12 +266,180 @@ unique_ptr<message_t> Telemetry::capnp_socket_t::recv() {
 }
 
 
+Telemetry::shared_memory_t::shared_memory_t(const Telemetry& telemetry) :
+    telemetry(telemetry), segment(nullptr)
+{/*   ¯\(°_o)/¯   */}
+
+bool Telemetry::shared_memory_t::open(const string& path) {
+    int descriptor = ::open(path.c_str(), O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (descriptor < 0 || ftruncate(descriptor, sizeof(Segment)) != 0) {
+        this->telemetry.log("[autodrome] : unable to create shared memory file '" + path + "'", SCS_LOG_TYPE_error);
+        return false;
+    }
+    void* address = mmap(nullptr, sizeof(Segment), PROT_READ | PROT_WRITE, MAP_SHARED, descriptor, 0);
+    ::close(descriptor);
+    if (address == MAP_FAILED) {
+        this->telemetry.log("[autodrome] : unable to map shared memory file '" + path + "'", SCS_LOG_TYPE_error);
+        return false;
+    }
+    this->segment = static_cast<Segment*>(address);
+    return true;
+}
+
+void Telemetry::shared_memory_t::write(Response::Reader response) {
+    if (this->segment == nullptr) return;
+    Segment& segment = *this->segment;
+
+    // Odd sequence number tells readers that the write is in progress
+    segment.sequence = segment.sequence + 1;
+    atomic_thread_fence(memory_order_release);
+
+    auto event = static_cast<uint16_t>(response.getEvent());
+    segment.event = event;
+    segment.events[event] += 1;
+    if (response.getData().isTelemetry()) {
+        auto telemetry = response.getData().getTelemetry();
+        segment.telemetry.render_time = telemetry.getRenderTime();
+        segment.telemetry.simulation_time = telemetry.getSimulationTime();
+        segment.telemetry.paused_simulation_time = telemetry.getPausedSimulationTime();
+
+        auto world_placement = telemetry.getWorldPlacement();
+        segment.telemetry.world_placement.x = world_placement.getPosition().getX();
+        segment.telemetry.world_placement.y = world_placement.getPosition().getY();
+        segment.telemetry.world_placement.z = world_placement.getPosition().getZ();
+        segment.telemetry.world_placement.heading = world_placement.getOrientation().getHeading();
+        segment.telemetry.world_placement.pitch = world_placement.getOrientation().getPitch();
+        segment.telemetry.world_placement.roll = world_placement.getOrientation().getRoll();
+        segment.telemetry.local_linear_velocity.x = telemetry.getLocalLinearVelocity().getX();
+        segment.telemetry.local_linear_velocity.y = telemetry.getLocalLinearVelocity().getY();
+        segment.telemetry.local_linear_velocity.z = telemetry.getLocalLinearVelocity().getZ();
+        segment.telemetry.local_angular_velocity.x = telemetry.getLocalAngularVelocity().getX();
+        segment.telemetry.local_angular_velocity.y = telemetry.getLocalAngularVelocity().getY();
+        segment.telemetry.local_angular_velocity.z = telemetry.getLocalAngularVelocity().getZ();
+        segment.telemetry.speed = telemetry.getSpeed();
+
+        segment.telemetry.effective_steering = telemetry.getEffectiveSteering();
+        segment.telemetry.effective_throttle = telemetry.getEffectiveThrottle();
+        segment.telemetry.effective_brake = telemetry.getEffectiveBrake();
+        segment.telemetry.parking_brake = telemetry.getParkingBrake();
+
+        segment.telemetry.wear_engine = telemetry.getWearEngine();
+        segment.telemetry.wear_transmission = telemetry.getWearTransmission();
+        segment.telemetry.wear_cabin = telemetry.getWearCabin();
+        segment.telemetry.wear_chassis = telemetry.getWearChassis();
+    }
+
+    atomic_thread_fence(memory_order_release);
+    segment.sequence = segment.sequence + 1;
+}
+
+void Telemetry::shared_memory_t::close() {
+    if (this->segment == nullptr) return;
+    munmap(this->segment, sizeof(Segment));
+    this->segment = nullptr;
+}
+
+
+void Telemetry::reply() {
+    this->reply(this->message_builder);
+}
+
+void Telemetry::reply(capnp::MessageBuilder& builder) {
+    switch (this->transport) {
+        case Transport::STREAM:
+            // PUB socket never waits for subscribers and drops messages once the high-water mark is reached
+            this->data_socket.send(builder, ZMQ_DONTWAIT);
+            break;
+        case Transport::MEMORY:
+            this->data_memory.write(builder.getRoot<Response>().asReader());
+            break;
+        case Transport::REQUEST: {
+            auto request = this->data_socket.recv();
+            // Clients send the same request every time, so it's only parsed when the subscription changes
+            bool changed = request->size() != this->subscription.size() ||
+                           memcmp(request->data(), this->subscription.data(), request->size()) != 0;
+            if (changed && request->size() > 0) {
+                this->subscription.assign(static_cast<const char*>(request->data()), request->size());
+                auto words = kj::heapArray<capnp::word>((request->size() + sizeof(capnp::word) - 1) / sizeof(capnp::word));
+                memcpy(words.begin(), request->data(), request->size());
+                capnp::FlatArrayMessageReader reader(words);
+                this->subscribe(reader.getRoot<Request>());
+            }
+            this->data_socket.send(builder);
+            break;
+        }
+    }
+}
+
+void Telemetry::collect(Response::Telemetry::Reader telemetry) {
+    if (!this->batch_builder) {
+        // Single segment large enough for the whole batch lets the Python decoder walk it without far pointers
+        auto words = 32 * (this->batch_size + 1);
+        this->batch_builder = unique_ptr<capnp::MallocMessageBuilder>(new capnp::MallocMessageBuilder(words));
+        auto response = this->batch_builder->initRoot<Response>();
+        response.setEvent(Response::Event::FRAME_END);
+        response.getData().initBatch(this->batch_size);
+        this->batch_count = 0;
+    }
+    auto batch = this->batch_builder->getRoot<Response>().getData().getBatch();
+    batch.setWithCaveats(this->batch_count++, telemetry);
+    if (this->batch_count >= batch.size()) {
+        this->flush();
+    }
+}
+
+void Telemetry::flush() {
+    if (!this->batch_builder) return;
+
+    // Partial batch is sent before lifecycle events and shortened to the collected frames
+    auto data = this->batch_builder->getRoot<Response>().getData();
+    auto batch = data.disownBatch();
+    batch.truncate(this->batch_count);
+    data.adoptBatch(kj::mv(batch));
+    this->reply(*this->batch_builder);
+    this->batch_builder.reset();
+}
+
+void Telemetry::subscribe(Request::Reader request) {
+    if (this->register_for_channel == nullptr) return;
+
+    this->batch_size = max<uint16_t>(request.getBatch(), 1);
+    auto subscriptions = request.getChannels();
+    for (auto& channel : this->channels) {
+        channel.decimation = subscriptions.size() == 0 ? 1 : 0;
+        for (auto subscription : subscriptions) {
+            if (subscription.getChannel() == channel.id) {
+                channel.decimation = max<uint16_t>(subscription.getDecimation(), 1);
+            }
+        }
+        if (channel.decimation > 0 && !channel.registered) {
+            channel.registered = this->register_channel(channel);
+        }
+        if (channel.decimation == 0 && channel.registered) {
+            this->unregister_channel(channel);
+        }
+    }
+}
+
+
 void Telemetry::log(const string& message, const scs_log_type_t type) const {
     if (!this->print) return;
     this->print(type, message.c_str());
 }
 
 
+Telemetry::Transport Telemetry::check_transport() {
+    const char* mode = getenv(Bind::MODE->cStr());
+    if (mode != nullptr && Mode::STREAM.get() == mode) return Transport::STREAM;
+    if (mode != nullptr && Mode::MEMORY.get() == mode) return Transport::MEMORY;
+    return Transport::REQUEST;
+}
+
+string Telemetry::check_bind(const char* variable, const char* fallback) {
+    const char* value = getenv(variable);
+    return value != nullptr && *value != '\0' ? string(value) : string(fallback);
+}
+
 bool Telemetry::check_steamid() const {
     ifstream steam_appid_file("MacOS/steam_appid.txt");
     if (steam_appid_file.is_open()) {
@@ -309,11 +494,17 @@ bool Telemetry::register_event(const scs_telemetry_init_params_v100_t *const par
     return true;
 }
 
-bool Telemetry::register_channel(const scs_telemetry_init_params_v100_t *const params, const scs_string_t channel, const scs_value_type_t type, const scs_context_t context) {
-    if (params->register_for_channel(channel, SCS_U32_NIL, type, SCS_TELEMETRY_CHANNEL_FLAG_each_frame, Telemetry::channel_update, context) != SCS_RESULT_ok) {
-        string message = "[autodrome] : unable to register for scs_telemetry_t=" + string(channel) + "' channel update";
+bool Telemetry::register_channel(channel_t& channel) {
+    if (this->register_for_channel(channel.name, SCS_U32_NIL, channel.type, SCS_TELEMETRY_CHANNEL_FLAG_each_frame, Telemetry::channel_update, &channel) != SCS_RESULT_ok) {
+        string message = "[autodrome] : unable to register for scs_telemetry_t=" + string(channel.name) + "' channel update";
         this->log(message, SCS_LOG_TYPE_error);
         return false;
     }
     return true;
 }
+
+void Telemetry::unregister_channel(channel_t& channel) {
+    this->unregister_from_channel(channel.name, SCS_U32_NIL, channel.type);
+    channel.registered = false;
+    channel.sampled = false;
+}
@@ -1,5 +1,14 @@
+#include <array>
+#include <memory>
+#include <atomic>
 #include <string>
 #include <fstream>
+#include <cstdlib>
+#include <cstring>
+#include <algorithm>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
 
 #include <zmq.hpp>
 #include <capnp/message.h>
@@ -45,25 +54,89 @@ protected:
         static void set(FVector::Builder builder, const scs_value_t *const value);
     };
 
+    enum class Transport { REQUEST, STREAM, MEMORY };
+
+    // Registered truck channel passed as the context of channel_update(...) so no channel names are compared
+    struct channel_t {
+        Telemetry* telemetry;
+        Request::Channel id;
+        scs_string_t name;
+        scs_value_type_t type;
+        uint16_t decimation;
+        uint32_t frame;
+        bool registered;
+        scs_value_t last;  // Value of the last sampled frame written again on the frames skipped by decimation
+        bool sampled;
+    };
+
+#pragma pack(push, 1)
+    // Layout must match autodrome.simulator.telemetry.TelemetryMemory.Layout
+    struct Segment {
+        volatile uint32_t sequence;
+        uint16_t event;
+        uint32_t events[7];
+        struct {
+            uint64_t render_time, simulation_time, paused_simulation_time;
+            struct { double x, y, z; float heading, pitch, roll; } world_placement;
+            struct { double x, y, z; } local_linear_velocity, local_angular_velocity;
+            float speed;
+            float effective_steering, effective_throttle, effective_brake;
+            uint8_t parking_brake;
+            float wear_engine, wear_transmission, wear_cabin, wear_chassis;
+        } telemetry;
+    };
+#pragma pack(pop)
+
+    class shared_memory_t {
+    public:
+        shared_memory_t(const Telemetry& telemetry);
+        bool open(const string& path);
+        void write(Response::Reader response);
+        void close();
+    private:
+        const Telemetry& telemetry;
+        Segment* segment;
+    };
+
     class capnp_socket_t: public socket_t {
     public:
         capnp_socket_t(context_t& context, int type, const Telemetry& telemetry);
-        size_t send(capnp::MessageBuilder &message);
+        size_t send(capnp::MessageBuilder &message, int flags=0);
         unique_ptr<message_t> recv();
     private:
         const Telemetry& telemetry;
     };
 
+    const Transport transport;
+    const string address;
+    const string memory;
     context_t zmq_context;
     capnp_socket_t data_socket;
+    shared_memory_t data_memory;
     capnp::MallocMessageBuilder message_builder;
 
+    array<channel_t, 12> channels;
+    string subscription;
+    uint16_t batch_size;
+    uint16_t batch_count;
+    unique_ptr<capnp::MallocMessageBuilder> batch_builder;
+    scs_telemetry_register_for_channel_t register_for_channel;
+    scs_telemetry_unregister_from_channel_t unregister_from_channel;
+
     bool paused;
     const scs_log_t print;
 
+    void reply();
+    void reply(capnp::MessageBuilder& builder);
+    void collect(Response::Telemetry::Reader telemetry);
+    void flush();
+    void subscribe(Request::Reader request);
     void log(const string& message, const scs_log_type_t type=SCS_LOG_TYPE_message) const;
+    static Transport check_transport();
+    static string check_bind(const char* variable, const char* fallback);
     bool check_steamid() const;
     bool check_version(const scs_telemetry_init_params_v100_t *const params, const scs_u32_t version) const;
     bool register_event(const scs_telemetry_init_params_v100_t *const params, const scs_event_t event, const scs_telemetry_event_callback_t callback);
-    bool register_channel(const scs_telemetry_init_params_v100_t *const params, const scs_string_t channel, const scs_value_type_t type, const scs_context_t context);
+    bool register_channel(channel_t& channel);
+    void unregister_channel(channel_t& channel);
 };
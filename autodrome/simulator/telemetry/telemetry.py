@@ -2,6 +2,8 @@ import zmq
 import math
 import time
 import capnp
+import unittest
+import threading
 from pathlib import Path
 
 
@@ -11,37 +13,187 @@ class Telemetry:
     Response = Message.Response
     Event = Response.Event
     Data = Response.Telemetry
+    Mode = Message.Mode.request
 
-    def __init__(self, address: str=Message.Bind.address):
+    def __init__(self, address: str=Message.Bind.address, channels: dict=None, batch: int=1):
         self.address = address
-        ctx = zmq.Context()
-        self.socket = ctx.socket(zmq.REQ)
-        self.socket.connect(Telemetry.Message.Bind.address)
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.connect(address)
         self.poller = zmq.Poller()
         self.poller.register(self.socket, flags=zmq.POLLIN)
+        self.skipped = 0
+        self.last = None
 
-        request = self.Request.new_message()
-        request_bytes = request.to_bytes()
-        self.socket.send(request_bytes)
+        self.request_bytes = self.subscribe(channels, batch)
+        self.socket.send(self.request_bytes)
 
-    def recv(self) -> Response:
-        reply_bytes = self.socket.recv()
-        reply = self.Response.from_bytes(reply_bytes)
+    @classmethod
+    def subscribe(cls, channels: dict=None, batch: int=1) -> bytes:
+        """ Serialize request subscribing to truck channels with decimation (i.e. {'worldPlacement': 1, 'wearCabin': 10})
+        The plugin registers and sends only the subscribed channels, all of them if channels is None. Batch of more than
+        one frame makes the plugin collect frames into a single frameEnd message and skip frameStart messages. """
+        request = cls.Request.new_message()
+        request.batch = batch
+        if channels:
+            subscriptions = request.init('channels', len(channels))
+            for subscription, (channel, decimation) in zip(subscriptions, channels.items()):
+                subscription.channel = channel
+                subscription.decimation = decimation
+        return request.to_bytes()
+
+    @classmethod
+    def decode(cls, reply_bytes: bytes) -> Response:
+        """ Deserialize raw bytes of a message sent by the telemetry plugin """
+        with cls.Response.from_bytes(reply_bytes) as reply:
+            return reply
+
+    def poll(self, timeout: float) -> bool:
+        """ Wait at most timeout seconds for the next message and return whether it's ready """
+        return bool(self.poller.poll(timeout=None if math.isinf(timeout) else timeout * 1000))
 
-        request = self.Request.new_message()
-        request_bytes = request.to_bytes()
-        self.socket.send(request_bytes)
+    def recv(self) -> Response:
+        reply = self.decode(self.recv_bytes())
+        if reply.event == Telemetry.Event.frameEnd:
+            self.last = self.frames(reply)[-1]
         return reply
 
+    def recv_bytes(self) -> bytes:
+        """ Receive raw bytes of the next message without deserializing them """
+        reply_bytes = self.socket.recv()
+        self.socket.send(self.request_bytes)
+        return reply_bytes
+
     def wait(self, event: Event, timeout: float=math.inf) -> Response:
-        reply, deadline = None, time.time() + timeout
-        while time.time() < deadline:
-            if self.poller.poll(timeout=5):
-                reply = self.recv()
-            if reply and reply.event == event:
-                break
-        return reply
+        """ Block until a message with the event arrives and count the skipped ones or return None after timeout
+        Event None receives all messages until timeout and returns the last one. """
+        reply, deadline = None, time.monotonic() + timeout
+        self.skipped = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.poll(timeout=remaining):
+                return reply if event is None else None
+            if reply is not None:
+                self.skipped += 1
+            reply = self.recv()
+            if event is not None and reply.event == event:
+                return reply
 
     def data(self) -> Data:
+        """ Wait for the next frame and return its telemetry data or the newest frame of a batch """
+        reply = self.wait(event=Telemetry.Event.frameEnd)
+        return self.frames(reply)[-1]
+
+    def batch(self) -> list:
+        """ Wait for the next frameEnd message and return telemetry data of all frames it carries """
         reply = self.wait(event=Telemetry.Event.frameEnd)
-        return reply.data.telemetry
+        return self.frames(reply)
+
+    def latest(self) -> Data:
+        """ Receive the messages that are ready without blocking and return telemetry of the newest frame received
+        so far or None if there was none """
+        while self.poll(timeout=0):
+            self.recv()
+        return self.last
+
+    @staticmethod
+    def frames(reply: Response) -> list:
+        """ Telemetry data of all frames in the message """
+        if reply.data.which() == 'batch':
+            return reply.data.batch
+        return [reply.data.telemetry]
+
+    def close(self):
+        """ Close the socket without waiting for unsent requests and release the context if it's owned """
+        self.socket.close(linger=0)
+        if self.context is not None:
+            self.context.term()
+
+
+# region Unit Tests
+
+
+class TestTelemetry(unittest.TestCase):
+    Lifecycle = ['load'] + 5 * ['config'] + ['start'] + 3 * ['frameStart', 'frameEnd'] + ['pause']
+
+    def setUp(self):
+        self.plugin = zmq.Context.instance().socket(zmq.REP)
+        self.plugin.bind(Telemetry.Message.Bind.address)
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.thread.join()
+        self.plugin.close(linger=0)
+
+    def serve(self, events: list):
+        """ Reply to telemetry requests with a sequence of events in a background thread like the plugin does """
+        def reply():
+            for render_time, event in enumerate(events):
+                self.plugin.recv()
+                response = Telemetry.Response.new_message()
+                response.event = event
+                if event == 'frameEnd':
+                    response.data.init('telemetry').renderTime = render_time
+                else:
+                    response.data.none = None
+                self.plugin.send(response.to_bytes())
+        self.thread = threading.Thread(target=reply)
+        self.thread.start()
+
+    def test_wait(self):
+        self.serve(self.Lifecycle)
+        telemetry = Telemetry()
+        self.assertEqual(telemetry.wait(Telemetry.Event.start).event, Telemetry.Event.start)
+        self.assertEqual(telemetry.skipped, 6)
+        self.assertEqual(telemetry.data().renderTime, 8)
+        self.assertEqual(telemetry.skipped, 1)
+        self.assertEqual(telemetry.wait(None, timeout=0.1).event, Telemetry.Event.pause)
+        self.assertEqual(telemetry.skipped, 4)
+
+    def test_subscribe(self):
+        telemetry = Telemetry(channels={'worldPlacement': 1, 'wearCabin': 10})
+        with Telemetry.Request.from_bytes(self.plugin.recv()) as request:
+            subscriptions = [(subscription.channel, subscription.decimation) for subscription in request.channels]
+        self.assertEqual(subscriptions, [('worldPlacement', 1), ('wearCabin', 10)])
+        with Telemetry.Request.from_bytes(Telemetry.subscribe()) as request:
+            self.assertEqual(len(request.channels), 0)
+
+    def test_batch(self):
+        def reply():
+            self.plugin.recv()
+            response = Telemetry.Response.new_message()
+            response.event = Telemetry.Event.frameEnd
+            for render_time, telemetry in enumerate(response.data.init('batch', 4)):
+                telemetry.renderTime = render_time
+            self.plugin.send(response.to_bytes())
+        self.thread = threading.Thread(target=reply)
+        self.thread.start()
+        telemetry = Telemetry(batch=4)
+        self.assertEqual([data.renderTime for data in telemetry.batch()], [0, 1, 2, 3])
+        with Telemetry.Request.from_bytes(telemetry.request_bytes) as request:
+            self.assertEqual(request.batch, 4)
+
+    def test_latest(self):
+        self.serve(self.Lifecycle)
+        telemetry = Telemetry()
+        telemetry.wait(Telemetry.Event.pause, timeout=1)
+        self.assertEqual(telemetry.latest().renderTime, 12)
+
+    def test_close(self):
+        telemetry = Telemetry()
+        telemetry.close()
+        self.assertTrue(telemetry.socket.closed)
+        self.assertTrue(telemetry.context.closed)
+
+    def test_timeout(self):
+        self.serve(self.Lifecycle)
+        telemetry = Telemetry()
+        start = time.monotonic()
+        self.assertIsNone(telemetry.wait(Telemetry.Event.unload, timeout=0.1))
+        self.assertGreater(time.monotonic() - start, 0.09)
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(telemetry.skipped, len(self.Lifecycle) - 1)
+
+
+# endregion
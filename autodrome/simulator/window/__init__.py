@@ -3,5 +3,7 @@ import platform
 
 if platform.system() == 'Darwin':
     from .darwin import WindowDarwin as Window
+elif platform.system() == 'Linux':
+    from .linux import WindowLinux as Window
 else:
     from .window import Window
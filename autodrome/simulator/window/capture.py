@@ -0,0 +1,184 @@
+import math
+import time
+import zlib
+import unittest
+import threading
+import collections
+import numpy as np
+
+from .window import Window
+
+
+Frame = collections.namedtuple('Frame', ['pixels', 'renderTime', 'timestamp', 'checksum'])
+
+
+def checksum(pixels: np.ndarray, samples: int=4096) -> int:
+    """ Cheap checksum of evenly spaced samples of the pixels that tells apart consecutive rendered frames """
+    flat = pixels.reshape(-1)
+    return zlib.crc32(flat[::max(flat.size // samples, 1)].tobytes())
+
+
+class WindowCapture:
+    """ Background thread capturing window content into a ring of preallocated buffers
+    Triple buffering keeps one buffer held by the consumer, one with the newest completed frame and at least one free
+    for the thread to write into, so neither side ever waits for the other. Every frame is tagged with the latest
+    renderTime known when the capture started, a monotonic timestamp of the start and a sampled checksum. Besides the
+    regular rate, a capture starts right away once a newer renderTime is requested. An observation callable like
+    autodrome.envs.Observation preprocesses every capture on the thread straight into the ring buffers, reading the
+    pixels in place if the window captures without copying. """
+    Buffers = 3
+    Rate = 120.0
+
+    def __init__(self, window: Window, buffers: int=Buffers, rate: float=Rate, observation: callable=None):
+        self.window, self.rate, self.observation = window, rate, observation
+        empty = window.empty if observation is None else lambda: observation.empty(window.shape)
+        self.scratch = None if observation is None or window.ZeroCopy else window.empty()
+        self.buffers = [empty() for buffer in range(max(buffers, 3))]
+        self.render_times = np.zeros(len(self.buffers), dtype=np.int64)
+        self.timestamps = np.zeros(len(self.buffers), dtype=np.float64)
+        self.checksums = np.zeros(len(self.buffers), dtype=np.uint32)
+        self.newest, self.held = None, None
+        self.render_time = 0
+        self.captured = 0
+        self.ready = threading.Condition()
+        self.stopping = threading.Event()
+        self.trigger = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """ Start capturing in a background thread """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop capturing and wait for the thread to finish """
+        self.stopping.set()
+        self.trigger.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def run(self):
+        """ Capture frames into free buffers at the rate or when triggered until stopped """
+        period, deadline = 1.0 / self.rate, time.monotonic()
+        while not self.stopping.is_set():
+            self.trigger.wait(timeout=max(deadline - time.monotonic(), 0))
+            self.trigger.clear()
+            if self.stopping.is_set():
+                break
+            with self.ready:
+                index = next(index for index in range(len(self.buffers)) if index not in (self.newest, self.held))
+            render_time, timestamp = self.render_time, time.monotonic()
+            deadline = timestamp + period
+            if not self.grab(self.buffers[index]):  # Minimized window
+                continue
+            frame_checksum = checksum(self.buffers[index])
+            with self.ready:
+                self.render_times[index], self.timestamps[index] = render_time, timestamp
+                self.checksums[index] = frame_checksum
+                self.newest = index
+                self.captured += 1
+                self.ready.notify_all()
+
+    def grab(self, out: np.ndarray) -> bool:
+        """ Capture the window into the buffer, through the observation preprocessing if there's one """
+        if self.observation is None:
+            return self.window.capture(out=out) is not None
+        pixels = self.window.capture(out=self.scratch)  # View of the window pixels if there's no scratch
+        if pixels is None:
+            return False
+        self.observation(pixels, out=out)
+        return True
+
+    def request(self, render_time: int):
+        """ Announce a newer renderTime and start capturing right away """
+        self.render_time = render_time
+        self.trigger.set()
+
+    def latest(self, render_time: int=0, since: float=-math.inf, timeout: float=None) -> Frame:
+        """ Hand over the newest completed frame, its buffer isn't overwritten until the next call
+        Blocks until there's a frame captured no earlier than the renderTime and after the monotonic time since.
+        Returns None if that doesn't happen before the timeout. """
+        def ready() -> bool:
+            return self.newest is not None and self.render_times[self.newest] >= render_time and \
+                self.timestamps[self.newest] > since
+        with self.ready:
+            if not self.ready.wait_for(ready, timeout=timeout):
+                return None
+            self.held = index = self.newest
+            return Frame(self.buffers[index], int(self.render_times[index]), float(self.timestamps[index]),
+                         int(self.checksums[index]))
+
+
+# region Unit Tests
+
+
+class TestWindowCapture(unittest.TestCase):
+
+    class WindowCounter(Window):
+        """ Window with content that counts the captures and takes a while to capture """
+        def __init__(self):
+            super().__init__(pid=None, timeout=0)
+            self.shape = (60, 100, 3)
+            self.count = 0
+
+        def capture(self, out: np.ndarray=None) -> np.array:
+            time.sleep(0.005)
+            self.count += 1
+            out = self.empty() if out is None else out
+            out.fill(self.count)
+            return out
+
+    def test_latest(self):
+        window = self.WindowCounter()
+        with WindowCapture(window, rate=1000) as capture:
+            capture.render_time = 42
+            first = capture.latest(timeout=1)
+            time.sleep(0.05)
+            second = capture.latest()
+        self.assertIsNot(first.pixels, second.pixels)
+        self.assertGreater(second.pixels[0, 0, 0], first.pixels[0, 0, 0])
+        self.assertGreater(second.timestamp, first.timestamp)
+        self.assertEqual(second.renderTime, 42)
+        self.assertTrue(second.pixels.flags.c_contiguous)
+        self.assertNotEqual(second.checksum, first.checksum)
+
+    def test_request(self):
+        window = self.WindowCounter()
+        with WindowCapture(window, rate=1) as capture:
+            capture.latest(timeout=1)
+            start = time.monotonic()
+            capture.request(7)
+            frame = capture.latest(render_time=7, timeout=1)
+            self.assertLess(time.monotonic() - start, 0.5)  # Doesn't wait for the next regular capture
+        self.assertEqual(frame.renderTime, 7)
+        self.assertEqual(frame.checksum, checksum(frame.pixels))
+
+    def test_held(self):
+        window = self.WindowCounter()
+        with WindowCapture(window, rate=1000) as capture:
+            frame = capture.latest(timeout=1)
+            value = frame.pixels.copy()
+            time.sleep(0.1)
+            self.assertEqual(frame.pixels.tolist(), value.tolist())  # Held buffer isn't overwritten
+            self.assertGreater(capture.captured, 5)
+
+    def test_overlap(self):
+        window = self.WindowCounter()
+        with WindowCapture(window, rate=1000) as capture:
+            capture.latest(timeout=1)
+            start = time.monotonic()
+            for frame in range(100):
+                capture.latest()
+            seconds = time.monotonic() - start
+        self.assertLess(seconds, 0.1)  # Consumer doesn't wait for capture latency
+
+
+# endregion
@@ -38,6 +38,7 @@ class WindowDarwin(Window):
                 continue
             break
         self.window = windows[0]
+        self.capture()  # Sets the shape of the captured pixels
 
     def activate(self):
         """ Bring window to foreground """
@@ -45,8 +46,13 @@ class WindowDarwin(Window):
         activationOptions = CA.NSApplicationActivateAllWindows | CA.NSApplicationActivateIgnoringOtherApps
         runningApplication.activateWithOptions_(activationOptions)
 
-    def capture(self) -> np.array:
-        """ Capture border-less window content and return it as a raw pixel array """
+    def focused(self) -> bool:
+        """ Check whether the window is in foreground and receives keyboard input """
+        return bool(CA.NSRunningApplication.runningApplicationWithProcessIdentifier_(self.pid).isActive())
+
+    def capture(self, out: np.ndarray=None) -> np.array:
+        """ Capture border-less window content and return it as an RGB pixel array
+        Pixels are cropped and converted from BGRA into the preallocated contiguous out array in one pass. """
         screenBounds = CG.CGRectNull
         listOption = CG.kCGWindowListOptionIncludingWindow
         windowID = self.window['kCGWindowNumber']
@@ -63,8 +69,16 @@ class WindowDarwin(Window):
         dataProvider = CG.CGImageGetDataProvider(screenshot)
         rawPixels = CG.CGDataProviderCopyData(dataProvider)
         image = np.frombuffer(rawPixels, dtype=np.uint8).reshape([height, bytesPerRow // 4, 4])
+        pixels = image[self.TitleBarHeight:height, 0:width, 2::-1]
 
-        return image[self.TitleBarHeight:height, 0:width, 0:3]
+        if self.shape is None:
+            self.shape = pixels.shape
+        if pixels.shape != self.shape:
+            raise WindowDarwinError(f"Window size changed from {self.shape} to {pixels.shape}")
+        if out is None:
+            out = self.empty()
+        np.copyto(out, pixels)
+        return out
 
 
 class WindowDarwinError(Exception):
@@ -86,12 +100,15 @@ class TestWindowDarwin(unittest.TestCase):
             window = self.wait_for_gui(process, timeout=10)
             pixels = window.capture()
             process.terminate()
-        self.assertIsInstance(pixels, np.ndarray)
+        self.assertEqual(pixels.shape, window.shape)
+        self.assertEqual(pixels.dtype, np.uint8)
+        self.assertTrue(pixels.flags.c_contiguous)
 
     def test_performance(self):
         with subprocess.Popen(self.GuineaPigApplication) as process:
             window = self.wait_for_gui(process, timeout=10)
-            seconds = timeit.timeit(lambda: window.capture(), number=self.RepeatFPS)
+            out = window.empty()
+            seconds = timeit.timeit(lambda: window.capture(out=out), number=self.RepeatFPS)
             process.terminate()
         self.assertGreater(self.RepeatFPS / seconds, self.MinimumFPS)
 
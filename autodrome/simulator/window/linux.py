@@ -0,0 +1,339 @@
+import os
+import sys
+import time
+import ctypes
+import shutil
+import timeit
+import unittest
+import platform
+import threading
+import contextlib
+import subprocess
+import ctypes.util
+import numpy as np
+
+from .window import Window
+
+
+class XWindowAttributes(ctypes.Structure):
+    _fields_ = [('x', ctypes.c_int), ('y', ctypes.c_int), ('width', ctypes.c_int), ('height', ctypes.c_int),
+                ('border_width', ctypes.c_int), ('depth', ctypes.c_int), ('visual', ctypes.c_void_p),
+                ('root', ctypes.c_ulong), ('class', ctypes.c_int), ('bit_gravity', ctypes.c_int),
+                ('win_gravity', ctypes.c_int), ('backing_store', ctypes.c_int), ('backing_planes', ctypes.c_ulong),
+                ('backing_pixel', ctypes.c_ulong), ('save_under', ctypes.c_int), ('colormap', ctypes.c_ulong),
+                ('map_installed', ctypes.c_int), ('map_state', ctypes.c_int), ('all_event_masks', ctypes.c_long),
+                ('your_event_mask', ctypes.c_long), ('do_not_propagate_mask', ctypes.c_long),
+                ('override_redirect', ctypes.c_int), ('screen', ctypes.c_void_p)]
+
+
+class XImage(ctypes.Structure):
+    """ Leading fields of the XImage struct, instances are only ever allocated by Xlib """
+    _fields_ = [('width', ctypes.c_int), ('height', ctypes.c_int), ('xoffset', ctypes.c_int),
+                ('format', ctypes.c_int), ('data', ctypes.c_void_p), ('byte_order', ctypes.c_int),
+                ('bitmap_unit', ctypes.c_int), ('bitmap_bit_order', ctypes.c_int), ('bitmap_pad', ctypes.c_int),
+                ('depth', ctypes.c_int), ('bytes_per_line', ctypes.c_int), ('bits_per_pixel', ctypes.c_int)]
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [('shmseg', ctypes.c_ulong), ('shmid', ctypes.c_int), ('shmaddr', ctypes.c_void_p),
+                ('readOnly', ctypes.c_int)]
+
+
+class X11:
+    """ Minimal ctypes bindings of Xlib, the MIT-SHM extension and System V shared memory """
+    ZPixmap = 2
+    IsViewable = 2
+    AllPlanes = 0xFFFFFFFF
+    RevertToParent = 2
+    CurrentTime = 0
+    XA_CARDINAL = 6
+    IPC_PRIVATE = 0
+    IPC_CREAT = 0o1000
+    IPC_RMID = 0
+
+    ErrorHandler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+    xlib, xext, libc = None, None, None  # Loaded by the first window, the module imports without X11
+    lock = threading.RLock()  # Serializes requests of the capture thread and the main thread
+
+    @classmethod
+    def load(cls):
+        """ Load the libraries and declare the function signatures unless it's done already """
+        if cls.xlib is not None:
+            return
+        paths = {name: ctypes.util.find_library(name) for name in ('X11', 'Xext', 'c')}
+        missing = [name for name, path in paths.items() if path is None]
+        if missing:
+            raise WindowLinuxError(f"Can't find libraries {', '.join(missing)}, is X11 installed?")
+        xlib, xext = ctypes.CDLL(paths['X11']), ctypes.CDLL(paths['Xext'])
+        libc = ctypes.CDLL(paths['c'], use_errno=True)
+        xlib.XInitThreads()  # Before the first display is opened
+
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XInternAtom.restype = ctypes.c_ulong
+        xlib.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+        xlib.XQueryTree.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong),
+                                    ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.POINTER(ctypes.c_ulong)),
+                                    ctypes.POINTER(ctypes.c_uint)]
+        xlib.XGetWindowProperty.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_long,
+                                            ctypes.c_long, ctypes.c_int, ctypes.c_ulong,
+                                            ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_int),
+                                            ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_ulong),
+                                            ctypes.POINTER(ctypes.c_void_p)]
+        xlib.XGetWindowAttributes.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XWindowAttributes)]
+        xlib.XFree.argtypes = [ctypes.c_void_p]
+        xlib.XRaiseWindow.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        xlib.XSetInputFocus.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int, ctypes.c_ulong]
+        xlib.XGetInputFocus.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_int)]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XFlush.argtypes = [ctypes.c_void_p]
+        xlib.XSetErrorHandler.restype = ctypes.c_void_p
+        xlib.XDestroyImage.argtypes = [ctypes.POINTER(XImage)]
+
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo), ctypes.c_uint,
+                                         ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage), ctypes.c_int,
+                                      ctypes.c_int, ctypes.c_ulong]
+
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+        cls.xlib, cls.xext, cls.libc = xlib, xext, libc
+
+    @classmethod
+    @contextlib.contextmanager
+    def errors(cls):
+        """ Serialize the requests in the block with the other threads and ignore their X errors, the default handler
+        would terminate the process. The handler is process-wide so it's swapped under the lock too. """
+        with cls.lock:
+            previous = cls.xlib.XSetErrorHandler(cls.ignore)
+            try:
+                yield
+            finally:
+                cls.xlib.XSetErrorHandler(ctypes.c_void_p(previous))
+
+    @ErrorHandler
+    def ignore(display, event):
+        """ Default Xlib error handler terminates the process, windows can be destroyed at any time though """
+        return 0
+
+
+class WindowLinux(Window):
+    """ Window class for capture of game window content on Linux with X11
+    The window is found by the _NET_WM_PID property of the process. Content is captured with the MIT-SHM extension
+    into a shared memory image allocated once, so the X server writes pixels directly into the array returned by
+    capture(). Without an out array the returned RGB view is overwritten by the next capture. Requests are serialized
+    by X11.lock, so the window can be captured in a background thread while it's activated in another one. """
+    ZeroCopy = True
+
+    def __init__(self, pid: int, timeout: float, display: str=None):
+        """ Create a new instance from main application window of a process """
+        super().__init__(pid, timeout)
+        X11.load()
+        self.display = X11.xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise WindowLinuxError(f"Can't open X display '{display or os.environ.get('DISPLAY')}'")
+        if not X11.xext.XShmQueryExtension(self.display):
+            raise WindowLinuxError("X server doesn't support MIT-SHM extension")
+        self.image, self.shminfo, self.pixels = None, XShmSegmentInfo(), None
+
+        deadline = time.time() + timeout
+        while True:
+            with X11.errors():  # Windows in the tree can be destroyed while it's searched
+                self.window = self.find(X11.xlib.XDefaultRootWindow(self.display))
+            if self.window is not None:
+                break
+            if time.time() > deadline:
+                raise WindowLinuxError("Main process window not found")
+            time.sleep(0.1)
+        self.allocate()
+
+    def find(self, window: int) -> int:
+        """ Search the window tree depth-first for a viewable window owned by the process """
+        if self.owner(window) == self.pid:
+            attributes = XWindowAttributes()
+            X11.xlib.XGetWindowAttributes(self.display, window, ctypes.byref(attributes))
+            if attributes.map_state == X11.IsViewable and attributes.width > 1 and attributes.height > 1:
+                return window
+        root, parent = ctypes.c_ulong(), ctypes.c_ulong()
+        children, count = ctypes.POINTER(ctypes.c_ulong)(), ctypes.c_uint()
+        if not X11.xlib.XQueryTree(self.display, window, ctypes.byref(root), ctypes.byref(parent),
+                                   ctypes.byref(children), ctypes.byref(count)):
+            return None
+        try:
+            for index in range(count.value):
+                found = self.find(children[index])
+                if found is not None:
+                    return found
+        finally:
+            if children:
+                X11.xlib.XFree(children)
+        return None
+
+    def owner(self, window: int) -> int:
+        """ Process ID from the _NET_WM_PID property of the window or None if it's not set """
+        atom = X11.xlib.XInternAtom(self.display, b'_NET_WM_PID', True)
+        actual_type, actual_format = ctypes.c_ulong(), ctypes.c_int()
+        items, remaining, value = ctypes.c_ulong(), ctypes.c_ulong(), ctypes.c_void_p()
+        status = X11.xlib.XGetWindowProperty(self.display, window, atom, 0, 1, False, X11.XA_CARDINAL,
+                                             ctypes.byref(actual_type), ctypes.byref(actual_format),
+                                             ctypes.byref(items), ctypes.byref(remaining), ctypes.byref(value))
+        if status != 0 or not value.value:
+            return None
+        try:
+            return ctypes.cast(value, ctypes.POINTER(ctypes.c_ulong))[0] if items.value == 1 else None
+        finally:
+            X11.xlib.XFree(value)
+
+    def allocate(self):
+        """ Create the shared memory image matching the current window size and depth """
+        attributes = XWindowAttributes()
+        X11.xlib.XGetWindowAttributes(self.display, self.window, ctypes.byref(attributes))
+        self.image = X11.xext.XShmCreateImage(self.display, attributes.visual, attributes.depth, X11.ZPixmap,
+                                              None, ctypes.byref(self.shminfo), attributes.width, attributes.height)
+        if not self.image or self.image.contents.bits_per_pixel != 32:
+            raise WindowLinuxError("Window doesn't have a 32 bits per pixel visual")
+        width, height = self.image.contents.width, self.image.contents.height
+        size = self.image.contents.bytes_per_line * height
+
+        self.shminfo.shmid = X11.libc.shmget(X11.IPC_PRIVATE, size, X11.IPC_CREAT | 0o600)
+        if self.shminfo.shmid < 0:
+            raise WindowLinuxError(f"Can't allocate shared memory: {os.strerror(ctypes.get_errno())}")
+        self.shminfo.shmaddr = self.image.contents.data = X11.libc.shmat(self.shminfo.shmid, None, 0)
+        self.shminfo.readOnly = False
+        with X11.errors():
+            X11.xext.XShmAttach(self.display, ctypes.byref(self.shminfo))
+            X11.xlib.XSync(self.display, False)
+        X11.libc.shmctl(self.shminfo.shmid, X11.IPC_RMID, None)  # Segment is freed once both sides detach
+
+        buffer = (ctypes.c_uint8 * size).from_address(self.shminfo.shmaddr)
+        raw = np.frombuffer(buffer, dtype=np.uint8).reshape([height, self.image.contents.bytes_per_line // 4, 4])
+        self.pixels = raw[:, 0:width, 2::-1]
+        self.shape = self.pixels.shape
+
+    def release(self):
+        """ Detach and free the shared memory image """
+        if self.image:
+            X11.xext.XShmDetach(self.display, ctypes.byref(self.shminfo))
+            X11.xlib.XSync(self.display, False)
+            self.image.contents.data = None  # Memory belongs to the segment, XDestroyImage would free() it
+            X11.xlib.XDestroyImage(self.image)
+            X11.libc.shmdt(ctypes.c_void_p(self.shminfo.shmaddr))
+        self.image, self.pixels = None, None
+
+    def activate(self):
+        """ Bring window to foreground """
+        with X11.errors():  # Focus can't be set on a window that isn't viewable
+            X11.xlib.XRaiseWindow(self.display, self.window)
+            X11.xlib.XSetInputFocus(self.display, self.window, X11.RevertToParent, X11.CurrentTime)
+            X11.xlib.XSync(self.display, False)
+
+    def focused(self) -> bool:
+        """ Check whether the window is in foreground and receives keyboard input """
+        focus, revert = ctypes.c_ulong(), ctypes.c_int()
+        with X11.lock:
+            X11.xlib.XGetInputFocus(self.display, ctypes.byref(focus), ctypes.byref(revert))
+        return focus.value == self.window
+
+    def capture(self, out: np.ndarray=None) -> np.array:
+        """ Capture border-less window content into the shared memory image and return an RGB view of its pixels
+        Pixels are converted from BGRX into the preallocated contiguous out array in one pass if it's given. """
+        with X11.errors():
+            captured = X11.xext.XShmGetImage(self.display, self.window, self.image, 0, 0, X11.AllPlanes)
+        if not captured:
+            raise WindowLinuxError("Can't capture window content, it was resized or unmapped")
+        if out is None:
+            return self.pixels
+        np.copyto(out, self.pixels)
+        return out
+
+    def __del__(self):
+        if getattr(self, 'display', None):
+            with X11.lock:
+                self.release()
+                X11.xlib.XCloseDisplay(self.display)
+                self.display = None
+
+
+class WindowLinuxError(Exception):
+    """ Exception that is raised in case of a failed WindowLinux class instance """
+    pass
+
+
+# region Unit Tests
+
+
+@unittest.skipUnless(platform.system() == 'Linux' and shutil.which('Xvfb'), "Only for Linux with Xvfb")
+class TestWindowLinux(unittest.TestCase):
+    Display = ':97'
+    GuineaPigApplication = [sys.executable, '-c', """if True:
+        import os, ctypes, ctypes.util, time
+        xlib = ctypes.CDLL(ctypes.util.find_library('X11'))
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XDefaultRootWindow.restype = xlib.XCreateSimpleWindow.restype = xlib.XInternAtom.restype = ctypes.c_ulong
+        xlib.XDefaultRootWindow.argtypes = xlib.XFlush.argtypes = [ctypes.c_void_p]
+        xlib.XCreateSimpleWindow.argtypes = [ctypes.c_void_p, ctypes.c_ulong] + 5 * [ctypes.c_int] + 2 * [ctypes.c_ulong]
+        xlib.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+        xlib.XChangeProperty.argtypes = [ctypes.c_void_p] + 3 * [ctypes.c_ulong] + 2 * [ctypes.c_int] + [ctypes.c_void_p, ctypes.c_int]
+        xlib.XMapWindow.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        display = xlib.XOpenDisplay(None)
+        window = xlib.XCreateSimpleWindow(display, xlib.XDefaultRootWindow(display), 0, 0, 640, 480, 0, 0, 0x336699)
+        pid = ctypes.c_ulong(os.getpid())
+        xlib.XChangeProperty(display, window, xlib.XInternAtom(display, b'_NET_WM_PID', False), 6, 32, 0, ctypes.byref(pid), 1)
+        xlib.XMapWindow(display, window)
+        xlib.XFlush(display)
+        time.sleep(60)
+    """]
+    RepeatFPS = 100
+    MinimumFPS = 50
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = subprocess.Popen(['Xvfb', cls.Display, '-screen', '0', '1024x768x24'])
+        cls.environment = dict(os.environ, DISPLAY=cls.Display)
+        time.sleep(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def test_capture(self):
+        with subprocess.Popen(self.GuineaPigApplication, env=self.environment) as process:
+            window = self.wait_for_gui(process, timeout=10)
+            pixels = window.capture()
+            process.terminate()
+        self.assertEqual(pixels.shape, (480, 640, 3))
+        self.assertEqual(pixels[240, 320].tolist(), [0x33, 0x66, 0x99])
+
+    def test_performance(self):
+        with subprocess.Popen(self.GuineaPigApplication, env=self.environment) as process:
+            window = self.wait_for_gui(process, timeout=10)
+            pixels, out = window.capture(), window.empty()
+            seconds = timeit.timeit(lambda: window.capture(out=out), number=self.RepeatFPS)
+            self.assertIs(window.capture(), pixels)
+            self.assertEqual(out.tolist(), pixels.tolist())
+            process.terminate()
+        self.assertGreater(self.RepeatFPS / seconds, self.MinimumFPS)
+
+    def wait_for_gui(self, process: subprocess.Popen, timeout: int=0):
+        deadline = time.time() + timeout
+        while time.time() <= deadline:
+            with contextlib.suppress(WindowLinuxError):
+                return WindowLinux(pid=process.pid, timeout=0.5, display=self.Display)
+        process.terminate()
+        raise TimeoutError("Timeout while waiting for application window")
+
+
+# endregion
@@ -0,0 +1,307 @@
+import io
+import os
+import json
+import zlib
+import time
+import struct
+import tempfile
+import unittest
+import threading
+import collections
+import numpy as np
+import multiprocessing
+from pathlib import Path
+
+
+class Codec:
+    """ Encoding of frames into standalone byte strings, optional dependencies are imported only when used """
+    Names = ('png', 'zstd', 'jpeg')
+    PNGSignature = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, name: str, level: int=None, quality: int=90):
+        if name not in self.Names:
+            raise ValueError(f"Codec '{name}' is not one of {self.Names}")
+        self.name, self.level, self.quality = name, level, quality
+        self.zstd = None
+
+    def check(self, shape: tuple, dtype: np.dtype):
+        """ Raise if the frames can't be encoded by the codec or its optional dependency isn't installed """
+        if self.name in ('png', 'jpeg') and (np.dtype(dtype) != np.uint8 or shape[-1] not in (1, 3)):
+            raise ValueError(f"Codec '{self.name}' needs uint8 frames with 1 or 3 channels")
+        if self.name == 'zstd':
+            import zstandard
+        if self.name == 'jpeg':
+            import PIL.Image
+
+    def encode(self, pixels: np.ndarray) -> bytes:
+        return getattr(self, 'encode_' + self.name)(pixels)
+
+    def decode(self, blob: bytes, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        return getattr(self, 'decode_' + self.name)(blob, shape, dtype)
+
+    def encode_png(self, pixels: np.ndarray) -> bytes:
+        """ PNG with the Up filter on every row written with zlib only """
+        height, width, channels = pixels.shape
+        rows = pixels.reshape(height, width * channels)
+        filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up filter, difference to the row above
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        filtered[0, 1:] = rows[0]
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+        header = struct.pack('>IIBBBBB', width, height, 8, 2 if channels == 3 else 0, 0, 0, 0)
+        data = zlib.compress(filtered.data, 1 if self.level is None else self.level)
+        return self.PNGSignature + chunk(b'IHDR', header) + chunk(b'IDAT', data) + chunk(b'IEND', b'')
+
+    def decode_png(self, blob: bytes, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        """ Decode PNG written by encode_png """
+        data, position = b'', len(self.PNGSignature)
+        while position < len(blob):
+            length, kind = struct.unpack('>I4s', blob[position:position + 8])
+            if kind == b'IDAT':
+                data += blob[position + 8:position + 8 + length]
+            position += length + 12
+        height, width, channels = shape
+        filtered = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(height, width * channels + 1)
+        return np.cumsum(filtered[:, 1:], axis=0, dtype=np.uint8).reshape(shape)
+
+    def encode_zstd(self, pixels: np.ndarray) -> bytes:
+        import zstandard
+        if self.zstd is None:
+            self.zstd = zstandard.ZstdCompressor(level=3 if self.level is None else self.level)
+        return self.zstd.compress(np.ascontiguousarray(pixels).data)
+
+    def decode_zstd(self, blob: bytes, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        import zstandard
+        return np.frombuffer(zstandard.ZstdDecompressor().decompress(blob), dtype=dtype).reshape(shape)
+
+    def encode_jpeg(self, pixels: np.ndarray) -> bytes:
+        import PIL.Image
+        stream = io.BytesIO()
+        image = PIL.Image.fromarray(pixels[..., 0] if pixels.shape[-1] == 1 else pixels)
+        image.save(stream, 'JPEG', quality=self.quality)
+        return stream.getvalue()
+
+    def decode_jpeg(self, blob: bytes, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        import PIL.Image
+        return np.asarray(PIL.Image.open(io.BytesIO(blob))).reshape(shape)
+
+
+def encoder(path: str, shape: tuple, dtype: str, codec: Codec,
+            tasks: multiprocessing.Queue, results: multiprocessing.Queue):
+    """ Worker process encoding frames from slots of the shared memory file until it gets None """
+    slots = np.memmap(path, dtype=dtype, mode='r').reshape((-1,) + shape)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        slot, frame, render_time = task
+        results.put((slot, frame, render_time, codec.encode(slots[slot])))
+
+
+class FrameRecorder:
+    """ Writer of captured frames encoded by a pool of worker processes into chunked shard files with an index
+    Frames are copied into free slots of a memory-mapped file shared with the workers. Once all slots are busy new
+    frames are dropped and counted instead of waiting, so a recording never stalls the simulator. Encoded frames are
+    appended to shards of a fixed number of frames in the order they finish. Every shard switch atomically replaces the
+    footer holding the number of index rows safely on disk. """
+    Footer = 'footer.json'
+    Index = 'index.bin'
+    IndexLayout = np.dtype([('frame', '<u8'), ('renderTime', '<i8'), ('shard', '<u4'),
+                            ('offset', '<u8'), ('length', '<u8')])
+    Shard = 256
+    Slots = 16
+
+    def __init__(self, directory: Path, shape: tuple, dtype: type=np.uint8, codec: str='png', workers: int=2,
+                 slots: int=Slots, shard: int=Shard, level: int=None, quality: int=90):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if (self.directory / self.Footer).exists():
+            raise FileExistsError(f"Recording in '{self.directory}' already exists")
+        self.shape, self.dtype, self.shard = tuple(shape), np.dtype(dtype), shard
+        self.codec = Codec(codec, level, quality)
+        self.codec.check(self.shape, self.dtype)
+
+        shm = Path('/dev/shm') if Path('/dev/shm').is_dir() else Path(tempfile.gettempdir())
+        descriptor, self.path = tempfile.mkstemp(prefix='autodrome_frames_', suffix='.mem', dir=shm)
+        os.close(descriptor)
+        self.slots = np.memmap(self.path, dtype=self.dtype, mode='w+', shape=(slots,) + self.shape)
+        self.free = collections.deque(range(slots))
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()  # Appended, dropped and written frames and bytes
+
+        self.tasks, self.results = multiprocessing.Queue(), multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=encoder, daemon=True,
+                                                args=(self.path, self.shape, self.dtype.str, self.codec,
+                                                      self.tasks, self.results))
+                        for worker in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+        self.file, self.index, self.written = None, open(self.directory / self.Index, 'wb'), 0
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def __enter__(self):
+        return self
+
+    @property
+    def pressure(self) -> float:
+        """ Fraction of the slots waiting for encoding, frames are dropped once it reaches 1 """
+        return 1.0 - len(self.free) / len(self.slots)
+
+    def append(self, pixels: np.ndarray, render_time: int=0) -> bool:
+        """ Queue a copy of the frame for encoding or drop it and return False if all slots are busy """
+        with self.lock:
+            if not self.free:
+                self.stats['dropped'] += 1
+                return False
+            slot = self.free.popleft()
+            frame = self.stats['appended']
+            self.stats['appended'] += 1
+        np.copyto(self.slots[slot], pixels)
+        self.tasks.put((slot, frame, render_time))
+        return True
+
+    def collect(self):
+        """ Write encoded frames into shards and the index as they come from the workers """
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            slot, frame, render_time, blob = result
+            with self.lock:
+                self.free.append(slot)
+            if self.written % self.shard == 0:
+                self.flush()
+                self.file = open(self.directory / f'shard{self.written // self.shard:05d}.bin', 'wb')
+            row = np.array((frame, render_time, self.written // self.shard, self.file.tell(), len(blob)),
+                           dtype=self.IndexLayout)
+            self.file.write(blob)
+            self.index.write(row.tobytes())
+            self.written += 1
+            self.stats['written'] += 1
+            self.stats['bytes'] += len(blob)
+
+    def flush(self):
+        """ Sync the current shard and the index and then commit the footer """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        metadata = {'count': self.written, 'shape': list(self.shape), 'dtype': self.dtype.str,
+                    'codec': self.codec.name, 'shard': self.shard}
+        footer = self.directory / self.Footer
+        temporary = footer.with_suffix('.tmp')
+        temporary.write_text(json.dumps(metadata))
+        os.replace(temporary, footer)
+
+    def close(self):
+        """ Encode all queued frames, commit the footer and release the workers and the shared memory """
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self.collector.join()
+        self.flush()
+        self.index.close()
+        self.slots = None
+        os.unlink(self.path)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FrameRecording:
+    """ Random access to frames stored by the FrameRecorder in the order they were appended """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        metadata = json.loads((self.directory / FrameRecorder.Footer).read_text())
+        self.shape, self.dtype = tuple(metadata['shape']), np.dtype(metadata['dtype'])
+        self.codec = Codec(metadata['codec'])
+        index = np.fromfile(self.directory / FrameRecorder.Index, dtype=FrameRecorder.IndexLayout)
+        index = index[:metadata['count']]
+        self.index = index[np.argsort(index['frame'], kind='stable')]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, position: int) -> np.ndarray:
+        """ Decoded pixels of the frame at the position """
+        row = self.index[position]
+        with open(self.directory / f"shard{row['shard']:05d}.bin", 'rb') as file:
+            file.seek(int(row['offset']))
+            blob = file.read(int(row['length']))
+        return self.codec.decode(blob, self.shape, self.dtype)
+
+    @property
+    def render_times(self) -> np.ndarray:
+        return self.index['renderTime']
+
+
+# region Unit Tests
+
+
+class TestFrameRecorder(unittest.TestCase):
+    Shape = (600, 1024, 3)
+
+    def frames(self, count: int) -> np.ndarray:
+        """ Gradients with a bit of noise that compress like rendered frames """
+        random = np.random.RandomState(0)
+        gradient = np.add.outer(np.arange(self.Shape[0]), np.arange(self.Shape[1])) // 8
+        frames = np.empty((count,) + self.Shape, dtype=np.uint8)
+        for frame in range(count):
+            noise = random.randint(0, 4, size=self.Shape)
+            frames[frame] = (gradient[..., np.newaxis] + frame + noise) % 256
+        return frames
+
+    def test_record(self):
+        frames = self.frames(12)
+        with tempfile.TemporaryDirectory() as directory:
+            with FrameRecorder(directory, self.Shape, shard=5, slots=len(frames)) as recorder:
+                for render_time, pixels in enumerate(frames):
+                    self.assertTrue(recorder.append(pixels, render_time * 10))
+            self.assertEqual(recorder.stats['written'], 12)
+            self.assertLess(recorder.stats['bytes'], frames.nbytes)
+            recording = FrameRecording(directory)
+            self.assertEqual(len(recording), 12)
+            self.assertEqual(recording.render_times.tolist(), list(range(0, 120, 10)))
+            for position in (0, 7, 11):
+                self.assertTrue((recording[position] == frames[position]).all())
+            self.assertEqual(len(list(Path(directory).glob('shard*.bin'))), 3)
+            self.assertFalse(os.path.exists(recorder.path))
+
+    def test_grayscale(self):
+        frames = self.frames(2)[..., 1:2]
+        with tempfile.TemporaryDirectory() as directory:
+            with FrameRecorder(directory, frames.shape[1:], workers=1) as recorder:
+                for pixels in frames:
+                    recorder.append(pixels)
+            self.assertTrue((FrameRecording(directory)[1] == frames[1]).all())
+
+    def test_back_pressure(self):
+        frames = self.frames(1)
+        with tempfile.TemporaryDirectory() as directory:
+            with FrameRecorder(directory, self.Shape, codec='png', workers=1, slots=2, level=9) as recorder:
+                start = time.monotonic()
+                accepted = [recorder.append(frames[0], render_time) for render_time in range(50)]
+                seconds = time.monotonic() - start
+                self.assertEqual(recorder.pressure, 1.0)
+            self.assertLess(seconds, 0.5)  # Appending never waits for the encoders
+            self.assertEqual(recorder.stats['dropped'], accepted.count(False))
+            self.assertGreater(recorder.stats['dropped'], 0)
+            self.assertEqual(len(FrameRecording(directory)), accepted.count(True))
+
+    def test_codec(self):
+        with self.assertRaises(ValueError):
+            Codec('gif')
+        with self.assertRaises(ValueError):
+            Codec('png').check((10, 10, 3), np.float16)
+
+
+# endregion
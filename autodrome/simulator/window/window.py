@@ -3,16 +3,31 @@ import numpy as np
 
 
 class Window(abc.ABC):
-    """ Abstract class for capturing content of a window """
+    """ Abstract class for capturing content of a window
+    Captured pixels are RGB with the same shape and dtype for the whole lifetime of the instance, so buffers for the
+    captures can be allocated once up front. """
+    Dtype = np.uint8
+    ZeroCopy = False  # Whether capture() without an out array returns a view of pixels held by the window
+
     def __init__(self, pid: int, timeout: float):
         """ Create a new instance from main application window of a process """
         self.pid = pid
         self.timeout = timeout
+        self.shape = None  # (Height, Width, 3) of the captured pixels set by the implementation
 
     def activate(self):
         """ Bring window to foreground """
         raise NotImplementedError
 
-    def capture(self) -> np.array:
-        """ Capture border-less window content and return it as a raw pixel array """
+    def focused(self) -> bool:
+        """ Check whether the window is in foreground and receives keyboard input """
+        raise NotImplementedError
+
+    def capture(self, out: np.ndarray=None) -> np.array:
+        """ Capture border-less window content and return it as an RGB pixel array
+        Pixels are written into the preallocated contiguous out array in one pass if it's given. """
         raise NotImplementedError
+
+    def empty(self) -> np.ndarray:
+        """ Allocate a contiguous array that can hold the captured pixels """
+        return np.empty(self.shape, dtype=self.Dtype)
@@ -1,5 +1,8 @@
 import argparse
+from pathlib import Path
 from autodrome.simulator import ETS2, ATS
+from autodrome.simulator.telemetry import Recorder, Telemetry
+from autodrome.simulator.window.recorder import FrameRecorder, Codec
 
 
 Simulators = {'ETS2': ETS2, 'ATS': ATS}
@@ -10,11 +13,26 @@ if __name__ == '__main__':
                         help="Game to run (i.e. ETS2 or ATS)")
     parser.add_argument('-m', '--map', default=None,
                         help="Map to drive on (i.e. 'europe' for ETS2 or 'usa' for ATS)")
+    parser.add_argument('-o', '--output', default='telemetry',
+                        help="Directory where the recorded telemetry is stored")
+    parser.add_argument('-f', '--frames', default=None, choices=Codec.Names,
+                        help="Also record captured frames encoded with the codec into 'frames' output subdirectory")
     args = parser.parse_args()
 
-    with Simulators[args.simulator]() as simulator:
+    with Simulators[args.simulator](threaded=False) as simulator, Recorder(Path(args.output)) as recorder:
+        frames = None
+        if args.frames is not None:
+            frames = FrameRecorder(Path(args.output) / 'frames', simulator.window.shape, codec=args.frames)
+            pixels = simulator.window.empty()
         if args.map is not None:
             simulator.command('preview {}'.format(args.map))
-    while simulator.process.poll() is None:
-        reply = simulator.telemetry.recv()
-        # TODO: Store data here
+        while simulator.process.poll() is None:
+            reply_bytes = simulator.telemetry.recv_bytes()
+            recorder.append(reply_bytes)
+            if frames is not None:
+                reply = Telemetry.decode(reply_bytes)
+                if reply.event == Telemetry.Event.frameEnd:
+                    frames.append(simulator.window.capture(out=pixels), reply.data.telemetry.renderTime)
+        if frames is not None:
+            frames.close()
+            print(f"Frames written: {frames.stats['written']}, dropped: {frames.stats['dropped']}")